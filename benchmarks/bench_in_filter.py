@@ -0,0 +1,69 @@
+"""Benchmark "in" search filters with 10, 1k and 100k ids.
+
+Compares the plain single ``IN (...)`` expression with the chunked / temporary
+table rewrite done by ``nwmapi.search``. Runs against a throw-away SQLite
+database, or the database given as the first argument.
+
+    python benchmarks/bench_in_filter.py [sqlalchemy-url]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from nwmapi import search
+from nwmapi.db import Base, DBSession, ordered_uuid1, apply_filters
+from nwmapi.models.user import User
+
+ROWS = 100000
+SIZES = (10, 1000, 100000)
+
+
+def setup(url):
+    engine = create_engine(url)
+    DBSession.configure(bind=engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+    ids = [ordered_uuid1() for _ in range(ROWS)]
+    engine.execute(User.__table__.insert(),
+                   [{'id': id, 'username': 'user%d' % i, 'email': 'user%d@example.com' % i}
+                    for i, id in enumerate(ids)])
+    return [id.hex for id in ids]
+
+
+def run(ids, chunk_size, threshold):
+    search.IN_CHUNK_SIZE = chunk_size
+    search.IN_TEMP_TABLE_THRESHOLD = threshold
+    filters = json.dumps({'filters': [{'name': 'id', 'op': 'in', 'val': ids}]})
+    start = time.time()
+    try:
+        count = len(apply_filters(None, User, filters).all())
+    except Exception as e:
+        return 'failed (%s)' % type(e).__name__
+    finally:
+        search.drop_in_temp_tables(DBSession)
+        DBSession.close()
+    return '%8.1f ms  %d rows' % ((time.time() - start) * 1000, count)
+
+
+def main(argv=sys.argv):
+    if len(argv) > 1:
+        url = argv[1]
+    else:
+        fd, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        url = 'sqlite:///%s' % path
+
+    chunk_size, threshold = search.IN_CHUNK_SIZE, search.IN_TEMP_TABLE_THRESHOLD
+    ids = setup(url)
+    for size in SIZES:
+        print('%6d ids  plain IN:  %s' % (size, run(ids[:size], sys.maxsize, sys.maxsize)))
+        print('%6d ids  rewritten: %s' % (size, run(ids[:size], chunk_size, threshold)))
+
+
+if __name__ == '__main__':
+    main()
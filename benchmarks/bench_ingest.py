@@ -0,0 +1,73 @@
+"""Ingestion of POST/PUT user bodies: JSON decoding, validation and from_dict.
+
+Times each step for a typical user body with a datetime, and compares
+``Base.from_dict`` and ``parse_datetime`` with the previous implementations:
+a loop over every column reading its type on each call, and ``dateutil``
+parsing every datetime. No database is needed.
+
+    python benchmarks/bench_ingest.py [iterations]
+"""
+import json
+import sys
+import time
+
+import dateutil.parser
+
+from nwmapi import validation
+from nwmapi.db import parse_datetime
+from nwmapi.models.user import User
+
+ITERATIONS = 20000
+
+BODY = json.dumps({
+    'username': 'ann',
+    'email': 'ann@example.com',
+    'firstname': 'Ann',
+    'lastname': 'Smith',
+    'location': 'Lisbon',
+    'about_me': 'Hello',
+    'created_at': '2016-02-01T10:20:30.123Z',
+})
+
+
+def legacy_from_dict(user, dictionary):
+    for col in user.__table__.columns.keys():
+        val = dictionary.get(col, None)
+        coltype = user.__table__.columns._data[col].type
+        if type(val) is str and coltype.__class__.__name__ in ('DateTime', 'UTCDateTime'):
+            val = dateutil.parser.parse(val)
+        if val:
+            setattr(user, col, val)
+
+
+def timeit(label, func, iterations):
+    start = time.time()
+    for i in range(iterations):
+        func()
+    elapsed = time.time() - start
+    print('%-28s %8.2f us' % (label, elapsed / iterations * 1e6))
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    data = json.loads(BODY)
+    schema = validation.schema(User)
+    value = data['created_at']
+
+    timeit('json.loads', lambda: json.loads(BODY), iterations)
+    timeit('schema.validate', lambda: schema.validate(data), iterations)
+    timeit('parse_datetime', lambda: parse_datetime(value), iterations)
+    timeit('dateutil.parser.parse', lambda: dateutil.parser.parse(value), iterations)
+    timeit('from_dict', lambda: User().from_dict(dict(data)), iterations)
+    timeit('legacy from_dict', lambda: legacy_from_dict(User(), dict(data)), iterations)
+
+    def ingest():
+        body = json.loads(BODY)
+        schema.validate(body)
+        User().from_dict(body)
+
+    timeit('decode + validate + from_dict', ingest, iterations)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark signup throughput against GET latency under mixed load.
+
+Simulates a waitress server with a fixed number of request threads serving a
+mix of signups (bcrypt hash) and cheap GETs (serializing a small document).
+Signups hash either inline on the request thread or through the bounded
+``nwmapi.passwords`` pool, where requests over the queue depth are rejected
+(503) instead of occupying a request thread.
+
+    python benchmarks/bench_password_pool.py [rounds]
+"""
+from concurrent import futures
+import json
+import sys
+import time
+
+from nwmapi import passwords
+
+SERVER_THREADS = 4
+REQUESTS = 2000
+SIGNUP_EVERY = 10   # one signup per N requests
+
+
+def get():
+    json.dumps({'id': '0' * 32, 'username': 'user', 'email': 'user@example.com'})
+
+
+def signup_inline():
+    passwords._hash('secret password', passwords.ROUNDS)
+
+
+def signup_pool():
+    try:
+        passwords.hash_password('secret password')
+    except passwords.PasswordPoolBusy:
+        return False
+    return True
+
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return time.time() - start, result
+
+
+def run(signup):
+    server = futures.ThreadPoolExecutor(max_workers=SERVER_THREADS)
+    gets, signups = [], []
+    start = time.time()
+    for i in range(REQUESTS):
+        submitted = time.time()
+        if i % SIGNUP_EVERY == 0:
+            signups.append(server.submit(timed, signup))
+        else:
+            # latency as seen by the client, including waiting for a thread
+            gets.append((submitted, server.submit(lambda: (get(), time.time())[1])))
+        time.sleep(0.0005)
+    server.shutdown(wait=True)
+    elapsed = time.time() - start
+
+    latencies = sorted(done.result() - submitted for submitted, done in gets)
+    completed = sum(1 for f in signups if f.result()[1] is not False)
+    return (completed / elapsed,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+            len(signups) - completed)
+
+
+def main(argv=sys.argv):
+    passwords.configure(rounds=int(argv[1]) if len(argv) > 1 else 10)
+    for name, signup in (('inline', signup_inline), ('pool', signup_pool)):
+        rate, p50, p99, rejected = run(signup)
+        print('%-6s  signups/s %6.1f  GET p50 %7.2f ms  p99 %7.2f ms  rejected %d'
+              % (name, rate, p50, p99, rejected))
+
+
+if __name__ == '__main__':
+    main()
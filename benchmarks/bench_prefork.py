@@ -0,0 +1,92 @@
+"""Throughput of the preforking server by number of worker processes.
+
+Serves the app on a temporary SQLite database with 1, 2, 4... workers (up to
+the number of CPUs, or the counts given as arguments) and keeps ``CLIENTS``
+keep-alive HTTP clients, each in its own process, requesting ``GET /queries``
+for ``DURATION`` seconds. Only 200 responses are counted, and a run with any
+other status fails. The clients need CPUs too: run them on another host for
+figures close to the server's capacity.
+
+    python benchmarks/bench_prefork.py [workers...]
+"""
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+import nwmapi
+from nwmapi import prefork
+
+DURATION = 5.0
+CLIENTS = 16
+THREADS = 4
+
+
+def serve(sock, workers, settings):
+    app = prefork.load(lambda: nwmapi.main({}, **settings))
+    prefork.Arbiter(app, sock, workers=workers, options={'threads': THREADS}, graceful_timeout=5).run()
+
+
+def client(port, deadline, results):
+    conn = httplib.HTTPConnection('127.0.0.1', port)
+    count = 0
+    errors = 0
+    while time.time() < deadline:
+        conn.request('GET', '/queries', headers={'Accept': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            count += 1
+        else:
+            errors += 1
+    results.put((count, errors))
+
+
+def bench(workers, settings):
+    sock = prefork.bind('127.0.0.1', 0)
+    port = sock.getsockname()[1]
+    server = multiprocessing.Process(target=serve, args=(sock, workers, settings))
+    server.start()
+    time.sleep(2)
+    try:
+        results = multiprocessing.Queue()
+        deadline = time.time() + DURATION
+        clients = [multiprocessing.Process(target=client, args=(port, deadline, results))
+                   for i in range(CLIENTS)]
+        for process in clients:
+            process.start()
+        counts = [results.get() for process in clients]
+        for process in clients:
+            process.join()
+    finally:
+        os.kill(server.pid, signal.SIGTERM)
+        server.join()
+        sock.close()
+    errors = sum(e for _, e in counts)
+    if errors:
+        raise RuntimeError('%d responses to GET /queries were not 200' % errors)
+    return sum(c for c, _ in counts) / DURATION
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    settings = {'sqlalchemy.url': 'sqlite:///%s/bench.sqlite' % directory,
+                'auth.keys': 'bench:secret'}
+    counts = [int(arg) for arg in sys.argv[1:]]
+    if not counts:
+        counts = [1]
+        while counts[-1] * 2 <= multiprocessing.cpu_count():
+            counts.append(counts[-1] * 2)
+    for workers in counts:
+        print('%2d workers  %8.0f requests/sec' % (workers, bench(workers, settings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Microbenchmark of the rate limiter hot path.
+
+Times ``RateLimiter.process_resource`` for an allowed request, which is the
+whole per-request cost of the middleware, with each store.
+
+    python benchmarks/bench_ratelimit.py
+"""
+import os
+import tempfile
+import timeit
+
+from nwmapi.ratelimit import MemoryStore, RateLimiter, SQLiteStore
+
+N = 100000
+
+
+class FakeRequest(object):
+    # anonymous: the claims set by RequestPipeline, keyed by the address
+    context = {}
+    env = {'REMOTE_ADDR': '10.0.0.1'}
+
+    def get_header(self, name):
+        return None
+
+
+class FakeResource(object):
+    __url__ = '/users'
+
+
+def bench(store):
+    limiter = RateLimiter(store, default=(1e9, 1e9))
+    req, resource = FakeRequest(), FakeResource()
+    seconds = timeit.timeit(lambda: limiter.process_resource(req, None, resource), number=N)
+    return seconds / N * 1e6
+
+
+def main():
+    print('memory  %6.2f us/request' % bench(MemoryStore()))
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    print('sqlite  %6.2f us/request' % bench(SQLiteStore(path)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Requests/sec of a trivial GET through the whole application.
+
+Calls the WSGI app directly with ``GET /queries``, which lists the named
+queries from memory without database access, so the numbers are the cost of
+falcon, the middleware and the response serialization. Every response must
+be a 200, so that error responses are never timed.
+
+    python benchmarks/bench_requests.py [requests]
+"""
+import sys
+import tempfile
+import time
+
+from falcon import testing
+
+import nwmapi
+
+N = 20000
+
+
+def make_app():
+    directory = tempfile.mkdtemp()
+    return nwmapi.main({}, **{
+        'sqlalchemy.url': 'sqlite:///%s/bench.sqlite' % directory,
+        'auth.keys': 'bench:secret',
+    })
+
+
+def start_response(status, headers, exc_info=None):
+    if not status.startswith('200'):
+        raise RuntimeError('GET /queries answered %s' % status)
+
+
+def bench(app, n, **kwargs):
+    env = testing.create_environ(path='/queries', headers={'Accept': 'application/json'}, **kwargs)
+    start = time.time()
+    for _ in range(n):
+        # the input stream is consumed by each request
+        b''.join(app(dict(env), start_response))
+    return n / (time.time() - start)
+
+
+def main(argv=sys.argv):
+    n = int(argv[1]) if len(argv) > 1 else N
+    app = make_app()
+    bench(app, 1000)
+    print('GET /queries             %8.0f requests/sec' % bench(app, n))
+    print('GET /queries?pretty=true %8.0f requests/sec' % bench(app, n, query_string='pretty=true'))
+
+
+if __name__ == '__main__':
+    main()
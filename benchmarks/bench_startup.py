@@ -0,0 +1,76 @@
+"""Cold start of the app: importing nwmapi and building the app with main().
+
+Each run is a fresh interpreter started with ``python -X importtime`` (Python
+3.7+) on an empty SQLite database. Prints the median time of the import and
+of ``main()``, and the modules slowest to import, cumulative microseconds
+including the modules they import. Each run checks that the app it built
+answers ``GET /queries`` with a 200.
+
+    python benchmarks/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+RUNS = 10
+TOP = 20
+
+SCRIPT = """
+import time
+started = time.time()
+import nwmapi
+imported = time.time()
+app = nwmapi.main({}, **{'sqlalchemy.url': 'sqlite:///%s', 'auth.keys': 'bench:secret'})
+print('%%f %%f' %% (imported - started, time.time() - imported))
+
+# the app built must work: a startup which only builds a broken app is not timed
+from falcon import testing
+start_response = testing.StartResponseMock()
+app(testing.create_environ(path='/queries', headers={'Accept': 'application/json'}), start_response)
+if start_response.status != '200 OK':
+    raise SystemExit('GET /queries answered %%s' %% start_response.status)
+"""
+
+
+def run(directory):
+    path = os.path.join(directory, 'startup.sqlite')
+    if os.path.exists(path):
+        os.remove(path)
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', SCRIPT % path],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError(err)
+    import_seconds, main_seconds = [float(value) for value in out.split()]
+    return import_seconds, main_seconds, err
+
+
+def slowest(importtime, top):
+    modules = []
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.append((int(cumulative), name.rstrip()))
+    return sorted(modules, reverse=True)[:top]
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else RUNS
+    directory = tempfile.mkdtemp()
+    results = [run(directory) for i in range(runs)]
+    print('import nwmapi  %6.1f ms' % (median([r[0] for r in results]) * 1000))
+    print('main()         %6.1f ms' % (median([r[1] for r in results]) * 1000))
+    print('\nslowest imports (us, cumulative):')
+    for cumulative, name in slowest(results[-1][2], TOP):
+        print('%8d %s' % (cumulative, name))
+
+
+if __name__ == '__main__':
+    main()
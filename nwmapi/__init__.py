@@ -1,12 +1,21 @@
 import logging
 import falcon
-from nwmapi.httpstatus import HTTP500InternalServerError, HTTP400BadRequest
-from nwmapi.middleware import ReqRequireJSONType, ParseJSONReqBody, Request, Response, \
-    DBSessionLifeCycle, SetCORSRespHeaders, ProcessCommonReqParams
-from nwmapi.db import Base, DBSession
+from nwmapi.httpstatus import HTTP500InternalServerError, HTTP400BadRequest, HTTP503ServiceUnavailable
+from nwmapi.middleware import Request, Response, RequestPipeline, MAX_BODY
+from nwmapi.db import Base, DBSession, check_schema_version, enable_sqlite_savepoints
 from nwmapi.resources import RootResource
-from nwmapi.resources.meta import MetaListResource
-from nwmapi.resources.users import UserResource, UsersResource
+from nwmapi.resources.batch import BatchResource
+from nwmapi.resources.jobs import JobResource
+from nwmapi.resources.meta import MetaListResource, SlowQueriesResource
+from nwmapi.resources.metrics import MetricsResource
+from nwmapi.resources.queries import QueriesResource
+from nwmapi.resources.users import UserResource, UsersResource, UserStatsResource, UsersExportResource, \
+    UserLoginResource, UserLogoutResource, UsersBulkResource, UsersLookupResource
+from nwmapi.services import userservice
+from nwmapi import batch, jobs, metrics, namedqueries, passwords, prefork, profiling, ratelimit, resources, \
+    scheduler, search, slowqueries, sqlstats, timing, tokens
+from nwmapi.common import booleanize
+from nwmapi.models.user import User
 from sqlalchemy import engine_from_config
 
 
@@ -17,9 +26,49 @@ def main(global_config, **settings):
     """ This function returns a WSGI application.
     """
     engine = engine_from_config(settings, 'sqlalchemy.')
+    # atomic batches roll back through SAVEPOINTs
+    enable_sqlite_savepoints(engine)
     DBSession.configure(bind=engine)
+    prefork.register_engine(engine)
+    sqlstats.install(engine)
+    sqlstats.configure(budget=settings.get('sqlstats.budget'),
+                       n_plus_one_threshold=settings.get('sqlstats.n_plus_one_threshold'))
     Base.metadata.bind = engine
-    Base.metadata.create_all()
+    # the schema is managed by alembic, DDL on startup is opt-in
+    if booleanize(settings.get('db.create_all', False)):
+        Base.metadata.create_all()
+    if settings.get('db.schema_version'):
+        check_schema_version(engine, settings['db.schema_version'])
+
+    search.IN_CHUNK_SIZE = int(settings.get('search.in_chunk_size', search.IN_CHUNK_SIZE))
+    search.IN_TEMP_TABLE_THRESHOLD = int(settings.get('search.in_temp_table_threshold',
+                                                      search.IN_TEMP_TABLE_THRESHOLD))
+    batch.configure(max_requests=settings.get('batch.max_requests'),
+                    max_statements=settings.get('batch.max_statements'),
+                    max_seconds=settings.get('batch.max_seconds'))
+    resources.PREFLIGHT_MAX_AGE = int(settings.get('cors.max_age', resources.PREFLIGHT_MAX_AGE))
+    namedqueries.configure(allow_post=settings.get('namedqueries.allow_post'),
+                           max_queries=settings.get('namedqueries.max_queries'))
+    namedqueries.load_from_settings(settings, models=[User])
+    passwords.configure(rounds=settings.get('passwords.rounds'),
+                        workers=settings.get('passwords.workers'),
+                        queue_depth=settings.get('passwords.queue_depth'),
+                        processes=booleanize(settings.get('passwords.processes', False)))
+    userservice.user_estimates.max_age = int(settings.get('estimates.max_age',
+                                                          userservice.user_estimates.max_age))
+    userservice.user_estimates.listen()
+    signer = tokens.from_settings(settings)
+    limiter = ratelimit.from_settings(settings)
+    jobs.configure(settings)
+
+    sweep_interval = int(settings.get('sweep.interval', 0))
+    if sweep_interval:
+        batch_size = int(settings.get('sweep.batch_size', 500))
+        pause = float(settings.get('sweep.pause', 0))
+        scheduler.every(sweep_interval,
+                        lambda: userservice.enqueue_sweep_non_activated_accounts(batch_size=batch_size,
+                                                                                 pause=pause),
+                        name='sweep_non_activated_accounts')
 
     # Configure WSGI server (app is a WSGI callable)
     app = falcon.API(
@@ -33,13 +82,7 @@ def main(global_config, **settings):
         # process_request middleware methods raises an error, it will be processed according
         # to the error type. If the type matches a registered error handler, that handler will be invoked
         # and then the framework will begin to unwind the stack, skipping any lower layers.
-        middleware=[
-            DBSessionLifeCycle(),
-            ReqRequireJSONType(),
-            ProcessCommonReqParams(),
-            ParseJSONReqBody(),
-            SetCORSRespHeaders(),
-        ],
+        middleware=build_middleware(settings, signer, engine, limiter),
 
         # ``Request``-like class to use instead of Falcon's default class. Among other things,
         # this feature affords inheriting from ``falcon.request.Request`` in order
@@ -51,12 +94,30 @@ def main(global_config, **settings):
 
     app.set_error_serializer(json_error_serializer)
 
-    add_routes(app)
+    add_routes(app, signer, limiter, settings)
 
     return app
 
 
-def add_routes(app):
+def build_middleware(settings, signer, engine, limiter=None):
+    # Optional components, configured in the ini file. They come first so that
+    # a rate limited request is rejected before its body is read.
+    components = [component for component in (metrics.from_settings(settings, engine),
+                                               limiter,
+                                               slowqueries.from_settings(settings, engine))
+                  if component is not None]
+
+    components.append(RequestPipeline(signer, max_body=int(settings.get('request.max_body', MAX_BODY))))
+
+    # Last, so that it profiles the hooks and the responder only
+    profiler = profiling.from_settings(settings)
+    if profiler is not None:
+        components.append(profiler)
+
+    return timing.instrument(settings, engine, components)
+
+
+def add_routes(app, signer, limiter=None, settings=None):
     # The router treats URI paths as a tree of URI segments and searches by
     # checking the URI one segment at a time. Instead of interpreting the route
     # tree for each look-up, it generates inlined, bespoke Python code to
@@ -86,10 +147,26 @@ def add_routes(app):
     app.add_route(RootResource.__url__, RootResource())
     app.add_route(MetaListResource.__url__, MetaListResource())
     app.add_route(UsersResource.__url__, UsersResource())
+    app.add_route(UserStatsResource.__url__, UserStatsResource())
+    app.add_route(UsersExportResource.__url__, UsersExportResource())
+    app.add_route(UsersBulkResource.__url__, UsersBulkResource())
+    app.add_route(UsersLookupResource.__url__, UsersLookupResource())
+    app.add_route(UserLoginResource.__url__, UserLoginResource(signer))
+    app.add_route(UserLogoutResource.__url__, UserLogoutResource(signer))
     app.add_route(UserResource.__url__, UserResource())
+    app.add_route(QueriesResource.__url__, QueriesResource())
+    app.add_route(JobResource.__url__, JobResource())
+    app.add_route(BatchResource.__url__, BatchResource(app, limiter))
+    if metrics.registry is not None:
+        app.add_route(MetricsResource.__url__, MetricsResource(token=(settings or {}).get('metrics.token')))
+    if slowqueries.registry is not None:
+        app.add_route(SlowQueriesResource.__url__,
+                      SlowQueriesResource(token=(settings or {}).get('slowqueries.token')))
 
     # If a responder ever raised an instance of Exception, pass control to the given handler.
     app.add_error_handler(Exception, handle_server_error)
+    # Handlers added later take precedence
+    app.add_error_handler(passwords.PasswordPoolBusy, handle_password_pool_busy)
 
 
 def json_error_serializer(req, exception):
@@ -123,6 +200,13 @@ def handle_server_error(ex, req, resp, params):
     raise http_error
 
 
+def handle_password_pool_busy(ex, req, resp, params):
+    raise HTTP503ServiceUnavailable(title='Too many password requests',
+                                    description='Too many sign ups or logins are in progress. '
+                                                'Please try again shortly.',
+                                    retry_after=1)
+
+
 def raise_unknown_url(req, resp):
     raise HTTP400BadRequest(title='Invalid url',
                             description='No route handler method defined for the url')
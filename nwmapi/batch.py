@@ -0,0 +1,235 @@
+"""Run many API calls in one HTTP request.
+
+``POST /batch`` takes a list of sub-requests, each a method, a path (with its
+query string) and an optional JSON body::
+
+    {"atomic": false,
+     "requests": [{"method": "GET", "path": "/users/<id>"},
+                  {"method": "PUT", "path": "/users/<id>", "body": {"firstname": "Ann"}}]}
+
+They run one after the other in the same thread, routed by the app's router
+and answered by its resources and their hooks, without the WSGI round trip
+and the middleware: the access token of the batch, its parsed body and its
+database session serve every sub-request. The response lists the status,
+headers and body of each one, in order.
+
+Each sub-request still takes a token from the rate limit bucket of its own
+route (429 when empty), and gets a ``sqlstats.budget`` of its own.
+
+With ``atomic``, the sub-requests share one transaction. Each runs in a
+SAVEPOINT, which takes the commit of the service it calls, and the batch
+commits once at the end. The first failing sub-request (status 400 or more)
+rolls everything back and the remaining ones are not run. (SQLite through
+pysqlite only honours SAVEPOINTs with the recipe of the SQLAlchemy
+documentation, which ``main()`` installs, see
+:func:`nwmapi.db.enable_sqlite_savepoints`.)
+
+A batch is limited to ``max_requests`` sub-requests, and stops running them
+once it has issued ``max_statements`` SQL statements or run for
+``max_seconds``: the remaining ones are answered with 429. Resources with a
+``__batch__`` attribute set to false (streamed bodies or responses) are not
+available in a batch.
+
+Settings::
+
+    batch.max_requests = 25
+    batch.max_statements = 500
+    batch.max_seconds = 10
+"""
+from collections import OrderedDict
+import io
+import logging
+import time
+
+import falcon
+from nwmapi import sqlstats
+from nwmapi.db import DBSession, jsonify
+from nwmapi.httpstatus import HTTP400BadRequest, HTTP400InvalidFields, HTTP500InternalServerError
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+log = logging.getLogger(__name__)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+#: Sub-requests allowed in one batch
+MAX_REQUESTS = 25
+
+#: SQL statements after which the remaining sub-requests are not run, 0 for no limit
+MAX_STATEMENTS = 500
+
+#: Seconds after which the remaining sub-requests are not run, 0 for no limit
+MAX_SECONDS = 10.0
+
+METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+# the conditional headers of the batch do not apply to its sub-requests
+_DROPPED_ENV = ('HTTP_IF_MATCH', 'HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE', 'HTTP_IF_UNMODIFIED_SINCE',
+                'CONTENT_LENGTH')
+
+
+def configure(max_requests=None, max_statements=None, max_seconds=None):
+    global MAX_REQUESTS, MAX_STATEMENTS, MAX_SECONDS
+    if max_requests is not None:
+        MAX_REQUESTS = int(max_requests)
+    if max_statements is not None:
+        MAX_STATEMENTS = int(max_statements)
+    if max_seconds is not None:
+        MAX_SECONDS = float(max_seconds)
+
+
+def parse(data):
+    """Return the list of ``(method, path, query string, body)`` of the batch body ``data``.
+
+    Raises 400 listing every invalid sub-request.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('requests'), list):
+        raise HTTP400BadRequest('Invalid batch', 'A JSON object with a "requests" array is required.')
+    items = data['requests']
+    if not items:
+        raise HTTP400BadRequest('Invalid batch', 'The batch has no requests.')
+    if len(items) > MAX_REQUESTS:
+        raise HTTP400BadRequest('Batch too large', 'A batch may not have more than %d requests.' % MAX_REQUESTS)
+
+    requests = []
+    errors = OrderedDict()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors[str(index)] = 'not an object'
+            continue
+        method = item.get('method')
+        path = item.get('path')
+        if method not in METHODS:
+            errors['%d.method' % index] = 'not one of %s' % ', '.join(METHODS)
+        if not isinstance(path, string_types) or not path.startswith('/'):
+            errors['%d.path' % index] = 'not an absolute path'
+            continue
+        path, _, query_string = path.partition('?')
+        requests.append((method, path, query_string, item.get('body')))
+    if errors:
+        raise HTTP400InvalidFields(errors)
+    return requests
+
+
+class Dispatcher(object):
+    """Runs the sub-requests of a batch through the router of ``app``.
+
+    ``limiter`` is the :class:`~nwmapi.ratelimit.RateLimiter` of the app, if any.
+    """
+
+    def __init__(self, app, limiter=None):
+        self.app = app
+        self.limiter = limiter
+
+    def run(self, req, requests, atomic=False, pretty=False):
+        """Return the JSON text of the responses to ``requests``, run on behalf of ``req``."""
+        started = clock()
+        statements = sqlstats.query_count()
+        responses = []
+        failed = False
+        for method, path, query_string, body in requests:
+            if failed and atomic:
+                responses.append(_not_run('424 Failed Dependency', 'Not run',
+                                          'A previous request of the atomic batch failed.'))
+                continue
+            if self._over_budget(started, statements):
+                failed = True
+                responses.append(_not_run('429 Too Many Requests', 'Batch budget exceeded',
+                                          'The batch ran out of time or SQL statements before this request.'))
+                continue
+
+            savepoint = DBSession.begin_nested() if atomic else None
+            sqlstats.renew_budget()
+            status, response = self.call(req, method, path, query_string, body, pretty)
+            responses.append(response)
+            if status < 400:
+                # a service which did not commit left its savepoint open
+                if savepoint is not None and savepoint.is_active:
+                    savepoint.commit()
+            else:
+                failed = True
+                if savepoint is not None and savepoint.is_active:
+                    savepoint.rollback()
+                DBSession.rollback()
+
+        if not atomic:
+            return '{"responses":[%s]}' % ','.join(responses)
+        if failed:
+            DBSession.rollback()
+        else:
+            DBSession.commit()
+        return '{"committed":%s,"responses":[%s]}' % ('false' if failed else 'true', ','.join(responses))
+
+    def _over_budget(self, started, statements):
+        if MAX_SECONDS and clock() - started > MAX_SECONDS:
+            return True
+        return bool(MAX_STATEMENTS) and sqlstats.query_count() - statements > MAX_STATEMENTS
+
+    def call(self, parent, method, path, query_string, body, pretty=False):
+        """Run one sub-request, returning its status code and its response as JSON text."""
+        env = dict((key, value) for key, value in parent.env.items() if key not in _DROPPED_ENV)
+        env['REQUEST_METHOD'] = method
+        env['PATH_INFO'] = path
+        env['QUERY_STRING'] = query_string
+        env['wsgi.input'] = io.BytesIO()
+        req = self.app._request_type(env, options=self.app.req_options)
+        resp = self.app._response_type()
+        req.context['auth'] = parent.context.get('auth')
+        req.json_data = body
+        resp.pretty_json = pretty
+
+        params = {}
+        try:
+            try:
+                # the router of falcon 0.3, as API.__call__ uses it
+                responder, params, resource = self.app._get_responder(req)
+                if not getattr(resource, '__batch__', True):
+                    raise HTTP400BadRequest('Not available in a batch',
+                                            'The resource %s can not be called in a batch.' % path)
+                if self.limiter is not None:
+                    self.limiter.process_resource(req, resp, resource)
+                responder(req, resp, **params)
+            except falcon.HTTPError:
+                raise
+            except Exception as ex:
+                for err_type, err_handler in self.app._error_handlers:
+                    if isinstance(ex, err_type):
+                        err_handler(ex, req, resp, params)
+                        break
+                else:
+                    raise
+        except falcon.HTTPError as ex:
+            body = jsonify(ex.to_dict(OrderedDict)) if ex.has_representation else None
+            return _code(ex.status), _response(ex.status, ex.headers, body)
+        except Exception as ex:
+            # an error handler which did not raise an HTTPError
+            log.exception(ex)
+            ex = HTTP500InternalServerError(repr(type(ex)), repr(ex))
+            return _code(ex.status), _response(ex.status, None, jsonify(ex.to_dict(OrderedDict)))
+
+        result = resp.body
+        if result is None and resp.data is not None:
+            result = resp.data.decode('utf-8')
+        if result and not (resp.content_type or '').startswith('application/json'):
+            # as a JSON string
+            result = jsonify(result)
+        # falcon 0.3 keeps the headers, lowercased, in _headers
+        return _code(resp.status), _response(resp.status, resp._headers, result)
+
+
+def _code(status):
+    return int(status.split(' ', 1)[0])
+
+
+def _response(status, headers, body):
+    return '{"status":%d,"headers":%s,"body":%s}' % (_code(status), jsonify(headers or {}),
+                                                    body if body else 'null')
+
+
+def _not_run(status, title, description):
+    error = OrderedDict((('status', status), ('title', title), ('description', description)))
+    return _response(status, None, jsonify(error))
+
@@ -1,13 +1,11 @@
-import configparser
 import hashlib
-from logging.config import fileConfig
 import random
 
 
 import os
-from paste.deploy import (
-    appconfig,
-)
+
+# configparser, logging.config and paste.deploy are imported by the functions
+# using them: only the scripts need them, not the app
 
 
 # Taken from pyramid framework <pyramid/scripts/common.py>
@@ -27,8 +25,7 @@ def parse_vars(args):
     return result
 
 
-def setup_logging(config_uri, fileConfig=fileConfig,
-                  configparser=configparser):
+def setup_logging(config_uri, fileConfig=None, configparser=None):
     """
     Set up logging via the logging module's fileConfig function with the
     filename specified via ``config_uri`` (a string in the form
@@ -37,6 +34,10 @@ def setup_logging(config_uri, fileConfig=fileConfig,
     ConfigParser defaults are specified for the special ``__file__``
     and ``here`` variables, similar to PasteDeploy config loading.
     """
+    if fileConfig is None:
+        from logging.config import fileConfig
+    if configparser is None:
+        import configparser
     path, _ = _getpathsec(config_uri, None)
     parser = configparser.ConfigParser()
     parser.read([path])
@@ -58,7 +59,7 @@ def _getpathsec(config_uri, name):
     return path, section
 
 
-def get_appsettings(config_uri, name=None, options=None, appconfig=appconfig):
+def get_appsettings(config_uri, name=None, options=None, appconfig=None):
     """ Return a dictionary representing the key/value pairs in an ``app``
     section within the file represented by ``config_uri``.
 
@@ -69,6 +70,8 @@ def get_appsettings(config_uri, name=None, options=None, appconfig=appconfig):
     If the ``name`` is None, this will attempt to parse the name from
     the ``config_uri`` string expecting the format ``inifile#name``.
     If no name is found, the name will default to "main"."""
+    if appconfig is None:
+        from paste.deploy import appconfig
     path, section = _getpathsec(config_uri, name)
     config_name = 'config:%s' % path
     here_dir = os.getcwd()
@@ -1,20 +1,35 @@
 from collections import OrderedDict
 import json
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+import re
 import uuid
 
-import dateutil.parser
-from dateutil.tz import tzutc
 from nwmapi.search import create_query
-from sqlalchemy import Unicode, Text, DateTime, desc
+from nwmapi.timing import timed
+from sqlalchemy import Unicode, Text, DateTime, desc, event
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker, joinedload, subqueryload
 from sqlalchemy.types import TypeDecorator, CHAR
 from sqlalchemy.dialects.postgresql import UUID
 
 log = logging.getLogger(__name__)
 
+try:
+    from datetime import timezone
+    UTC = timezone.utc
+except ImportError:
+    # Python 2
+    from dateutil.tz import tzutc
+    timezone = None
+    UTC = tzutc()
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 # See: http://docs.sqlalchemy.org/en/rel_1_0/orm/extensions/declarative/mixins.html#augmenting-the-base
 class Base(object):
     """A mixin class to augment Base class that will be extended by all Model classes
@@ -52,12 +67,18 @@ class Base(object):
         """
         return list(self.__table__.primary_key.columns)[0].name
 
-    def to_dict(self, excluded=None, included=None, object_type=dict):
+    @timed('serialize')
+    def to_dict(self, excluded=None, included=None, object_type=dict, deep=None):
         """Return the resource as a dictionary.
         Include all columns if include_columns is None or empty set
         if a column name is specified in both excluded and included sets,
         the column will get excluded.
 
+        ``deep`` is a dictionary mapping relation names to the ``deep``
+        dictionary of the related model, as returned by :func:`parse_includes`.
+        Those relations are added to the result; load them eagerly with
+        :func:`apply_includes` to avoid a query per row.
+
         :rtype: dict
         """
         excluded = excluded or set()
@@ -69,28 +90,48 @@ class Base(object):
 
         result = object_type()
         for col in columns:
-            val = getattr(self, col, None)
-            if type(val) is uuid.UUID:
-                val = val.hex
-            elif type(val) is datetime:
-                # val = val.replace(microsecond=0)
-                # val = val.isoformat()
-                val = val.strftime('%Y-%m-%dT%H:%M:%S.%f')
-                val = val[:-3] + 'Z'
+            val = serialize_value(getattr(self, col, None))
             if col in included and col not in excluded:
                 result[col] = val
+
+        for relation, rdeep in (deep or {}).items():
+            related = getattr(self, relation)
+            if related is None:
+                result[relation] = None
+            elif isinstance(related, Base):
+                result[relation] = related.to_dict(deep=rdeep)
+            else:
+                result[relation] = [r.to_dict(deep=rdeep) for r in related]
         return result
 
+    @classmethod
+    def column_converters(cls):
+        """Return the function converting a JSON string to the value of each column, ``None`` if it is kept.
+
+        Computed once per model.
+        """
+        converters = cls.__dict__.get('_column_converters')
+        if converters is None:
+            converters = {}
+            for column in cls.__table__.columns:
+                if isinstance(column.type, (DateTime, UTCDateTime)):
+                    converters[column.key] = parse_datetime
+                else:
+                    converters[column.key] = None
+            cls._column_converters = converters
+        return converters
+
     def from_dict(self, dictionary):
-        dictionary = dictionary or {}
-        for col in self.__table__.columns.keys():
-            val = dictionary.get(col, None)
-            coltype = self.__table__.columns._data[col].type
-            valtype = type(val)
-            if (valtype is str) and (coltype is DateTime or coltype is UTCDateTime):
-                val = dateutil.parser.parse(val)
+        """Set the columns of the keys of ``dictionary``, ignoring other keys and falsy values."""
+        converters = self.column_converters()
+        for key, val in (dictionary or {}).items():
+            if key not in converters:
+                continue
+            convert = converters[key]
+            if convert is not None and isinstance(val, string_types):
+                val = convert(val)
             if val:
-                setattr(self, col, val)
+                setattr(self, key, val)
 
     def to_json(self, excluded=None, included=None, pretty=False, object_type=OrderedDict):
         dictionary = self.to_dict(excluded=excluded, included=included, object_type=object_type)
@@ -100,7 +141,7 @@ class Base(object):
         return json.dumps(dictionary)
 
     def from_json(self, json_str):
-        dictionary = json.loads(json_str, encoding='utf-8')
+        dictionary = json.loads(json_str)
         self.from_dict(dictionary)
 
     def replace(self, dictionary):
@@ -128,6 +169,19 @@ class Base(object):
     def __str__(self):
         return str(getattr(self, self.primary_key()))
 
+def serialize_value(val):
+    """Convert a column value to its JSON representation: GUIDs as hex strings
+    and datetimes as ISO 8601 strings with milliseconds in UTC."""
+    if type(val) is uuid.UUID:
+        return val.hex
+    elif type(val) is datetime:
+        # val = val.replace(microsecond=0)
+        # val = val.isoformat()
+        val = val.strftime('%Y-%m-%dT%H:%M:%S.%f')
+        return val[:-3] + 'Z'
+    return val
+
+
 # Base is a class and has its own metadata property and its own registry.
 # The reason we use 'declarative_base' function to create Base class
 # is because that allow us to create another Base class if necessary.
@@ -158,6 +212,52 @@ DBSession = scoped_session(sessionmaker(
     expire_on_commit=True
 ))
 
+
+class SchemaVersionMismatch(RuntimeError):
+    """The database is not at the alembic revision the code expects."""
+
+    def __init__(self, expected, found):
+        super(SchemaVersionMismatch, self).__init__(
+            'Database schema at revision %s, expected %s: run "alembic upgrade head"'
+            % (', '.join(found) or 'none', expected))
+        self.expected = expected
+        self.found = found
+
+
+def check_schema_version(engine, expected):
+    """Raise :exc:`SchemaVersionMismatch` unless the alembic revision of the database is ``expected``."""
+    try:
+        found = [row[0] for row in engine.execute('SELECT version_num FROM alembic_version')]
+    except DBAPIError as e:
+        log.debug(e)
+        # no alembic_version table
+        found = []
+    if found != [expected]:
+        raise SchemaVersionMismatch(expected, found)
+
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    # no BEGIN issued by pysqlite itself, nor its COMMIT before DDL
+    dbapi_connection.isolation_level = None
+
+
+def _sqlite_begin(conn):
+    # on the DBAPI connection, so that sqlstats does not count it as a statement
+    conn.connection.cursor().execute('BEGIN')
+
+
+def enable_sqlite_savepoints(engine):
+    """Make SAVEPOINTs work on a pysqlite ``engine``, as in the SQLAlchemy documentation.
+
+    pysqlite only starts a transaction before an INSERT, UPDATE or DELETE, so
+    releasing a SAVEPOINT outside of one commits it. With this, SQLAlchemy
+    emits BEGIN itself when a transaction starts. Other engines are left as is.
+    """
+    if engine.dialect.name != 'sqlite' or event.contains(engine, 'begin', _sqlite_begin):
+        return
+    event.listen(engine, 'connect', _sqlite_connect)
+    event.listen(engine, 'begin', _sqlite_begin)
+
 # @contextmanager
 # def transactional_dbsession():
 #     """Provide a transactional scope around a series of operations."""
@@ -192,6 +292,13 @@ class GUID(TypeDecorator):
 
     impl = CHAR
 
+    @staticmethod
+    def coerce(value):
+        """Return ``value`` as a ``uuid.UUID``, accepting UUIDs and hex strings."""
+        if value is None or isinstance(value, uuid.UUID):
+            return value
+        return uuid.UUID(value)
+
     def load_dialect_impl(self, dialect):
         if dialect.name == 'postgresql':
             return dialect.type_descriptor(UUID())
@@ -204,11 +311,11 @@ class GUID(TypeDecorator):
         elif dialect.name == 'postgresql':
             return str(value)
         else:
+            # hexstring; "%.32x" % value needs __index__, which UUID lacks on Python 3
             if not isinstance(value, uuid.UUID):
-                return "%.32x" % uuid.UUID(value)
+                return uuid.UUID(value).hex
             else:
-                # hexstring
-                return "%.32x" % value
+                return value.hex
 
     def process_result_value(self, value, dialect):
         if value is None:
@@ -233,23 +340,64 @@ class JsonBlob(TypeDecorator):
         return value
 
 
+#: The ISO 8601 datetimes written by :func:`serialize_value`, and the like
+ISO_8601_DATETIME = re.compile(r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6})\d*)?'
+                               r'(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def parse_iso8601(value):
+    """Return the datetime of the ISO 8601 string ``value``, ``None`` if it is in another format.
+
+    Without an offset the datetime is naive, as with ``dateutil``.
+    """
+    match = ISO_8601_DATETIME.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, offset = match.groups()
+    if offset is None:
+        tzinfo = None
+    elif offset == 'Z':
+        tzinfo = UTC
+    elif timezone is None:
+        return None
+    else:
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        tzinfo = timezone(timedelta(minutes=-minutes if offset[0] == '-' else minutes))
+    try:
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                        int(fraction.ljust(6, '0')) if fraction else 0, tzinfo)
+    except ValueError:
+        # out of range
+        return None
+
+
+def parse_datetime(value):
+    """Return the datetime of the string ``value``."""
+    parsed = parse_iso8601(value)
+    if parsed is not None:
+        return parsed
+    # other formats, imported on first use since it is slow to import
+    import dateutil.parser
+    return dateutil.parser.parse(value)
+
+
 # Based on: http://stackoverflow.com/questions/2528189/can-sqlalchemy-datetime-objects-only-be-naive
 class UTCDateTime(TypeDecorator):
     impl = DateTime
 
     def process_bind_param(self, value, engine):
-        if type(value) is str:
-            value = dateutil.parser.parse(value)
+        if isinstance(value, string_types):
+            value = parse_datetime(value)
         if value is not None:
-            return value.astimezone(tzutc())
+            return value.astimezone(UTC)
 
     def process_result_value(self, value, engine):
         if type(value) is str:
-            value = dateutil.parser.parse(value)
+            value = parse_datetime(value)
         if value is not None:
             return datetime(value.year, value.month, value.day,
                             value.hour, value.minute, value.second,
-                            value.microsecond, tzinfo=tzutc())
+                            value.microsecond, tzinfo=UTC)
 
 
 # See: https://www.percona.com/blog/2014/12/19/store-uuid-optimized-way/
@@ -284,7 +432,24 @@ def utcnow():
     """
     :return: current datetime in utc with utc timezone
     """
-    return datetime.now(tz=tzutc())
+    return datetime.now(tz=UTC)
+
+
+def merge_patch(target, patch):
+    """Return ``target`` with the JSON Merge Patch ``patch`` applied (RFC 7396).
+
+    Members of ``patch`` set to ``None`` are removed, objects are merged
+    recursively and any other value replaces the target's.
+    """
+    if not isinstance(patch, dict):
+        return patch
+    result = OrderedDict(target) if isinstance(target, dict) else OrderedDict()
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
 
 
 # class ModelJSONEncoder(json.JSONEncoder):
@@ -355,12 +520,18 @@ def jsonify(result, **kwargs):
         result = [m.to_dict() if isinstance(m, Base) else m for m in result]
     elif isinstance(result, Base):
         result = result.to_dict()
+    return _encode(result, **kwargs)
+
+
+@timed('encode')
+def _encode(result, **kwargs):
     # return json.dumps(result, cls=ModelJSONEncoder, encoding='utf-8', **kwargs)
-    return json.dumps(result, encoding='utf-8', **kwargs)
+    return json.dumps(result, **kwargs)
 
 
 def generate_query(model,
-                   filters=None, order_by=None, limit=None, offset=None, start=None, end=None):
+                   filters=None, order_by=None, limit=None, offset=None, start=None, end=None,
+                   deep=None):
     """apply where/order_by/limit/offset to the ``Query`` based on a "
     "range and return the newly resulting ``Query``."""
 
@@ -369,6 +540,8 @@ def generate_query(model,
         q = apply_filters(q, model, filters)
     if order_by:
         q = apply_order_by(q, model, order_by)
+    if deep:
+        q = apply_includes(q, model, deep)
     if limit:
         q = q.limit(int(limit))
     if offset:
@@ -384,12 +557,31 @@ def generate_query(model,
     return q
 
 
-def apply_filters(q, model, filters):
+class InvalidFilters(ValueError):
+    """The ``q`` parameter is not JSON or not a valid search of the model."""
+
+    def __init__(self, error):
+        super(InvalidFilters, self).__init__('Invalid filters: %s' % error)
+
+
+def parse_filters(filters):
+    """Return the search parameters of a ``q`` request parameter."""
+    # falcon splits comma separated query parameters into a list
+    if type(filters) is list:
+        filters = ','.join(filters)
+    return json.loads(filters)
+
+
+def apply_filters(q, model, filters, session=DBSession):
+    """Return the query of ``model`` searching with the ``q`` parameter ``filters``, or ``q`` without filters.
+
+    Raises :exc:`InvalidFilters` if ``filters`` is not a valid search.
+    """
     if filters:
-        if type(filters) is list:
-            filters = ','.join(filters)
-        searchparams = json.loads(filters)
-        q = create_query(DBSession, model, searchparams)
+        try:
+            q = create_query(session, model, parse_filters(filters))
+        except (ValueError, AttributeError, KeyError, TypeError) as e:
+            raise InvalidFilters(e)
 
     return q
 
@@ -415,3 +607,62 @@ def apply_order_by(q, model, order_by):
 
     return q
 
+
+def parse_includes(include, model=None):
+    """Turn an ``include`` request parameter into a ``deep`` dictionary.
+
+    ``include`` is a comma separated string (or list) of relation paths, e.g.
+    ``activation,groups.users`` becomes
+    ``{'activation': {}, 'groups': {'users': {}}}``.
+
+    If ``model`` is given, the paths are checked against it and ``ValueError``
+    is raised as in :func:`apply_includes`.
+    """
+    deep = OrderedDict()
+    if not include:
+        return deep
+    if type(include) is str:
+        include = include.split(',')
+
+    for path in include:
+        node = deep
+        for name in path.strip().split('.'):
+            node = node.setdefault(name, OrderedDict())
+
+    if model is not None:
+        _loader_options(model, deep)
+    return deep
+
+
+def apply_includes(q, model, deep):
+    """Eager load the relations named in ``deep`` (see :func:`parse_includes`).
+
+    Scalar relations are loaded with a join in the same statement, collections
+    with one extra query per relation, whatever the number of rows. Raises
+    ``ValueError`` for names which are not eager loadable relations of the model.
+    """
+    for option in _loader_options(model, deep):
+        q = q.options(option)
+    return q
+
+
+def _loader_options(model, deep, parent=None):
+    options = []
+    for name, rdeep in deep.items():
+        attr = getattr(model, name, None)
+        prop = getattr(attr, 'property', None)
+        if prop is None or not hasattr(prop, 'mapper'):
+            raise ValueError('%s has no relation named %r' % (model.__name__, name))
+        if prop.lazy == 'dynamic':
+            raise ValueError('%s.%s is a dynamic relation and cannot be included' % (model.__name__, name))
+
+        strategy = 'subqueryload' if prop.uselist else 'joinedload'
+        if parent is None:
+            loader = {'subqueryload': subqueryload, 'joinedload': joinedload}[strategy](attr)
+        else:
+            loader = getattr(parent, strategy)(attr)
+
+        options.append(loader)
+        options.extend(_loader_options(prop.mapper.class_, rdeep, parent=loader))
+    return options
+
@@ -0,0 +1,217 @@
+"""Approximate row counts and distinct counts kept in memory.
+
+A :class:`CardinalityEstimator` keeps a HyperLogLog sketch per column of a
+model, plus one of the primary key for the row count. Sketches are built in
+batch from the table with :meth:`CardinalityEstimator.rebuild` and updated
+incrementally from the mapper ``after_insert``/``after_update`` events, so
+reading an estimate never touches the database.
+
+Bulk ``Query.delete()`` and ``Query.update()`` bypass the mapper events and
+are seen through the session ``after_bulk_delete``/``after_bulk_update``
+events instead: deleted rows are subtracted from the row count, and a bulk
+update of an estimated column, whose new values are unknown, marks the
+sketches stale so that the next :meth:`CardinalityEstimator.stats` rebuilds
+them in the background.
+
+HyperLogLog cannot forget values: deleted rows are subtracted from the row
+count, but distinct counts only shrink on the next rebuild. Writes of flushes
+which are later rolled back are counted as well. Each process keeps its own
+sketches and only sees its own writes between rebuilds.
+"""
+from collections import OrderedDict
+import hashlib
+import logging
+import math
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+log = logging.getLogger(__name__)
+
+
+class HyperLogLog(object):
+    """HyperLogLog sketch of the distinct values added to it.
+
+    With ``precision`` p, the sketch uses 2**p one-byte registers and the
+    estimate has a relative standard error of ``1.04 / sqrt(2**p)``
+    (about 1.6% for the default of 12, in 4KB).
+    """
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError('precision must be between 4 and 16')
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+        self._rest_bits = 64 - precision
+        self._rest_mask = (1 << self._rest_bits) - 1
+
+    def add(self, value):
+        x = int.from_bytes(hashlib.sha1(str(value).encode('utf-8')).digest()[:8], 'big')
+        j = x >> self._rest_bits
+        rank = self._rest_bits - (x & self._rest_mask).bit_length() + 1
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge sketches of different precision')
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        estimate = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+        if estimate <= 2.5 * self.m:
+            # small range correction (linear counting)
+            zeros = self.registers.count(0)
+            if zeros:
+                estimate = self.m * math.log(self.m / float(zeros))
+        return int(round(estimate))
+
+    @property
+    def error(self):
+        """Relative standard error of :meth:`count`."""
+        return 1.04 / math.sqrt(self.m)
+
+
+def estimate(value, error):
+    """Return an estimate with its relative standard error and ~95% bounds."""
+    # rounded to the nearest count, so that small counts, which are
+    # estimated to much less than one, are bounded by themselves
+    delta = value * 2 * error
+    result = OrderedDict()
+    result['value'] = value
+    result['error'] = round(error, 4)
+    result['bounds'] = [max(0, int(round(value - delta))), int(round(value + delta))]
+    return result
+
+
+class CardinalityEstimator(object):
+    """Keeps the approximate row count of ``model`` and distinct counts of ``columns``."""
+
+    def __init__(self, model, columns, precision=12, max_age=3600):
+        self.model = model
+        self.columns = tuple(columns)
+        self.precision = precision
+        #: seconds after which :meth:`stats` triggers a rebuild in the background
+        self.max_age = max_age
+        self.built_at = None
+        #: set by bulk updates of the columns, the next :meth:`stats` rebuilds
+        self.stale = False
+        self._lock = threading.Lock()
+        # held while the sketches are built, one build at a time
+        self._build_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.rows = HyperLogLog(self.precision)
+        self.deleted = 0
+        self.sketches = OrderedDict((col, HyperLogLog(self.precision)) for col in self.columns)
+
+    def listen(self):
+        """Update the sketches from the mapper events of the model."""
+        if event.contains(self.model, 'after_insert', self._after_write):
+            return
+        event.listen(self.model, 'after_insert', self._after_write)
+        event.listen(self.model, 'after_update', self._after_write)
+        event.listen(self.model, 'after_delete', self._after_delete)
+        event.listen(Session, 'after_bulk_delete', self._after_bulk_delete)
+        event.listen(Session, 'after_bulk_update', self._after_bulk_update)
+
+    def _after_write(self, mapper, connection, target):
+        self.add(target)
+
+    def _after_delete(self, mapper, connection, target):
+        with self._lock:
+            self.deleted += 1
+
+    def _after_bulk_delete(self, delete_context):
+        if delete_context.primary_table is self.model.__table__:
+            with self._lock:
+                self.deleted += max(0, delete_context.result.rowcount)
+
+    def _after_bulk_update(self, update_context):
+        if update_context.primary_table is not self.model.__table__:
+            return
+        values = update_context.values
+        keys = values.keys() if hasattr(values, 'keys') else [key for key, value in values]
+        if any(getattr(key, 'key', key) in self.columns for key in keys):
+            self.stale = True
+
+    def add(self, instance):
+        pk = self.model.__table__.primary_key.columns.keys()[0]
+        with self._lock:
+            self.rows.add(getattr(instance, pk))
+            for col, sketch in self.sketches.items():
+                value = getattr(instance, col)
+                if value is not None:
+                    sketch.add(value)
+
+    def rebuild(self, session, batch_size=10000):
+        """Rebuild the sketches from a scan of the table, ``batch_size`` rows at a time."""
+        started = time.time()
+        # bulk updates during the scan mark the new sketches stale again
+        self.stale = False
+        table = self.model.__table__
+        pk = list(table.primary_key.columns)[0]
+        rows = HyperLogLog(self.precision)
+        sketches = OrderedDict((col, HyperLogLog(self.precision)) for col in self.columns)
+
+        q = session.query(pk, *[table.c[col] for col in self.columns]).yield_per(batch_size)
+        for row in q:
+            rows.add(row[0])
+            for sketch, value in zip(sketches.values(), row[1:]):
+                if value is not None:
+                    sketch.add(value)
+
+        with self._lock:
+            self.rows = rows
+            self.sketches = sketches
+            self.deleted = 0
+            self.built_at = time.time()
+        log.info('Rebuilt %s estimates in %.2fs', table.name, self.built_at - started)
+
+    def _rebuild_in_background(self, session_factory):
+        """Start rebuilding the sketches in a thread, unless a build is running."""
+        if not self._build_lock.acquire(False):
+            return
+
+        def run():
+            session = session_factory()
+            try:
+                self.rebuild(session)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                session.close()
+                self._build_lock.release()
+
+        thread = threading.Thread(target=run, name='estimates-%s' % self.model.__tablename__)
+        thread.daemon = True
+        thread.start()
+
+    def stats(self, session_factory):
+        """Return the estimates, building the sketches on first use.
+
+        Only one thread builds them, the others wait for it. Stale sketches
+        are rebuilt in the background while the current ones are returned.
+        """
+        if self.built_at is None:
+            with self._build_lock:
+                if self.built_at is None:
+                    session = session_factory()
+                    try:
+                        self.rebuild(session)
+                    finally:
+                        session.close()
+        elif self.stale or time.time() - self.built_at > self.max_age:
+            self._rebuild_in_background(session_factory)
+
+        with self._lock:
+            result = OrderedDict()
+            result['count'] = estimate(max(0, self.rows.count() - self.deleted), self.rows.error)
+            result['distinct'] = OrderedDict(
+                (col, estimate(sketch.count(), sketch.error)) for col, sketch in self.sketches.items())
+        return result
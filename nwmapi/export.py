@@ -0,0 +1,54 @@
+"""Encoders streaming rows (dictionaries of JSON values) as NDJSON or CSV.
+
+Each encoder is a generator of ``bytes`` chunks of roughly :data:`CHUNK_SIZE`,
+suitable for ``resp.stream``, so only one chunk is held in memory at a time.
+"""
+import csv
+import io
+import json
+
+CHUNK_SIZE = 64 * 1024
+
+
+def ndjson_chunks(rows):
+    buf = []
+    size = 0
+    for row in rows:
+        line = json.dumps(row) + '\n'
+        buf.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(buf).encode('utf-8')
+            buf = []
+            size = 0
+    if buf:
+        yield ''.join(buf).encode('utf-8')
+
+
+def csv_chunks(rows, fieldnames):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(fieldnames)
+    for row in rows:
+        writer.writerow([_csv_value(row[name]) for name in fieldnames])
+        if buf.tell() >= CHUNK_SIZE:
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')
+
+
+def _csv_value(val):
+    if val is None:
+        return ''
+    if isinstance(val, (dict, list)):
+        return json.dumps(val)
+    return val
+
+
+#: format name -> media type
+MEDIA_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
@@ -13,7 +13,6 @@ import datetime
 import inspect
 import uuid
 
-from dateutil.parser import parse as parse_datetime
 from sqlalchemy import Date
 from sqlalchemy import DateTime
 from sqlalchemy import Interval
@@ -566,6 +565,7 @@ def strings_to_dates(model, dictionary):
             elif value in CURRENT_TIME_MARKERS:
                 result[fieldname] = getattr(func, value.lower())()
             else:
+                from dateutil.parser import parse as parse_datetime
                 value_as_datetime = parse_datetime(value)
                 result[fieldname] = value_as_datetime
                 # If the attribute on the model needs to be a Date object as
@@ -1,11 +1,28 @@
+import hmac
 import logging
 
-from nwmapi.httpstatus import HTTP400InvalidParam, HTTP413RequestEntityTooLarge, HTTP400BadRequest, \
-    HTTP400MissingRequiredParam
+from nwmapi.httpstatus import HTTP400InvalidParam, HTTP400BadRequest, HTTP400MissingRequiredParam, \
+    HTTP400InvalidFields, HTTP401Unauthorized, HTTP403Forbidden
 import re
 
+from nwmapi import validation
+from nwmapi.models.user import USER_ROLE_ADMIN
+from nwmapi.timing import timed_hook
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
 log = logging.getLogger(__name__)
 
+#: Ids are 32 hex digits
+ID_PATTERN = re.compile('[a-fA-F0-9]{32}$')
+
+
+def is_valid_id(value):
+    return isinstance(value, string_types) and ID_PATTERN.match(value) is not None
+
 
 def require_path_param(*args):
     def hook(req, resp, resource, params):
@@ -13,15 +30,10 @@ def require_path_param(*args):
         for name in args:
             if name not in params:
                 raise HTTP400MissingRequiredParam(name)
-            if name == 'id':
-                check_id(params)
-
-    def check_id(params):
-        val = params.get('id')
-        if not re.match("[a-fA-F0-9]{32}$", val):
-            raise HTTP400InvalidParam('The "id" needs to be 32 digits hex numbers', 'id')
+            if name == 'id' and not is_valid_id(params['id']):
+                raise HTTP400InvalidParam('id')
 
-    return hook
+    return timed_hook(hook)
 
 
 def require_query_param(*args):
@@ -31,7 +43,37 @@ def require_query_param(*args):
             if name not in req.params:
                 raise HTTP400MissingRequiredParam(name)
 
-    return hook
+    return timed_hook(hook)
+
+
+def require_admin():
+    """Raise 401 without an access token, 403 if it is not an admin's."""
+    def hook(req, resp, resource, params):
+        log.debug('require_admin')
+        claims = req.context.get('auth')
+        if not claims:
+            raise HTTP401Unauthorized('Authentication required', 'An access token is required.')
+        if claims.get('role') != USER_ROLE_ADMIN:
+            raise HTTP403Forbidden('Forbidden', 'Only admins can do this.')
+
+    return timed_hook(hook)
+
+
+def require_token(header='X-Admin-Token'):
+    """Raise 401 unless the ``header`` of the request is the ``token`` of the resource.
+
+    Resources without a token refuse every request with 403.
+    """
+    def hook(req, resp, resource, params):
+        log.debug('require_token %s', header)
+        if not resource.token:
+            raise HTTP403Forbidden('Forbidden', 'No token is configured for %s.' % resource.__url__)
+        value = req.get_header(header)
+        if value is None or not hmac.compare_digest(value.encode('utf-8'), resource.token.encode('utf-8')):
+            raise HTTP401Unauthorized('Authentication required', 'A valid %s header is required.' % header,
+                                      scheme=header)
+
+    return timed_hook(hook)
 
 
 def require_req_body():
@@ -39,11 +81,12 @@ def require_req_body():
         log.debug('require_req_body')
         _check_req_body_exists(req)
 
-    return hook
+    return timed_hook(hook)
 
 
 def _check_req_body_exists(req):
-    if req.content_length in (None, 0):
+    # the sub-requests of a batch come with their body parsed
+    if req.json_data is None and req.content_length in (None, 0):
         raise HTTP400BadRequest('Empty request body',
                                 'A valid JSON document is required.')
 
@@ -59,35 +102,23 @@ def require_json_fields(*argv):
             if key not in data:
                 raise HTTP400MissingRequiredParam(key)
 
-    return hook
+    return timed_hook(hook)
+
 
+def validate_fields(model, partial=False):
+    """Raise 400 listing every field of the body invalid for ``model``.
+
+    With ``partial``, required fields may be left out, as in an update.
+    """
+    schema = validation.schema(model)
 
-def validate_fields(model):
     def hook(req, resp, resource, params):
         log.debug('validate_fields')
         _check_req_body_exists(req)
-
         data = req.json_data
-
-        required_fields = model.required()
-        all_fields = required_fields + model.optional()
-
-        for key in data:
-            if key not in all_fields:
-                raise HTTP400InvalidParam(key)
-        for required in set(model.required()):
-            if required not in data:
-                raise HTTP400MissingRequiredParam(required)
-    return hook
-
-
-def max_body(limit):
-    def hook(req, resp, resource, params):
-        length = req.content_length
-        if length is not None and length > limit:
-            description = ('The size of the request is too large. The body must not '
-                           'exceed ' + str(limit) + ' bytes in length.')
-
-            raise HTTP413RequestEntityTooLarge('Request body is too large', description)
-
-    return hook
+        if not isinstance(data, dict):
+            raise HTTP400BadRequest('Invalid body', 'A JSON object is required.')
+        errors = schema.validate(data, partial=partial)
+        if errors:
+            raise HTTP400InvalidFields(errors)
+    return timed_hook(hook)
@@ -57,6 +57,49 @@ class HTTP400InvalidParam(falcon.HTTPInvalidParam):
         super(HTTP400InvalidParam, self).__init__("", param_name, **kwargs)
 
 
+class HTTP400InvalidFields(HTTP400BadRequest):
+    """400 Bad Request listing the invalid fields of a request body.
+
+    Args:
+        errors (dict): The message of each invalid field, added to the
+            representation as ``errors``.
+        kwargs (optional): Same as for ``HTTPError``.
+
+    """
+
+    def __init__(self, errors, **kwargs):
+        super(HTTP400InvalidFields, self).__init__('Invalid fields',
+                                                   'Invalid fields: %s.' % ', '.join(errors), **kwargs)
+        self.errors = errors
+
+    def to_dict(self, obj_type=dict):
+        obj = super(HTTP400InvalidFields, self).to_dict(obj_type)
+        obj['errors'] = self.errors
+        return obj
+
+
+class HTTP401Unauthorized(falcon.HTTPUnauthorized):
+    """401 Unauthorized.
+
+    Use when authentication is required, and the provided credentials are
+    not valid, or no credentials were provided in the first place.
+
+    Args:
+        title (str): Error title (e.g., 'Authentication Required').
+        description (str): Human-friendly description of the error, along with
+            a helpful suggestion or two.
+        scheme (str): Authentication scheme to use as the value of the
+            WWW-Authenticate header in the response (default 'Bearer').
+        kwargs (optional): Same as for ``HTTPError``.
+
+    """
+
+    def __init__(self, title, description, scheme='Bearer', **kwargs):
+        headers = kwargs.setdefault('headers', {})
+        headers['WWW-Authenticate'] = scheme
+        super(HTTP401Unauthorized, self).__init__(title, description, **kwargs)
+
+
 class HTTP403Forbidden(falcon.HTTPForbidden):
     """403 Forbidden.
 
@@ -133,6 +176,24 @@ class HTTP406NotAcceptable(falcon.HTTPNotAcceptable):
         super(HTTP406NotAcceptable, self).__init__('Media type not acceptable', description, **kwargs)
 
 
+class HTTP409Conflict(falcon.HTTPConflict):
+    """409 Conflict.
+
+    The request could not be completed due to a conflict with the current
+    state of the resource. (RFC 2616)
+
+    Args:
+        title (str): Error title (e.g., 'Editing Conflict').
+        description (str): Human-friendly description of the error, along with
+            a helpful suggestion or two.
+        kwargs (optional): Same as for ``HTTPError``.
+
+    """
+
+    def __init__(self, title, description, **kwargs):
+        super(HTTP409Conflict, self).__init__(title, description, **kwargs)
+
+
 class HTTP413RequestEntityTooLarge(falcon.HTTPRequestEntityTooLarge):
     """413 Request Entity Too Large.
 
@@ -180,6 +241,28 @@ class HTTP415UnsupportedMediaType(falcon.HTTPUnsupportedMediaType):
         super(HTTP415UnsupportedMediaType, self).__init__(description, **kwargs)
 
 
+class HTTP429TooManyRequests(falcon.HTTPError):
+    """429 Too Many Requests.
+
+    The user has sent too many requests in a given amount of time ("rate
+    limiting"). (RFC 6585)
+
+    Args:
+        title (str): Error title (e.g., 'Rate Limit Exceeded').
+        description (str): Human-friendly description of the error, along with
+            a helpful suggestion or two.
+        retry_after (int): Value for the Retry-After header, the number of
+            seconds to wait before making a new request.
+        kwargs (optional): Same as for ``HTTPError``.
+
+    """
+
+    def __init__(self, title, description, retry_after, **kwargs):
+        headers = kwargs.setdefault('headers', {})
+        headers['Retry-After'] = str(retry_after)
+        super(HTTP429TooManyRequests, self).__init__('429 Too Many Requests', title, description, **kwargs)
+
+
 class HTTP500InternalServerError(falcon.HTTPInternalServerError):
     """500 Internal Server Error.
 
@@ -229,7 +312,7 @@ class HTTP503ServiceUnavailable(falcon.HTTPServiceUnavailable):
     """
 
     def __init__(self, title, description, retry_after, **kwargs):
-        super(HTTP503ServiceUnavailable, self).__init__(title, description, **kwargs)
+        super(HTTP503ServiceUnavailable, self).__init__(title, description, retry_after, **kwargs)
 
 
 def _HTTPError_to_dict(self, obj_type=dict):
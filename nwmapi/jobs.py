@@ -0,0 +1,267 @@
+"""In-process background jobs with a persistent queue.
+
+Work that does not need to finish before the response is sent is enqueued as
+a job instead of running in the responder::
+
+    @job_type('rebuild_user_estimates', concurrency=1)
+    def rebuild_user_estimates(payload):
+        ...
+
+    job_id = jobs.enqueue('rebuild_user_estimates')
+
+Jobs are stored in their own database (``jobs.url``, usually a SQLite file)
+and run by a small pool of worker threads in each server process. A worker
+claims a job by moving it to ``running`` with a lease; the job is retried with
+exponential backoff when its handler raises, up to the ``max_attempts`` of its
+type, and picked up again by any process once the lease of a crashed worker
+expires. A job whose last attempt expired that way is marked failed instead.
+Each job type runs at most ``concurrency`` jobs at a time per process.
+
+Handlers get a thread-local ``DBSession`` which is removed after each job.
+"""
+from collections import OrderedDict
+import json
+import logging
+import threading
+import time
+import uuid
+
+from sqlalchemy import Table, Column, MetaData, String, Text, Integer, Float, create_engine, \
+    select, and_, or_
+
+from nwmapi import prefork
+from nwmapi.common import booleanize
+from nwmapi.db import DBSession
+
+log = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+metadata = MetaData()
+
+job_table = Table(
+    'job', metadata,
+    Column('id', String(32), primary_key=True),
+    Column('type', String(64), nullable=False),
+    Column('payload', Text),
+    Column('status', String(16), nullable=False, index=True),
+    Column('attempts', Integer, nullable=False, default=0),
+    Column('run_at', Float, nullable=False, index=True),
+    Column('locked_until', Float),
+    Column('result', Text),
+    Column('last_error', Text),
+    Column('created_at', Float, nullable=False),
+    Column('updated_at', Float, nullable=False),
+)
+
+
+class JobType(object):
+    def __init__(self, name, func, concurrency=1, max_attempts=3, backoff=2.0, lease=300):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        #: seconds before the first retry, doubled for every further attempt
+        self.backoff = backoff
+        #: seconds after which a running job is considered lost and run again
+        self.lease = lease
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+
+#: job type name -> JobType
+JOB_TYPES = OrderedDict()
+
+
+def job_type(name, concurrency=1, max_attempts=3, backoff=2.0, lease=300):
+    """Register the decorated function as the handler of jobs of type ``name``.
+
+    The handler is called with the job payload and may return a JSON
+    serializable result.
+    """
+    def decorator(func):
+        JOB_TYPES[name] = JobType(name, func, concurrency=concurrency, max_attempts=max_attempts,
+                                  backoff=backoff, lease=lease)
+        return func
+    return decorator
+
+
+class JobQueue(object):
+    """Jobs persisted in the database of ``engine``."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        metadata.create_all(engine)
+
+    def enqueue(self, type, payload=None, delay=0):
+        if type not in JOB_TYPES:
+            raise ValueError('Unknown job type %r' % type)
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        self.engine.execute(job_table.insert().values(
+            id=job_id, type=type, payload=json.dumps(payload), status=JOB_QUEUED, attempts=0,
+            run_at=now + delay, created_at=now, updated_at=now))
+        return job_id
+
+    def get(self, job_id):
+        row = self.engine.execute(select([job_table]).where(job_table.c.id == job_id)).first()
+        if row is None:
+            return None
+        result = OrderedDict((key, row[key]) for key in ('id', 'type', 'status', 'attempts', 'last_error'))
+        result['result'] = json.loads(row['result']) if row['result'] else None
+        for key in ('run_at', 'created_at', 'updated_at'):
+            result[key] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(row[key]))
+        return result
+
+    def claim(self, types):
+        """Move the next due job of one of ``types`` to running and return it, or ``None``."""
+        now = time.time()
+        due = or_(job_table.c.status == JOB_QUEUED,
+                  and_(job_table.c.status == JOB_RUNNING, job_table.c.locked_until < now))
+        candidates = self.engine.execute(
+            select([job_table.c.id, job_table.c.type, job_table.c.payload, job_table.c.attempts,
+                    job_table.c.status])
+            .where(and_(due, job_table.c.run_at <= now, job_table.c.type.in_(types)))
+            .order_by(job_table.c.run_at)
+            .limit(len(types))).fetchall()
+
+        for row in candidates:
+            if row['status'] == JOB_RUNNING and row['attempts'] >= JOB_TYPES[row['type']].max_attempts:
+                # its last attempt was lost with its worker
+                self.engine.execute(
+                    job_table.update()
+                    .where(and_(job_table.c.id == row['id'], due))
+                    .values(status=JOB_FAILED, last_error='Lease expired', locked_until=None, updated_at=now))
+                log.warning('Job %s of type %s failed: lease expired after %d attempts',
+                            row['id'], row['type'], row['attempts'])
+                continue
+
+            # only one worker wins the update of a given job
+            claimed = self.engine.execute(
+                job_table.update()
+                .where(and_(job_table.c.id == row['id'], due))
+                .values(status=JOB_RUNNING, attempts=row['attempts'] + 1,
+                        locked_until=now + JOB_TYPES[row['type']].lease, updated_at=now))
+            if claimed.rowcount == 1:
+                return row['id'], row['type'], json.loads(row['payload']), row['attempts'] + 1
+        return None
+
+    def finish(self, job_id, result):
+        self._update(job_id, status=JOB_DONE, result=json.dumps(result), locked_until=None)
+
+    def fail(self, job_id, error, attempts, jobtype):
+        if attempts < jobtype.max_attempts:
+            run_at = time.time() + jobtype.backoff * 2 ** (attempts - 1)
+            self._update(job_id, status=JOB_QUEUED, last_error=error, run_at=run_at, locked_until=None)
+        else:
+            self._update(job_id, status=JOB_FAILED, last_error=error, locked_until=None)
+
+    def _update(self, job_id, **values):
+        values['updated_at'] = time.time()
+        self.engine.execute(job_table.update().where(job_table.c.id == job_id).values(**values))
+
+
+class JobRunner(object):
+    """Runs due jobs in ``workers`` daemon threads, polling every ``poll_interval`` seconds."""
+
+    def __init__(self, queue, workers=2, poll_interval=1.0):
+        self.queue = queue
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work, name='jobs-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _work(self):
+        while not self._stopped.is_set():
+            try:
+                if not self.run_one():
+                    self._stopped.wait(self.poll_interval)
+            except Exception as e:
+                log.exception(e)
+                self._stopped.wait(self.poll_interval)
+
+    def run_one(self):
+        """Run one due job, if a job type has a free slot. Returns whether a job ran."""
+        free = [jobtype for jobtype in JOB_TYPES.values() if jobtype.slots.acquire(False)]
+        claimed = None
+        try:
+            if free:
+                claimed = self.queue.claim([jobtype.name for jobtype in free])
+        finally:
+            # keep the slot of the claimed type only
+            claimed_type = claimed[1] if claimed else None
+            for jobtype in free:
+                if jobtype.name != claimed_type:
+                    jobtype.slots.release()
+
+        if claimed is None:
+            return False
+
+        job_id, type, payload, attempts = claimed
+        jobtype = JOB_TYPES[type]
+        started = time.time()
+        try:
+            result = jobtype.func(payload)
+        except Exception as e:
+            log.exception('Job %s %s failed (attempt %d)', type, job_id, attempts)
+            DBSession.rollback()
+            self.queue.fail(job_id, repr(e), attempts, jobtype)
+        else:
+            self.queue.finish(job_id, result)
+            log.info('Job %s %s done in %.2fs', type, job_id, time.time() - started)
+        finally:
+            DBSession.remove()
+            jobtype.slots.release()
+        return True
+
+
+queue = None
+runner = None
+
+
+def configure(settings):
+    """Set up the queue and start the workers if ``jobs.enabled``."""
+    global queue, runner
+    if not booleanize(settings.get('jobs.enabled', False)):
+        return
+
+    for key, value in settings.items():
+        if key.startswith('jobs.concurrency.') and key[len('jobs.concurrency.'):] in JOB_TYPES:
+            jobtype = JOB_TYPES[key[len('jobs.concurrency.'):]]
+            jobtype.concurrency = int(value)
+            jobtype.slots = threading.BoundedSemaphore(jobtype.concurrency)
+
+    queue = JobQueue(create_engine(settings['jobs.url']))
+    runner = JobRunner(queue,
+                       workers=int(settings.get('jobs.workers', 2)),
+                       poll_interval=float(settings.get('jobs.poll_interval', 1.0)))
+    prefork.register_engine(queue.engine)
+    prefork.start(runner.start)
+
+
+def enqueue(type, payload=None, delay=0):
+    """Enqueue a job and return its id.
+
+    Without a configured queue the job runs right away in the calling thread
+    and ``None`` is returned.
+    """
+    if queue is None:
+        JOB_TYPES[type].func(payload)
+        return None
+    return queue.enqueue(type, payload, delay=delay)
+
+
+def get(job_id):
+    if queue is None:
+        return None
+    return queue.get(job_id)
@@ -0,0 +1,326 @@
+"""Request metrics in the Prometheus text format, served at ``/metrics``.
+
+Every thread records into its own shard of plain dictionaries, without
+locking; a scrape merges the shards. The values of a thread are only ever
+written by that thread, so a scrape may miss a request in progress but never
+loses one.
+
+With ``metrics.multiprocess_dir``, each process of a prefork deployment also
+writes its merged values to ``<dir>/metrics-<pid>.json`` every
+``metrics.flush_interval`` seconds, and a scrape of any process adds up the
+files of all processes. Counters of exited processes are kept, so totals do
+not go backwards; their gauges are dropped. Empty the directory when
+deploying. ``serve_nwmapi`` refuses to start several workers without it.
+
+``GET /metrics`` requires the ``metrics.token`` in the ``X-Admin-Token``
+header.
+
+Settings::
+
+    metrics.enabled = true
+    metrics.multiprocess_dir = %(here)s/metrics
+    metrics.flush_interval = 5
+    metrics.token =
+"""
+from collections import OrderedDict
+import atexit
+import errno
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from nwmapi import sqlstats
+from nwmapi.common import booleanize
+
+log = logging.getLogger(__name__)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+#: name -> (type, help, histogram buckets)
+METRICS = OrderedDict([
+    ('nwmapi_requests_total', (COUNTER, 'Requests by route template and status.', None)),
+    ('nwmapi_request_duration_seconds', (HISTOGRAM, 'Request latency by route template.', LATENCY_BUCKETS)),
+    ('nwmapi_requests_in_flight', (GAUGE, 'Requests being processed.', None)),
+    ('nwmapi_response_bytes', (HISTOGRAM, 'Size of the response bodies by route template.', SIZE_BUCKETS)),
+    ('nwmapi_db_statements_total', (COUNTER, 'SQL statements executed by route template.', None)),
+    ('nwmapi_db_statement_seconds_total', (COUNTER, 'Seconds spent executing SQL statements by route template.',
+                                           None)),
+    ('nwmapi_db_pool_size', (GAUGE, 'Connections kept in the pool.', None)),
+    ('nwmapi_db_pool_checked_out', (GAUGE, 'Connections in use.', None)),
+    ('nwmapi_db_pool_overflow', (GAUGE, 'Connections opened beyond the pool size.', None)),
+])
+
+
+class _Shard(object):
+    """The values recorded by one thread."""
+
+    def __init__(self):
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [count per bucket..., sum, count]
+        self.histograms = {}
+        self.in_flight = 0
+
+
+_shards = []
+_shards_lock = threading.Lock()
+_local = threading.local()
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = _Shard()
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def inc(name, labels, value=1):
+    counters = _shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, labels, value):
+    histograms = _shard().histograms
+    key = (name, labels)
+    buckets = METRICS[name][2]
+    values = histograms.get(key)
+    if values is None:
+        values = histograms[key] = [0] * (len(buckets) + 2)
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            values[i] += 1
+            break
+    values[-2] += value
+    values[-1] += 1
+
+
+class Metrics(object):
+    """Middleware recording every request, and the merged values for a scrape."""
+
+    def __init__(self, engine=None, multiprocess_dir=None, flush_interval=5):
+        self.engine = engine
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+        self._flusher_pid = None
+
+    def process_request(self, req, resp):
+        if self.multiprocess_dir and self._flusher_pid != os.getpid():
+            # first request of this (possibly forked) process
+            self.start_flushing()
+        _shard().in_flight += 1
+        req.context['metrics.start'] = clock()
+
+    def process_response(self, req, resp, resource):
+        shard = _shard()
+        shard.in_flight -= 1
+        start = req.context.get('metrics.start')
+        if start is None:
+            return
+
+        route = getattr(resource, '__url__', None) or 'unmatched'
+        inc('nwmapi_requests_total', (req.method, route, resp.status.split(' ', 1)[0]))
+        observe('nwmapi_request_duration_seconds', (req.method, route), clock() - start)
+        if resp.body is not None:
+            # JSON is encoded with ensure_ascii, so characters are bytes
+            observe('nwmapi_response_bytes', (req.method, route), len(resp.body))
+        elif resp.data is not None:
+            observe('nwmapi_response_bytes', (req.method, route), len(resp.data))
+        count = sqlstats.query_count()
+        if count:
+            inc('nwmapi_db_statements_total', (route,), count)
+            inc('nwmapi_db_statement_seconds_total', (route,), sqlstats.query_time())
+
+    def snapshot(self):
+        """Merge the values of all the threads of this process."""
+        counters, histograms = {}, {}
+        with _shards_lock:
+            shards = list(_shards)
+        in_flight = 0
+        for shard in shards:
+            in_flight += shard.in_flight
+            for key, value in list(shard.counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, values in list(shard.histograms.items()):
+                merged = histograms.get(key)
+                if merged is None:
+                    histograms[key] = list(values)
+                else:
+                    histograms[key] = [a + b for a, b in zip(merged, values)]
+
+        gauges = {('nwmapi_requests_in_flight', ()): in_flight}
+        pool = getattr(self.engine, 'pool', None)
+        for name, attr in (('nwmapi_db_pool_size', 'size'),
+                           ('nwmapi_db_pool_checked_out', 'checkedout'),
+                           ('nwmapi_db_pool_overflow', 'overflow')):
+            # only QueuePool has these
+            if hasattr(pool, attr):
+                gauges[(name, ())] = getattr(pool, attr)()
+        return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+    def collect(self):
+        """The values to expose: this process, or all processes in multiprocess mode."""
+        snapshot = self.snapshot()
+        if not self.multiprocess_dir:
+            return snapshot
+
+        self.flush(snapshot)
+        merged = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        for path in glob.glob(os.path.join(self.multiprocess_dir, 'metrics-*.json')):
+            try:
+                with open(path) as f:
+                    other = _loads(f.read())
+            except (IOError, OSError, ValueError):
+                continue
+            pid = int(os.path.basename(path)[len('metrics-'):-len('.json')])
+            _merge(merged, other, gauges=_alive(pid))
+        return merged
+
+    def flush(self, snapshot=None):
+        """Write the values of this process to the multiprocess directory."""
+        snapshot = snapshot or self.snapshot()
+        path = os.path.join(self.multiprocess_dir, 'metrics-%d.json' % os.getpid())
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(_dumps(snapshot))
+        os.rename(tmp, path)
+
+    def start_flushing(self):
+        """Start flushing in a background thread, once per process."""
+        with _shards_lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        try:
+            os.makedirs(self.multiprocess_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                try:
+                    self.flush()
+                except Exception as e:
+                    log.exception(e)
+
+        thread = threading.Thread(target=run, name='metrics-flush')
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.flush)
+
+    def render(self):
+        return render(self.collect())
+
+
+def _dumps(snapshot):
+    return json.dumps(dict((kind, [[name, list(labels), value] for (name, labels), value in values.items()])
+                           for kind, values in snapshot.items()))
+
+
+def _loads(data):
+    return dict((kind, dict(((name, tuple(labels)), value) for name, labels, value in values))
+                for kind, values in json.loads(data).items())
+
+
+def _merge(into, snapshot, gauges=True):
+    for key, value in snapshot['counters'].items():
+        into['counters'][key] = into['counters'].get(key, 0) + value
+    for key, values in snapshot['histograms'].items():
+        merged = into['histograms'].get(key)
+        into['histograms'][key] = values if merged is None else [a + b for a, b in zip(merged, values)]
+    if gauges:
+        for key, value in snapshot['gauges'].items():
+            into['gauges'][key] = into['gauges'].get(key, 0) + value
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+LABEL_NAMES = {
+    'nwmapi_requests_total': ('method', 'route', 'status'),
+    'nwmapi_request_duration_seconds': ('method', 'route'),
+    'nwmapi_response_bytes': ('method', 'route'),
+    'nwmapi_db_statements_total': ('route',),
+    'nwmapi_db_statement_seconds_total': ('route',),
+}
+
+
+def _labels(name, values, extra=None):
+    pairs = list(zip(LABEL_NAMES.get(name, ()), values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in pairs)
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render(snapshot):
+    """Format ``snapshot`` in the Prometheus text exposition format."""
+    lines = []
+    for name, (kind, help, buckets) in METRICS.items():
+        if kind == HISTOGRAM:
+            values = snapshot['histograms']
+        elif kind == COUNTER:
+            values = snapshot['counters']
+        else:
+            values = snapshot['gauges']
+        series = sorted((labels, value) for (metric, labels), value in values.items() if metric == name)
+        if not series:
+            continue
+
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for labels, value in series:
+            if kind != HISTOGRAM:
+                lines.append('%s%s %s' % (name, _labels(name, labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(buckets, value):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _labels(name, labels, ('le', _number(bound))), cumulative))
+            lines.append('%s_bucket%s %d' % (name, _labels(name, labels, ('le', '+Inf')), value[-1]))
+            lines.append('%s_sum%s %s' % (name, _labels(name, labels), _number(value[-2])))
+            lines.append('%s_count%s %d' % (name, _labels(name, labels), value[-1]))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+#: the :class:`Metrics` of the application, ``None`` unless ``metrics.enabled``
+registry = None
+
+
+def from_settings(settings, engine):
+    """Return the :class:`Metrics` middleware, or ``None`` if disabled."""
+    global registry
+    if not booleanize(settings.get('metrics.enabled', False)):
+        return None
+    registry = Metrics(engine,
+                       multiprocess_dir=settings.get('metrics.multiprocess_dir') or None,
+                       flush_interval=float(settings.get('metrics.flush_interval', 5)))
+    return registry
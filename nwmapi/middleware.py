@@ -1,79 +1,262 @@
+import codecs
 import logging
 import json
+import numbers
 
 import falcon
 from nwmapi.common import booleanize
 from nwmapi.httpstatus import HTTP400BadRequest, HTTP406NotAcceptable, HTTP415UnsupportedMediaType, \
-    HTTP500InternalServerError
+    HTTP500InternalServerError, HTTP401Unauthorized, HTTP413RequestEntityTooLarge
 from nwmapi.db import DBSession, Base, jsonify
+from nwmapi.search import drop_in_temp_tables
+from nwmapi import sqlstats
+from nwmapi.tokens import InvalidToken
 
 log = logging.getLogger(__name__)
 
+#: Non JSON media types a client may ask for, served by the export resources
+EXPORT_MEDIA_TYPES = ('application/x-ndjson', 'text/csv')
 
-class DBSessionLifeCycle(object):
-    def process_request(self, req, resp):
-        log_debug(req, 'DBSessionLifeCycle: before routing request')
+#: Media types of JSON request bodies, merge patches for PATCH
+JSON_MEDIA_TYPES = ('application/json', 'application/merge-patch+json')
 
-    def process_response(self, req, resp, resource):
-        log_debug(req, 'DBSessionLifeCycle: after processing response')
-        DBSession.close()
+#: Default limit of request bodies in bytes, see ``request.max_body``
+MAX_BODY = 1024 * 1024
 
+#: Bytes read from the request stream at a time
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class RequestPipeline(object):
+    """The per-request work of the application in one middleware component.
+
+    Before routing, in order:
+
+    * sets the CORS headers, so that error responses carry them too
+    * rejects requests not accepting JSON (or an export media type) and
+      POST/PUT/PATCH bodies which are not JSON
+    * verifies the bearer access token, if any: its claims are stored in
+      ``req.context['auth']``, ``None`` for anonymous requests; only the
+      signature, expiry and revocation are checked, in-process: no database
+      is read (see :mod:`nwmapi.tokens`)
+    * reads the common query parameters (``pretty``)
+
+    Once the request is routed, parses the JSON request body into
+    ``req.json_data``. Resources tune this with class attributes:
+
+    * ``__max_body__``: the body size limit in bytes, instead of ``max_body``.
+      Larger bodies are answered with 413, checked against Content-Length
+      first and while reading, so an oversized body is never buffered
+    * ``__raw_body__``: also keep the body bytes in ``req.body``
+    * ``__stream_body__``: leave the body unread; the responder reads it, for
+      example with :func:`iter_json_array`, within ``req.max_body``
+
+    After the response, counts the SQL statements of the request, reports
+    repeated ones (see :mod:`nwmapi.sqlstats`), drops its temporary tables and
+    closes the session.
+    """
+
+    def __init__(self, signer, max_body=MAX_BODY):
+        self.signer = signer
+        self.max_body = max_body
+
+    def process_request(self, req, resp):
+        if log.isEnabledFor(logging.DEBUG):
+            log_debug(req, 'RequestPipeline: before routing request')
+        sqlstats.reset(request=True)
 
-class SetCORSRespHeaders(object):
-    def process_response(self, req, resp, resource):
-        log_debug(req, 'SetCORSRespHeaders: after processing response')
         # http://stackoverflow.com/questions/10636611/how-does-access-control-allow-origin-header-work
         # http://stackoverflow.com/questions/24687313/what-exactly-does-the-access-control-allow-credentials-header-do
         resp.set_header('Access-Control-Allow-Origin', '*')
         resp.set_header('Access-Control-Allow-Credentials', 'true')
 
+        require_json_type(req)
+        self.authenticate(req)
 
-class ReqRequireJSONType(object):
-    def process_request(self, req, resp):
-        log_debug(req, 'RequireJSONType: before routing request')
-        if not req.client_accepts_json:
-            raise HTTP406NotAcceptable('Unsupported response encoding', href='https://url/to/docs')
+        resp.pretty_json = booleanize(req.params.get('pretty', False))
+        # "?pretty" without a value is not in req.params
+        if not resp.pretty_json and 'pretty' not in req.params and 'pretty' in req.query_string:
+            resp.pretty_json = 'pretty' in req.query_string.split('&')
 
-        if req.method in ('POST', 'PUT'):
-            if not req.content_type or 'application/json' not in req.content_type:
-                raise HTTP415UnsupportedMediaType('Unsupported content type', href='https://url/to/docs')
+    def process_resource(self, req, resp, resource):
+        req.max_body = getattr(resource, '__max_body__', self.max_body)
+        if not req.content_length:
+            return
 
+        check_content_length(req)
+        if not getattr(resource, '__stream_body__', False):
+            parse_json_body(req, keep_raw=getattr(resource, '__raw_body__', False))
 
-class ProcessCommonReqParams(object):
-    def process_request(self, req, resp):
-        log_debug(req, 'ParseCommonReqParams: before routing request')
-        resp.pretty_json = booleanize(req.params.get('pretty', False))
-        if 'pretty' not in req.params and 'pretty' in req.query_string.split('&'):
-            resp.pretty_json = True
+    def authenticate(self, req):
+        req.context['auth'] = None
+        credential = req.auth
+        if not credential:
+            return
 
+        scheme, _, token = credential.partition(' ')
+        if scheme.lower() != 'bearer' or not token:
+            raise HTTP401Unauthorized('Invalid credentials',
+                                      'The Authorization header must be "Bearer <access token>".')
+        try:
+            req.context['auth'] = self.signer.verify(token.strip())
+        except InvalidToken as e:
+            raise HTTP401Unauthorized('Invalid access token', str(e))
 
-class ParseJSONReqBody(object):
-    def process_request(self, req, resp):
-        log_debug(req, 'ParseJSONReqBody: before routing request')
-        # req.stream corresponds to the WSGI wsgi.input environ variable,
-        # and allows you to read bytes form the request body
-        #
-        # See also: PEP 3333
-        if req.content_length in (None, 0):
-            # Nothing to do
-            return
+    def process_response(self, req, resp, resource):
+        req.context['query_count'] = sqlstats.query_count()
+        if log.isEnabledFor(logging.DEBUG):
+            log_debug(req, 'RequestPipeline: after processing response, %d SQL statements'
+                      % req.context['query_count'])
+        for statement, count in sqlstats.repeated_statements().items():
+            log.warning('Likely N+1: %s %s ran %d times: %s', req.method, getattr(resource, '__url__', None),
+                        count, statement)
+        sqlstats.end_request()
+        drop_in_temp_tables(DBSession)
+        DBSession.close()
+
+
+def require_json_type(req):
+    if not req.client_accepts_json and not any(req.client_accepts(t) for t in EXPORT_MEDIA_TYPES):
+        raise HTTP406NotAcceptable('Unsupported response encoding', href='https://url/to/docs')
+
+    if req.method in ('POST', 'PUT', 'PATCH'):
+        if not req.content_type or not any(t in req.content_type for t in JSON_MEDIA_TYPES):
+            raise HTTP415UnsupportedMediaType('Unsupported content type', href='https://url/to/docs')
+
+
+def check_content_length(req):
+    if req.content_length > req.max_body:
+        raise_body_too_large(req.max_body)
+
+
+def raise_body_too_large(limit):
+    raise HTTP413RequestEntityTooLarge('Request body is too large',
+                                       'The body must not exceed %d bytes in length.' % limit)
+
+
+def iter_body(req):
+    """Yield the request body in chunks, up to ``req.max_body`` bytes."""
+    # req.stream corresponds to the WSGI wsgi.input environ variable,
+    # and allows you to read bytes form the request body. Reading past
+    # Content-Length may block, so never ask for more.
+    #
+    # See also: PEP 3333
+    remaining = req.content_length or 0
+    read = 0
+    while remaining > 0:
+        chunk = req.stream.read(min(READ_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        read += len(chunk)
+        if read > req.max_body:
+            raise_body_too_large(req.max_body)
+        remaining -= len(chunk)
+        yield chunk
 
-        body = req.stream.read()
-        if not body:
-            raise HTTP400BadRequest(
-                title='Empty request body',
-                description='A valid JSON document is required.')
 
+def parse_json_body(req, keep_raw=False):
+    body = b''.join(iter_body(req))
+    if not body:
+        raise HTTP400BadRequest(
+            title='Empty request body',
+            description='A valid JSON document is required.')
+
+    try:
+        req.json_data = json.loads(body.decode('utf-8'))
+    # except (ValueError, UnicodeDecodeError):
+    except Exception as e:
+        log.exception(e)
+        raise_malformed_json()
+
+    if keep_raw:
+        req.body = body
+
+
+def raise_malformed_json():
+    raise HTTP400BadRequest(
+        title='Malformed JSON',
+        description='Could not decode the request body. '
+                    'The JSON was incorrect or not encoded as UTF-8')
+
+
+def iter_json_array(req):
+    """Yield the items of the JSON array request body as they are read.
+
+    Only the current item and one chunk of the stream are held in memory, so
+    bulk uploads are processed in bounded space. Raises 400 when the body is
+    not a JSON array, including anything but whitespace after it, and 413
+    past ``req.max_body`` bytes.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter_body(req)
+    buf = ''
+    pos = 0
+    started = False
+    items = 0
+    # an item is expected next, rather than "," or "]"
+    expect_item = True
+    closed = False
+    eof = False
+
+    while True:
+        # skip whitespace and the separators between items
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+        if closed:
+            # only whitespace may follow the array
+            if pos < len(buf):
+                raise_malformed_json()
+            if eof:
+                return
+        elif pos < len(buf):
+            if not started:
+                if buf[pos] != '[':
+                    raise_malformed_json()
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']' and (not expect_item or not items):
+                closed = True
+                pos += 1
+                continue
+            if not expect_item:
+                if buf[pos] != ',':
+                    raise_malformed_json()
+                expect_item = True
+                pos += 1
+                continue
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                item, end = None, None
+            # a number is only complete once followed by a delimiter: "12" may be
+            # the start of "12.5" or "1e5" cut by the end of a chunk
+            if end is not None and (eof or not isinstance(item, numbers.Number) or isinstance(item, bool)
+                                    or (end < len(buf) and buf[end] in ',] \t\r\n')):
+                yield item
+                items += 1
+                pos = end
+                expect_item = False
+                continue
+            if eof:
+                raise_malformed_json()
+
+        if eof:
+            raise_malformed_json()
         try:
-            req.body = body
-            req.json_data = json.loads(body)
-        # except (ValueError, UnicodeDecodeError):
-        except Exception as e:
-            log.exception(e)
-            raise HTTP400BadRequest(
-                title='Malformed JSON',
-                description='Could not decode the request body. '
-                            'The JSON was incorrect or not encoded as UTF-8')
+            chunk = next(chunks)
+        except StopIteration:
+            eof = True
+            buf = buf[pos:] + text_decoder.decode(b'', final=True)
+        except UnicodeDecodeError:
+            raise_malformed_json()
+        else:
+            try:
+                buf = buf[pos:] + text_decoder.decode(chunk)
+            except UnicodeDecodeError:
+                raise_malformed_json()
+        pos = 0
 
 
 def log_debug(req, msg):
@@ -87,6 +270,7 @@ class Request(falcon.Request):
         super(Request, self).__init__(env, options)
         self.body = None
         self.json_data = None
+        self.max_body = MAX_BODY
 
 
 class Response(falcon.Response):
@@ -2,9 +2,8 @@ import logging
 from datetime import timedelta
 import uuid
 
-import bcrypt
-from dateutil.tz import tzutc
-from nwmapi.db import GUID, Base, Unicode, UTCDateTime, ordered_uuid1, utcnow
+from nwmapi import passwords
+from nwmapi.db import GUID, UTC, Base, Unicode, UTCDateTime, ordered_uuid1, utcnow
 from sqlalchemy import Column, String, func, ForeignKey, Enum, UnicodeText
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.orm import relationship, synonym
@@ -62,17 +61,17 @@ class User(Base):
              USER_STATUS_UNVERIFIED,
              name="user_status_enum"),
         default=USER_STATUS_UNVERIFIED)
-    # activation = relationship(
-    #     'Activation',
-    #     cascade="all, delete, delete-orphan",
-    #     uselist=False,
-    #     backref='user',
-    #     lazy='joined')
+    # Loaded on access; use include=activation to load it with the users
+    activation = relationship(
+        'Activation',
+        cascade="all, delete, delete-orphan",
+        uselist=False,
+        backref='user')
 
     custom_data = Column(JSON)
     created_by = Column(Unicode(255), default=CREATED_BY_SIGNUP)
-    created_at = Column(UTCDateTime, default=func.now(tz=tzutc()))
-    updated_at = Column(UTCDateTime, server_default=func.now(tz=tzutc()), onupdate=func.current_timestamp())
+    created_at = Column(UTCDateTime, default=func.now(tz=UTC))
+    updated_at = Column(UTCDateTime, server_default=func.now(tz=UTC), onupdate=func.current_timestamp())
 
     # groups = relationship(
     #     Group,
@@ -86,25 +85,14 @@ class User(Base):
         self.status = USER_STATUS_UNVERIFIED
 
     def _set_password(self, password):
-        """Hash password on the fly."""
-        # hashed_password = password
+        """Hash password on the fly.
 
-        pw = password
-        # if isinstance(password, unicode):
-        #     pw = password.encode('UTF-8')
-        # else:
-        #     pw = password
-
-        # Hash a password for the first time, with a randomly-generated salt
-        salt = bcrypt.gensalt(10)
-        hashed_password = bcrypt.hashpw(pw, salt)
-
-        # Make sure the hased password is an UTF-8 object at the end of the
-        # process because SQLAlchemy _wants_ a unicode object for Unicode fields
-        # if not isinstance(hashed_password, unicode):
-        #     hashed_password = hashed_password.decode('UTF-8')
-
-        self._password = hashed_password
+        Hashing runs in the password worker pool and raises
+        ``passwords.PasswordPoolBusy`` when the pool is saturated.
+        """
+        # Hash a password for the first time, with a randomly-generated salt.
+        # The result is a str since SQLAlchemy _wants_ a unicode object for Unicode fields
+        self._password = passwords.hash_password(password)
 
     def _get_password(self):
         """Return the password hashed"""
@@ -147,18 +135,23 @@ class User(Base):
         :type password: unicode object.
         :return: Whether the password is valid.
 
+        A valid password whose hash was made with a lower cost than
+        ``passwords.ROUNDS`` is hashed again; the caller commits the change.
+
         """
         if self.password:
-            salt = self.password[:29]
-            return self.password == bcrypt.hashpw(password, salt)
+            valid = passwords.verify_password(password, self.password)
+            if valid and passwords.needs_rehash(self.password):
+                self.password = password
+            return valid
         else:
             return False
 
-    def to_dict(self, excluded=None, included=None):
+    def to_dict(self, excluded=None, included=None, deep=None):
         excluded = excluded or set()
         excluded = excluded | {'password'}   # always exclude password
         included = included or set()
-        result = super(User, self).to_dict(excluded=excluded, included=included)
+        result = super(User, self).to_dict(excluded=excluded, included=included, deep=deep)
         # if self.status == USER_STATUS_UNVERIFIED:
         #     result['email_verification_token'] = self.activation.code
         return result
@@ -178,31 +171,32 @@ class User(Base):
         return "<User {} {} {} {}>".format(self.username, self.email, self.role, self.status)
 
 
-# class Activation(Base):
-#     """Handle activations/password reset items for users
-#
-#     The id is the user's id. Each user can only have one valid activation in
-#     process at a time
-#
-#     The code should be a random hash that is valid only one time
-#     After that hash is used to access the site it'll be removed
-#
-#     The created by is a system: new user registration, password reset, forgot
-#     password, etc.
-#
-#     """
-#     __tablename__ = u'activation'
-#
-#     user_id = Column(GUID, ForeignKey('user.id'), primary_key=True)
-#     code = Column(Unicode(60))
-#     valid_until = Column(UTCDateTime, default=lambda: utcnow() + ACTIVATION_AGE)
-#     created_by = Column('created_by', Unicode(255))
-#
-#     def __init__(self, created_by=CREATED_BY_SIGNUP):
-#         """Create a new activation"""
-#         self.code = uuid.uuid4().hex
-#         self.created_by = created_by
-#         self.valid_until = utcnow() + ACTIVATION_AGE
+class Activation(Base):
+    """Handle activations/password reset items for users
+
+    The id is the user's id. Each user can only have one valid activation in
+    process at a time
+
+    The code should be a random hash that is valid only one time
+    After that hash is used to access the site it'll be removed
+
+    The created by is a system: new user registration, password reset, forgot
+    password, etc.
+
+    """
+    __tablename__ = u'activation'
+
+    user_id = Column(GUID, ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    code = Column(Unicode(60))
+    # indexed for sweeping expired activations, see userservice.sweep_non_activated_accounts()
+    valid_until = Column(UTCDateTime, default=lambda: utcnow() + ACTIVATION_AGE, index=True)
+    created_by = Column('created_by', Unicode(255))
+
+    def __init__(self, created_by=CREATED_BY_SIGNUP):
+        """Create a new activation"""
+        self.code = uuid.uuid4().hex
+        self.created_by = created_by
+        self.valid_until = utcnow() + ACTIVATION_AGE
 
 # class Group(Base):
 #     __tablename__ = 'group'
@@ -0,0 +1,245 @@
+"""Registry of named, parameterized searches.
+
+A named query is a search in the format of ``q`` (see ``docs/searchformat.rst``)
+whose values may be placeholders written as ``":<param>"``::
+
+    {"filters": [{"name": "role", "op": "eq", "val": "ADMIN"},
+                 {"name": "created_at", "op": "gt", "val": ":since"}]}
+
+It is validated and built into a SQL statement with bind parameters once, when
+it is registered, and runs as ``GET /users?query=active_admins&since=...``.
+Per request only the parameter values are bound; the compiled form of the
+statement is cached as well. Use ``"::"`` to start a literal value with ``:``.
+
+Named queries come from ``namedquery.<table>.<name> = <json>`` settings. The
+registry is kept in memory by each process, so registration is config-only:
+a query defined at runtime would only exist in the prefork worker which
+answered the request. ``POST /queries`` is refused unless ``allow_post`` is
+set, for a single process server, and then only defines new names for
+admins, up to ``max_queries`` queries in all.
+
+Settings::
+
+    namedqueries.allow_post = false
+    namedqueries.max_queries = 100
+"""
+from collections import OrderedDict
+import copy
+import json
+import logging
+import threading
+import uuid
+
+from sqlalchemy import bindparam, Integer, DateTime
+from sqlalchemy.orm import sessionmaker
+
+from nwmapi.common import booleanize
+from nwmapi.db import DBSession, GUID, UTCDateTime, parse_datetime
+from nwmapi.search import create_query
+
+log = logging.getLogger(__name__)
+
+SETTINGS_PREFIX = 'namedquery.'
+
+#: Value bound to ``LIMIT`` when the request and the definition have none.
+ALL_ROWS = 2 ** 31 - 1
+
+#: Whether ``POST /queries`` may define queries, see the module documentation
+ALLOW_POST = False
+
+#: Queries :func:`define` allows in the registry
+MAX_QUERIES = 100
+
+_registry = OrderedDict()
+_lock = threading.Lock()
+
+# Named queries are built without touching the database.
+_UnboundSession = sessionmaker()
+
+
+class MissingQueryParam(ValueError):
+    """A parameter of a named query was not supplied."""
+
+    def __init__(self, param_name):
+        super(MissingQueryParam, self).__init__('Missing query parameter %r' % param_name)
+        self.param_name = param_name
+
+
+class InvalidQueryParam(ValueError):
+    """A parameter of a named query has a value invalid for its column."""
+
+    def __init__(self, param_name):
+        super(InvalidQueryParam, self).__init__('Invalid query parameter %r' % param_name)
+        self.param_name = param_name
+
+
+class QueryExists(ValueError):
+    """A query of the same name is already registered."""
+
+
+class TooManyQueries(ValueError):
+    """The registry holds :data:`MAX_QUERIES` queries."""
+
+
+def configure(allow_post=None, max_queries=None):
+    global ALLOW_POST, MAX_QUERIES
+    if allow_post is not None:
+        ALLOW_POST = booleanize(allow_post)
+    if max_queries is not None:
+        MAX_QUERIES = int(max_queries)
+
+
+def _converter(column):
+    """Return the function converting a parameter string to a value of ``column``, ``None`` if kept."""
+    if isinstance(column.type, (DateTime, UTCDateTime)):
+        return parse_datetime
+    if isinstance(column.type, GUID):
+        return uuid.UUID
+    return None
+
+
+class NamedQuery(object):
+    """A search on ``model`` built once into a statement with bind parameters."""
+
+    def __init__(self, name, model, searchparams):
+        if isinstance(searchparams, str):
+            searchparams = json.loads(searchparams)
+        if not isinstance(searchparams, dict):
+            raise ValueError('Invalid query %r: a JSON object is required' % name)
+        self.name = name
+        self.model = model
+        self.searchparams = searchparams
+        self.params = []
+        # parameter name: function converting its string value
+        self._converters = {}
+        self.statement = self._compile()
+        self._compiled_cache = {}
+
+    def _compile(self):
+        searchparams = copy.deepcopy(self.searchparams)
+        for filt in searchparams.get('filters', []):
+            self._bind_placeholders(filt)
+
+        try:
+            q = create_query(_UnboundSession(), self.model, searchparams)
+        except (AttributeError, KeyError, TypeError) as e:
+            raise ValueError('Invalid query %r: %s' % (self.name, e))
+
+        self.limit = searchparams.get('limit') or ALL_ROWS
+        self.offset = searchparams.get('offset') or 0
+        return q.statement \
+            .limit(bindparam('limit', type_=Integer)) \
+            .offset(bindparam('offset', type_=Integer))
+
+    def _bind_placeholders(self, node):
+        if isinstance(node, list):
+            for item in node:
+                self._bind_placeholders(item)
+            return
+        if not isinstance(node, dict):
+            return
+
+        val = node.get('val')
+        if isinstance(val, str) and val.startswith('::'):
+            node['val'] = val[1:]
+        elif isinstance(val, str) and len(val) > 1 and val.startswith(':'):
+            if node.get('op') in ('in', 'not_in'):
+                raise ValueError('Placeholders are not supported with the %r operator' % node['op'])
+            param = val[1:]
+            if param in ('limit', 'offset'):
+                raise ValueError('%r is a reserved parameter name' % param)
+            if param not in self.params:
+                self.params.append(param)
+            column = self.model.__table__.columns.get(node.get('name'))
+            if column is not None and _converter(column) is not None:
+                self._converters[param] = _converter(column)
+            node['val'] = bindparam(param)
+        else:
+            for value in node.values():
+                self._bind_placeholders(value)
+
+    def bind(self, values, limit=None, offset=None):
+        """Return the bind parameter values taken from ``values`` (e.g. ``req.params``)."""
+        params = {}
+        for name in self.params:
+            if name not in values:
+                raise MissingQueryParam(name)
+            value = values[name]
+            convert = self._converters.get(name)
+            if convert is not None:
+                try:
+                    value = convert(value)
+                except (ValueError, TypeError, OverflowError, AttributeError):
+                    raise InvalidQueryParam(name)
+            params[name] = value
+        params['limit'] = int(limit) if limit else self.limit
+        params['offset'] = int(offset) if offset else self.offset
+        return params
+
+    def execute(self, values, limit=None, offset=None):
+        """Run the query with the parameters in ``values`` and return the model instances."""
+        params = self.bind(values, limit=limit, offset=offset)
+        connection = DBSession.connection().execution_options(compiled_cache=self._compiled_cache)
+        result = connection.execute(self.statement, params)
+        return list(DBSession.query(self.model).instances(result))
+
+    def to_dict(self):
+        result = OrderedDict()
+        result['name'] = self.name
+        result['model'] = self.model.__tablename__
+        result['params'] = self.params
+        result['q'] = self.searchparams
+        return result
+
+
+def register(name, model, searchparams):
+    """Build and register a named query, replacing any query of the same name on ``model``.
+
+    Raises ``ValueError`` if the search is not valid for ``model``.
+    """
+    query = NamedQuery(name, model, searchparams)
+    with _lock:
+        _registry[(model.__tablename__, name)] = query
+    return query
+
+
+def define(name, model, searchparams):
+    """Build and register a new named query, as :func:`register`.
+
+    Raises :exc:`QueryExists` if ``model`` already has a query ``name``, and
+    :exc:`TooManyQueries` if the registry is full.
+    """
+    query = NamedQuery(name, model, searchparams)
+    key = (model.__tablename__, name)
+    with _lock:
+        if key in _registry:
+            raise QueryExists('A query %r is already defined' % name)
+        if len(_registry) >= MAX_QUERIES:
+            raise TooManyQueries('No more than %d named queries can be defined' % MAX_QUERIES)
+        _registry[key] = query
+    return query
+
+
+def get(model, name):
+    """Return the named query of ``model``, or ``None``."""
+    return _registry.get((model.__tablename__, name))
+
+
+def all_queries():
+    return list(_registry.values())
+
+
+def load_from_settings(settings, models):
+    """Register the ``namedquery.<table>.<name>`` entries of ``settings``.
+
+    ``models`` is a list of the model classes queries may refer to.
+    """
+    models = dict((model.__tablename__, model) for model in models)
+    for key, value in settings.items():
+        if not key.startswith(SETTINGS_PREFIX):
+            continue
+        tablename, name = key[len(SETTINGS_PREFIX):].split('.', 1)
+        if tablename not in models:
+            raise ValueError('%s: unknown table %r' % (key, tablename))
+        register(name, models[tablename], value)
+        log.info('Registered named query %s', key)
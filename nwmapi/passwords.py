@@ -0,0 +1,127 @@
+"""bcrypt hashing and verification in a bounded worker pool.
+
+Hashing is CPU bound and takes tens of milliseconds at the default cost. It
+runs in a dedicated pool of :data:`WORKERS` threads (or processes) instead of
+on every request thread at once, and at most :data:`QUEUE_DEPTH` more calls
+may wait for a worker. Beyond that :exc:`PasswordPoolBusy` is raised right
+away, so a burst of signups or logins is shed instead of tying up every
+server thread while cheap requests wait. A call still waiting for its result
+after :data:`TIMEOUT` seconds is cancelled, if not started yet, and raises
+:exc:`PasswordPoolBusy` as well.
+
+Hashes are created with :data:`ROUNDS`; :func:`needs_rehash` tells whether a
+stored hash was made with a lower cost and should be replaced.
+"""
+import hmac
+import logging
+import threading
+from concurrent import futures
+
+log = logging.getLogger(__name__)
+
+#: bcrypt cost factor of new hashes
+ROUNDS = 10
+
+#: number of hashing workers
+WORKERS = 2
+
+#: number of calls which may wait for a worker before PasswordPoolBusy is raised
+QUEUE_DEPTH = 8
+
+#: seconds a caller waits for its result
+TIMEOUT = 10
+
+_executor = None
+_slots = threading.BoundedSemaphore(WORKERS + QUEUE_DEPTH)
+_lock = threading.Lock()
+_use_processes = False
+
+
+class PasswordPoolBusy(Exception):
+    """Too many password hashing calls are running or queued, or a call timed out."""
+
+
+def configure(rounds=None, workers=None, queue_depth=None, processes=False):
+    """Set the cost factor and the pool size. Takes effect on the next call."""
+    global ROUNDS, WORKERS, QUEUE_DEPTH, _slots, _use_processes, _executor
+    with _lock:
+        if rounds is not None:
+            ROUNDS = int(rounds)
+        if workers is not None:
+            WORKERS = int(workers)
+        if queue_depth is not None:
+            QUEUE_DEPTH = int(queue_depth)
+        _use_processes = processes
+        _slots = threading.BoundedSemaphore(WORKERS + QUEUE_DEPTH)
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def _get_executor():
+    # Created on first use, so that a process pool is started after the
+    # server has forked its workers.
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                if _use_processes:
+                    _executor = futures.ProcessPoolExecutor(max_workers=WORKERS)
+                else:
+                    _executor = futures.ThreadPoolExecutor(max_workers=WORKERS)
+    return _executor
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _hash(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(_to_bytes(password), bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(password, hashed):
+    import bcrypt
+    hashed = _to_bytes(hashed)
+    return hmac.compare_digest(bcrypt.hashpw(_to_bytes(password), hashed), hashed)
+
+
+def _run(fn, *args):
+    slots = _slots
+    if not slots.acquire(False):
+        raise PasswordPoolBusy()
+    try:
+        future = _get_executor().submit(fn, *args)
+    except Exception:
+        slots.release()
+        raise
+    future.add_done_callback(lambda f: slots.release())
+    try:
+        return future.result(timeout=TIMEOUT)
+    except futures.TimeoutError:
+        # frees the slot of a call still queued; a running one frees it when done
+        future.cancel()
+        log.warning('Password hashing call timed out after %ss', TIMEOUT)
+        raise PasswordPoolBusy()
+
+
+def hash_password(password):
+    """Return the bcrypt hash of ``password`` as a string."""
+    return _run(_hash, password, ROUNDS)
+
+
+def verify_password(password, hashed):
+    """Return whether ``password`` matches the bcrypt hash ``hashed``."""
+    return _run(_check, password, hashed)
+
+
+def needs_rehash(hashed):
+    """Return whether ``hashed`` was made with a lower cost than :data:`ROUNDS`."""
+    # $2b$10$<salt and hash>
+    try:
+        return int(hashed.split('$')[2]) < ROUNDS
+    except (IndexError, ValueError):
+        return True
@@ -0,0 +1,312 @@
+"""Preforking server: the app is loaded once and served by forked workers.
+
+A single waitress process runs Python code on one core at a time. The
+master process of :class:`Arbiter` binds the listening socket, loads the app
+and forks ``workers`` processes serving that socket with waitress threads.
+Since the app is loaded before forking, with the garbage collector frozen
+(Python 3.7+), the workers share the pages of the loaded modules
+copy-on-write instead of each importing its own copy.
+
+The master restarts the workers which exit. Signals to the master:
+
+* ``TERM``, ``INT``: stop the workers gracefully, then exit
+* ``HUP``: replace the workers one at a time, each old one finishing its
+  requests while its replacement already accepts connections. The app is not
+  loaded again: deploying code or settings means restarting the master.
+
+A worker stopping gracefully stops accepting connections and exits once its
+requests are answered, or after ``graceful_timeout`` seconds.
+
+Threads do not survive ``fork()``. Modules starting background threads when
+the app is loaded go through :func:`start`, which defers the call to every
+worker while the master loads the app. The pools of the engines registered
+with :func:`register_engine` are emptied before forking, so that no
+connection opened while loading is shared by the workers.
+
+Run it with ``serve_nwmapi production.ini``, see :mod:`nwmapi.scripts.serve`.
+"""
+import errno
+import fcntl
+import gc
+import logging
+import os
+import select
+import signal
+import socket
+import threading
+import time
+
+try:
+    import _thread as thread
+except ImportError:
+    import thread
+
+log = logging.getLogger(__name__)
+
+_loading = False
+_deferred = []
+_engines = []
+
+
+def start(func):
+    """Call ``func()``, which starts background threads, in the processes serving requests.
+
+    While a preforking master loads the app the call is deferred to every
+    worker, after the fork; otherwise ``func`` runs now.
+    """
+    if _loading:
+        _deferred.append(func)
+    else:
+        func()
+
+
+def register_engine(engine):
+    """Empty the connection pool of ``engine`` before forking workers."""
+    _engines.append(engine)
+
+
+def load(loader):
+    """Return the app built by ``loader()``, deferring the background threads it starts."""
+    global _loading
+    # no collection while loading, so that the objects of the app are frozen
+    # together before forking; the master enables it again
+    if hasattr(gc, 'freeze'):
+        gc.disable()
+    _loading = True
+    try:
+        return loader()
+    finally:
+        _loading = False
+
+
+def bind(host, port, backlog=1024):
+    """Return a listening socket bound to ``host`` and ``port``."""
+    family, socktype, proto, _, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def _server(app, sock, options):
+    """A waitress server accepting on ``sock``, which the master has bound."""
+    from waitress.server import TcpWSGIServer
+
+    class PreboundServer(TcpWSGIServer):
+        def bind_server_socket(self):
+            pass
+
+    return PreboundServer(app, _sock=sock, **options)
+
+
+class Arbiter(object):
+    """The master process, forking and supervising the workers."""
+
+    #: a worker exiting sooner after its start is restarted after a delay
+    MIN_UPTIME = 1.0
+    MAX_RESPAWN_DELAY = 30.0
+
+    def __init__(self, app, sock, workers=2, options=None, graceful_timeout=30):
+        self.app = app
+        self.sock = sock
+        self.size = workers
+        self.options = options or {}
+        self.graceful_timeout = graceful_timeout
+        # pid -> [started at, stopping]
+        self.workers = {}
+        self._retiring = []
+        self._signals = []
+        self._stopping_at = None
+        self._respawn_delay = 0.0
+        self._respawn_at = 0.0
+
+    def run(self):
+        self._setup_signals()
+        gc.enable()
+        log.info('Master %d serving %s with %d workers', os.getpid(), self.sock.getsockname(), self.size)
+        try:
+            while True:
+                self._reap()
+                for signum in self._pop_signals():
+                    self._handle(signum)
+                if self._stopping_at is not None:
+                    if not self.workers:
+                        break
+                    if time.time() > self._stopping_at + self.graceful_timeout + 5:
+                        self._kill_all(signal.SIGKILL)
+                else:
+                    self._retire_one()
+                    self._spawn_missing()
+                self._wait(1.0)
+        finally:
+            self._kill_all(signal.SIGKILL)
+        log.info('Master %d stopped', os.getpid())
+
+    def _setup_signals(self):
+        self._pipe = os.pipe()
+        for fd in self._pipe:
+            _set_non_blocking(fd)
+        signal.set_wakeup_fd(self._pipe[1])
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, self._on_signal)
+
+    def _on_signal(self, signum, frame):
+        self._signals.append(signum)
+
+    def _pop_signals(self):
+        signals = self._signals[:]
+        del self._signals[:len(signals)]
+        return signals
+
+    def _wait(self, timeout):
+        try:
+            ready = select.select([self._pipe[0]], [], [], timeout)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return
+        if ready:
+            try:
+                while os.read(self._pipe[0], 64):
+                    pass
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def _handle(self, signum):
+        if signum in (signal.SIGTERM, signal.SIGINT) and self._stopping_at is None:
+            log.info('Master %d stopping', os.getpid())
+            self._stopping_at = time.time()
+            self._kill_all(signal.SIGTERM)
+        elif signum == signal.SIGHUP and self._stopping_at is None:
+            log.info('Master %d replacing its workers', os.getpid())
+            self._retiring = list(self.workers)
+
+    def _retire_one(self):
+        # one at a time, once the previous one has exited
+        if not self._retiring or any(stopping for _, stopping in self.workers.values()):
+            return
+        pid = self._retiring.pop(0)
+        if pid in self.workers:
+            self._kill(pid, signal.SIGTERM)
+
+    def _spawn_missing(self):
+        running = sum(1 for _, stopping in self.workers.values() if not stopping)
+        if running < self.size and time.time() >= self._respawn_at:
+            for i in range(self.size - running):
+                self._spawn()
+
+    def _spawn(self):
+        for engine in _engines:
+            engine.dispose()
+        if hasattr(gc, 'freeze'):
+            # out of the collections of the worker, which would unshare them
+            gc.freeze()
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = [time.time(), False]
+            return pid
+
+        code = 1
+        try:
+            self._run_worker()
+            code = 0
+        except SystemExit as e:
+            code = e.code or 0
+        except BaseException:
+            log.exception('Worker %d failed', os.getpid())
+        finally:
+            _run_exit_functions()
+            os._exit(code)
+
+    def _run_worker(self):
+        signal.set_wakeup_fd(-1)
+        for fd in self._pipe:
+            os.close(fd)
+        for signum in (signal.SIGHUP, signal.SIGCHLD):
+            signal.signal(signum, signal.SIG_DFL)
+        # the master stops the workers on ctrl-c
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        for func in _deferred:
+            func()
+
+        server = _server(self.app, self.sock, self.options)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop_worker(server))
+        log.info('Worker %d started', os.getpid())
+        server.run()
+        log.info('Worker %d stopped', os.getpid())
+
+    def _stop_worker(self, server):
+        server.accepting = False
+        # interrupt_main() simulates a SIGINT on Python 3.10+
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        deadline = time.time() + self.graceful_timeout
+
+        def wait():
+            while time.time() < deadline:
+                try:
+                    channels = list(server.active_channels.values())
+                except RuntimeError:
+                    # changed size during iteration
+                    continue
+                if not channels:
+                    break
+                for channel in channels:
+                    if not channel.requests:
+                        channel.will_close = True
+                server.pull_trigger()
+                time.sleep(0.1)
+            # ends server.run() in the main thread
+            thread.interrupt_main()
+
+        waiter = threading.Thread(target=wait, name='graceful-stop')
+        waiter.daemon = True
+        waiter.start()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            started, stopping = self.workers.pop(pid, (None, True))
+            if stopping or started is None:
+                continue
+
+            log.warning('Worker %d exited with status %d', pid, status)
+            if time.time() - started < self.MIN_UPTIME:
+                self._respawn_delay = min(max(self._respawn_delay * 2, 0.5), self.MAX_RESPAWN_DELAY)
+                self._respawn_at = time.time() + self._respawn_delay
+            else:
+                self._respawn_delay = 0.0
+
+    def _kill(self, pid, signum):
+        if signum != signal.SIGKILL:
+            self.workers[pid][1] = True
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _kill_all(self, signum):
+        for pid in list(self.workers):
+            self._kill(pid, signum)
+
+
+def _set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def _run_exit_functions():
+    import atexit
+    run = getattr(atexit, '_run_exitfuncs', None)
+    if run is not None:
+        run()
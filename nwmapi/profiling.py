@@ -0,0 +1,159 @@
+"""Profiling of single requests with cProfile.
+
+A request is profiled when it carries ``X-Profile: <profiling.token>``, or
+when it is one of every ``profiling.sample_every`` requests. The profiler runs
+from the routing of the request to its response, so it covers the hooks and
+the responder.
+
+* A request profiled on demand gets the statistics, sorted by cumulative
+  time, as its response body instead of its result.
+* With ``profiling.directory``, every profile is also dumped there as
+  ``<time>-<method>-<route>-<query shape>.prof`` for ``pstats`` or snakeviz,
+  keeping the latest ``profiling.keep`` dumps. Sampled requests are only
+  dumped, their response is untouched.
+
+The component is only installed when a token or a sample rate is set, and it
+only checks a header and a counter on requests it does not profile.
+
+Settings::
+
+    profiling.token =
+    profiling.sample_every = 0
+    profiling.directory = %(here)s/profiles
+    profiling.keep = 50
+"""
+import cProfile
+import hmac
+import itertools
+import logging
+import os
+import pstats
+import re
+import threading
+import time
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+log = logging.getLogger(__name__)
+
+HEADER = 'X-Profile'
+
+#: lines of statistics in an inline response
+STATS_LIMIT = 60
+
+
+def query_shape(req):
+    """Describe the query of ``req`` by its parameter names and search filters, without values."""
+    from nwmapi.db import parse_filters
+
+    parts = []
+    for name in sorted(req.params):
+        if name != 'q':
+            parts.append(name)
+            continue
+        try:
+            filters = parse_filters(req.params['q']).get('filters', [])
+        except (ValueError, AttributeError):
+            filters = []
+        parts.append('q[%s]' % ','.join(_filter_shapes(filters)))
+    return '&'.join(parts)
+
+
+def _filter_shapes(filters):
+    for filt in filters:
+        if not isinstance(filt, dict):
+            continue
+        if 'name' in filt:
+            yield '%s:%s' % (filt['name'], filt.get('op'))
+        for key in ('or', 'and'):
+            for shape in _filter_shapes(filt.get(key) or []):
+                yield shape
+
+
+def _slug(value, length=60):
+    return re.sub(r'[^A-Za-z0-9_.:\[\],-]+', '_', value).strip('_')[:length] or '_'
+
+
+class Profiler(object):
+    """Middleware profiling requests on demand or by sampling."""
+
+    def __init__(self, token=None, sample_every=0, directory=None, keep=50):
+        self.token = token
+        self.sample_every = sample_every
+        self.directory = directory
+        self.keep = keep
+        self._counter = itertools.count(1)
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def _requested(self, req):
+        if not self.token:
+            return False
+        value = req.get_header(HEADER)
+        return value is not None and hmac.compare_digest(value.encode('utf-8'), self.token.encode('utf-8'))
+
+    def process_resource(self, req, resp, resource):
+        requested = self._requested(req)
+        sampled = (not requested and self.sample_every and self.directory
+                   and next(self._counter) % self.sample_every == 0)
+        if not (requested or sampled):
+            return
+
+        req.context['profiling.inline'] = requested
+        profile = req.context['profiling.profile'] = cProfile.Profile()
+        profile.enable()
+
+    def process_response(self, req, resp, resource):
+        profile = req.context.get('profiling.profile')
+        if profile is None:
+            return
+        profile.disable()
+
+        route = getattr(resource, '__url__', None) or 'unmatched'
+        shape = query_shape(req)
+        if self.directory:
+            try:
+                path = self.dump(profile, req.method, route, shape)
+                resp.set_header('X-Profile-Dump', os.path.basename(path))
+            except (IOError, OSError) as e:
+                log.exception(e)
+
+        if req.context.get('profiling.inline'):
+            stream = StringIO()
+            stream.write('%s %s %s\n\n' % (req.method, route, shape))
+            pstats.Stats(profile, stream=stream).sort_stats('cumulative').print_stats(STATS_LIMIT)
+            resp.content_type = 'text/plain; charset=utf-8'
+            resp.body = stream.getvalue()
+
+    def dump(self, profile, method, route, shape):
+        """Write ``profile`` to the directory, dropping the oldest dumps over ``keep``."""
+        name = '%s.%06d-%s-%s-%s.prof' % (time.strftime('%Y%m%dT%H%M%S'), next(self._sequence) % 1000000,
+                                          method, _slug(route), _slug(shape))
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path)
+
+        with self._lock:
+            dumps = sorted((os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                            if f.endswith('.prof')), key=os.path.getmtime)
+            for old in dumps[:-self.keep]:
+                os.remove(old)
+        return path
+
+
+def from_settings(settings):
+    """Return the :class:`Profiler` middleware, or ``None`` if neither a token nor a sample rate is set."""
+    token = settings.get('profiling.token') or None
+    sample_every = int(settings.get('profiling.sample_every', 0))
+    if not token and not sample_every:
+        return None
+
+    directory = settings.get('profiling.directory') or None
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if sample_every and not directory:
+        log.warning('profiling.sample_every needs profiling.directory, sampling is disabled')
+    return Profiler(token=token, sample_every=sample_every, directory=directory,
+                    keep=int(settings.get('profiling.keep', 50)))
@@ -0,0 +1,184 @@
+"""Token bucket rate limiting per client and route.
+
+Every client (the subject of its verified access token when present,
+otherwise the remote address) has one bucket per route template. A bucket holds up to ``burst``
+tokens and refills at ``rate`` tokens per second; each request takes a token,
+and a request finding the bucket empty is answered with ``429 Too Many
+Requests`` and a ``Retry-After`` header.
+
+Buckets live in a :class:`MemoryStore` for a single process, or in a
+:class:`SQLiteStore` file shared by all the workers of a host. With the
+memory store and several prefork workers, a client may get up to one budget
+per worker; the SQLite store enforces one budget per host at the cost of a
+(short) write to the file for each request.
+
+Settings::
+
+    ratelimit.enabled = true
+    # <requests>/<seconds>, for every route without its own budget
+    ratelimit.default = 20/1
+    ratelimit.route./users = 100/60
+    ratelimit.store = memory | sqlite
+    ratelimit.sqlite_path = %(here)s/ratelimit.sqlite
+    # use the first X-Forwarded-For address, behind a trusted proxy only
+    ratelimit.trust_forwarded = false
+"""
+import logging
+import math
+import sqlite3
+import threading
+import time
+
+from nwmapi.common import booleanize
+from nwmapi.httpstatus import HTTP429TooManyRequests
+
+log = logging.getLogger(__name__)
+
+ROUTE_SETTINGS_PREFIX = 'ratelimit.route.'
+
+
+class MemoryStore(object):
+    """Buckets of the current process.
+
+    Once more than ``max_keys`` buckets exist they are all dropped, which only
+    resets clients to a full bucket.
+    """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token from the bucket ``key``.
+
+        Returns 0 if a token was available, otherwise the number of seconds
+        until one will be.
+        """
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.clear()
+                self._buckets[key] = [burst - 1.0, now]
+                return 0
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+        return (1 - tokens) / rate
+
+
+class SQLiteStore(object):
+    """Buckets in a SQLite file, shared by the processes using the same ``path``.
+
+    Taking a token is one UPDATE, so the write lock of the file is held for a
+    single statement, and a request finding its bucket empty only reads it.
+    Buckets idle for ``expire`` seconds are full again and are deleted, at
+    most every ``purge_interval`` seconds by each process.
+    """
+
+    def __init__(self, path, timeout=1.0, expire=3600.0, purge_interval=60.0):
+        self.path = path
+        self.timeout = timeout
+        self.expire = expire
+        self.purge_interval = purge_interval
+        self._purged = time.time()
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket '
+                         '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst):
+        conn = self._connection()
+        now = time.time()
+        if now - self._purged > self.purge_interval:
+            self._purged = now
+            conn.execute('DELETE FROM bucket WHERE updated < ?', (now - self.expire,))
+
+        # each statement is a transaction of its own (isolation_level=None)
+        refilled = 'MIN(:burst, tokens + (:now - updated) * :rate)'
+        if conn.execute('UPDATE bucket SET tokens = %s - 1, updated = :now WHERE key = :key AND %s >= 1'
+                        % (refilled, refilled), {'burst': burst, 'now': now, 'rate': rate, 'key': key}).rowcount:
+            return 0
+        row = conn.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            if conn.execute('INSERT OR IGNORE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)',
+                            (key, burst - 1.0, now)).rowcount:
+                return 0
+            # another process created the bucket meanwhile
+            return self.take(key, rate, burst)
+        tokens = min(burst, row[0] + (now - row[1]) * rate)
+        return max(1 - tokens, 0) / rate
+
+
+def parse_budget(value):
+    """Parse ``<requests>/<seconds>`` into a ``(rate, burst)`` tuple."""
+    requests, seconds = value.split('/')
+    requests = float(requests)
+    return requests / float(seconds), requests
+
+
+class RateLimiter(object):
+    """Middleware taking a token for each request before its responder runs."""
+
+    def __init__(self, store, default=(20.0, 20.0), routes=None, trust_forwarded=False):
+        self.store = store
+        self.default = default
+        self.routes = routes or {}
+        self.trust_forwarded = trust_forwarded
+
+    def client_key(self, req):
+        # the verified claims of RequestPipeline.process_request: a client
+        # can not get a new bucket by sending arbitrary Authorization headers
+        claims = req.context.get('auth')
+        if claims:
+            return 'sub:%s' % claims['sub']
+        if self.trust_forwarded:
+            forwarded = req.get_header('X-Forwarded-For')
+            if forwarded:
+                return forwarded.split(',', 1)[0].strip()
+        return req.env.get('REMOTE_ADDR', '')
+
+    def process_resource(self, req, resp, resource):
+        route = getattr(resource, '__url__', None)
+        rate, burst = self.routes.get(route, self.default)
+        wait = self.store.take('%s %s' % (route, self.client_key(req)), rate, burst)
+        if wait:
+            raise HTTP429TooManyRequests('Rate limit exceeded',
+                                         'Too many requests. Please wait before trying again.',
+                                         retry_after=int(math.ceil(wait)))
+
+
+def from_settings(settings):
+    """Return a :class:`RateLimiter` configured from ``settings``, or ``None`` if disabled."""
+    if not booleanize(settings.get('ratelimit.enabled', False)):
+        return None
+
+    default = parse_budget(settings.get('ratelimit.default', '20/1'))
+    routes = dict((key[len(ROUTE_SETTINGS_PREFIX):], parse_budget(value))
+                  for key, value in settings.items() if key.startswith(ROUTE_SETTINGS_PREFIX))
+
+    if settings.get('ratelimit.store', 'memory') == 'sqlite':
+        # the longest time an empty bucket takes to fill up
+        expire = max(burst / rate for rate, burst in [default] + list(routes.values()))
+        store = SQLiteStore(settings['ratelimit.sqlite_path'], expire=expire)
+    else:
+        store = MemoryStore()
+
+    return RateLimiter(store,
+                       default=default,
+                       routes=routes,
+                       trust_forwarded=booleanize(settings.get('ratelimit.trust_forwarded', False)))
@@ -1,4 +1,8 @@
+import hashlib
 import logging
+
+import falcon
+from nwmapi.db import jsonify
 from nwmapi.httpstatus import HTTP501NotImplemented
 
 log = logging.getLogger(__name__)
@@ -15,30 +19,84 @@ HTTP_METHODS = (
     'TRACE',
 )
 
+#: Request headers allowed in cross-origin requests
+CORS_ALLOW_HEADERS = 'Accept, Authorization, Content-Type, If-None-Match'
+
+#: Seconds browsers may cache the answer to a CORS preflight
+PREFLIGHT_MAX_AGE = 86400
+
+
 class BaseHandler(object):
     #: The relative URL this resource should live at.
     __url__ = None
 
+    @classmethod
+    def options_headers(cls):
+        """Return the headers answering ``OPTIONS``, computed once per resource class."""
+        headers = cls.__dict__.get('_options_headers')
+        if headers is None:
+            # Usually expect a method, but any callable will do
+            allowed = ', '.join(method for method in HTTP_METHODS
+                                if callable(getattr(cls, 'on_' + method.lower(), None)))
+            headers = [('Allow', allowed),
+                       ('Access-Control-Allow-Methods', allowed),
+                       ('Access-Control-Allow-Headers', CORS_ALLOW_HEADERS),
+                       ('Access-Control-Max-Age', str(PREFLIGHT_MAX_AGE))]
+            cls._options_headers = headers
+        return headers
+
     def on_options(self, req, resp, **kwargs):
-        allowed_methods = []
-
-        for method in HTTP_METHODS:
-            try:
-                responder = getattr(self, 'on_' + method.lower())
-            except AttributeError:
-                # resource does not implement this method
-                pass
-            else:
-                # Usually expect a method, but any callable will do
-                if callable(responder):
-                    allowed_methods.append(method)
-
-        allowed = ', '.join(allowed_methods)
-
-        resp.set_header('Allow', allowed)
+        for name, value in self.options_headers():
+            resp.set_header(name, value)
         resp.http204nocontent()
 
 
+class StaticResource(BaseHandler):
+    """A resource whose ``GET`` result only changes on deploy.
+
+    Subclasses implement :meth:`render`. Its result is encoded once, compact
+    and pretty, when the resource is created, and served with a strong ``ETag``, ``Cache-Control:
+    max-age=__max_age__`` and ``304 Not Modified`` to a matching
+    ``If-None-Match``.
+    """
+    #: Seconds clients may use the response without revalidating it
+    __max_age__ = 86400
+
+    def __init__(self):
+        # rendered when the routes are added, before any request
+        result = self.render()
+        self._responses = {}
+        for pretty, kwargs in ((False, {}), (True, {'indent': 4, 'separators': (',', ': ')})):
+            body = jsonify(result, **kwargs).encode('utf-8')
+            self._responses[pretty] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+
+    def render(self):
+        """Return the result to serve, encoded by ``jsonify``."""
+        raise NotImplementedError
+
+    def on_get(self, req, resp):
+        body, etag = self._responses[bool(resp.pretty_json)]
+        resp.etag = etag
+        resp.cache_control = ['public', 'max-age=%d' % self.__max_age__]
+        resp.content_type = 'application/json; charset=utf-8'
+        if etag_matches(req.if_none_match, etag):
+            resp.status = falcon.HTTP_304
+        else:
+            resp.status = falcon.HTTP_200
+            resp.data = body
+
+
+def etag_matches(if_none_match, etag):
+    """Return whether the ``If-None-Match`` header value lists ``etag``."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate == etag or candidate == 'W/' + etag:
+            return True
+    return False
+
+
 class RootResource(BaseHandler):
     __url__ = '/'
 
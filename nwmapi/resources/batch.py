@@ -0,0 +1,30 @@
+import logging
+
+import falcon
+from nwmapi import batch
+from nwmapi.common import booleanize
+from nwmapi.hooks import require_req_body
+from nwmapi.resources import BaseHandler
+
+log = logging.getLogger(__name__)
+
+
+# HTTP method   URI Pattern                 Method
+# POST          /batch                      run the sub-requests, see nwmapi.batch
+
+class BatchResource(BaseHandler):
+    __url__ = '/batch'
+    #: a batch does not contain batches
+    __batch__ = False
+
+    def __init__(self, app, limiter=None):
+        self.dispatcher = batch.Dispatcher(app, limiter)
+
+    @falcon.before(require_req_body())
+    def on_post(self, req, resp):
+        data = req.json_data
+        requests = batch.parse(data)
+        atomic = booleanize(data.get('atomic', False))
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'application/json; charset=utf-8'
+        resp.body = self.dispatcher.run(req, requests, atomic=atomic, pretty=resp.pretty_json)
@@ -0,0 +1,25 @@
+import logging
+
+import falcon
+from nwmapi.hooks import require_path_param
+from nwmapi.httpstatus import HTTP404NotFound
+from nwmapi.resources import BaseHandler
+from nwmapi.services import userservice
+
+log = logging.getLogger(__name__)
+
+
+# HTTP method   URI Pattern                 Method
+# GET           /jobs/<id>                  get_job()
+
+class JobResource(BaseHandler):
+    __url__ = '/jobs/{id}'
+
+    @falcon.before(require_path_param('id'))
+    def on_get(self, req, resp, id):
+        job = userservice.get_job(id.lower())
+
+        if job is None:
+            raise HTTP404NotFound()
+
+        resp.http200ok(result=job)
@@ -1,15 +1,30 @@
 from collections import OrderedDict
 import logging
 
+import falcon
+from nwmapi import slowqueries
+from nwmapi.hooks import require_token
 from nwmapi.models.user import User
-from nwmapi.resources import BaseHandler
+from nwmapi.resources import BaseHandler, StaticResource
 
 log = logging.getLogger(__name__)
 
-class MetaListResource(BaseHandler):
+class MetaListResource(StaticResource):
     __url__ = '/meta'
 
-    def on_get(self, req, resp):
+    def render(self):
         results = OrderedDict()
         results[User.__tablename__] = User.description()
-        resp.http200ok(result=results)
+        return results
+
+
+class SlowQueriesResource(BaseHandler):
+    __url__ = '/meta/slow-queries'
+
+    def __init__(self, token=None):
+        #: value of the X-Admin-Token header required, ``slowqueries.token``
+        self.token = token
+
+    @falcon.before(require_token())
+    def on_get(self, req, resp):
+        resp.http200ok(result=slowqueries.registry.recent())
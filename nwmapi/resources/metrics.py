@@ -0,0 +1,24 @@
+import logging
+
+import falcon
+from nwmapi import metrics
+from nwmapi.hooks import require_token
+from nwmapi.resources import BaseHandler
+
+log = logging.getLogger(__name__)
+
+
+# HTTP method   URI Pattern                 Method
+# GET           /metrics                    metrics.registry.render()
+
+class MetricsResource(BaseHandler):
+    __url__ = '/metrics'
+
+    def __init__(self, token=None):
+        #: value of the X-Admin-Token header required, ``metrics.token``
+        self.token = token
+
+    @falcon.before(require_token())
+    def on_get(self, req, resp):
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.body = metrics.registry.render()
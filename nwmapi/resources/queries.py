@@ -0,0 +1,47 @@
+import logging
+
+import falcon
+from nwmapi import namedqueries
+from nwmapi.hooks import require_admin, require_json_fields
+from nwmapi.httpstatus import HTTP400BadRequest, HTTP403Forbidden, HTTP409Conflict
+from nwmapi.models.user import User
+from nwmapi.resources import BaseHandler
+
+log = logging.getLogger(__name__)
+
+MODELS = {
+    User.__tablename__: User,
+}
+
+
+# HTTP method   URI Pattern                 Method
+# GET           /queries                    namedqueries.all_queries()
+# POST          /queries                    namedqueries.define(), with namedqueries.allow_post
+
+class QueriesResource(BaseHandler):
+    __url__ = '/queries'
+
+    def on_get(self, req, resp):
+        resp.http200ok(result=[q.to_dict() for q in namedqueries.all_queries()])
+
+    @falcon.before(require_admin())
+    @falcon.before(require_json_fields('name', 'q'))
+    def on_post(self, req, resp):
+        if not namedqueries.ALLOW_POST:
+            raise HTTP403Forbidden('Named queries are configured',
+                                   'Named queries are defined in the configuration of the server.')
+        data = req.json_data
+        model = MODELS.get(data.get('model', User.__tablename__))
+        if model is None:
+            raise HTTP400BadRequest('Invalid model',
+                                    'Named queries can be defined for: %s' % ', '.join(MODELS))
+
+        try:
+            query = namedqueries.define(data['name'], model, data['q'])
+        except namedqueries.QueryExists as e:
+            raise HTTP409Conflict('Query exists', str(e))
+        except ValueError as e:
+            raise HTTP400BadRequest('Invalid query', str(e))
+
+        resp.http201created(location='/%ss?query=%s' % (model.__tablename__, query.name),
+                            result=query.to_dict())
@@ -1,23 +1,38 @@
 import logging
 
 import falcon
+from nwmapi import export, validation
 from nwmapi.common import booleanize
-from nwmapi.hooks import require_path_param, validate_fields
-from nwmapi.httpstatus import HTTP404NotFound, HTTP501NotImplemented
-from nwmapi.models.user import User
+from nwmapi.db import InvalidFilters, parse_includes
+from nwmapi.hooks import require_path_param, validate_fields, require_json_fields, require_req_body, is_valid_id
+from nwmapi.httpstatus import HTTP404NotFound, HTTP501NotImplemented, HTTP400InvalidParam, \
+    HTTP400MissingRequiredParam, HTTP400BadRequest, HTTP400InvalidFields, HTTP401Unauthorized, HTTP403Forbidden
+from nwmapi.middleware import iter_json_array
+from nwmapi.namedqueries import MissingQueryParam, InvalidQueryParam
+from nwmapi.models.user import User, USER_STATUS_DISABLED
 from nwmapi.resources import BaseHandler
 from nwmapi.services import userservice
 
 log = logging.getLogger(__name__)
 
+#: Ids accepted by GET /users?ids= and POST /users/lookup
+MAX_LOOKUP_IDS = 1000
 
 
 # HTTP method   URI Pattern                 Method
 # GET           /users                      get_user_list()
+# GET           /users?ids=<id>,<id>        get_users()
 # POST          /users                      create_user()
 # GET           /users/<id>                 get_user()
 # PUT           /users/<id>                 update_user()
+# PATCH         /users/<id>                 patch_user()
 # DELETE        /users/<id>                 delete_user()
+# POST          /users/login                login_user()
+# POST          /users/logout               (revoke the access token)
+# POST          /users/lookup               get_users()
+# GET           /users/stats                user_stats()
+# GET           /users/export               export_users()
+# POST          /users/bulk                 import_users()
 
 # TODO
 
@@ -31,8 +46,6 @@ log = logging.getLogger(__name__)
 # GET           /users/confirm              confirm_email()
 # GET           /users/count                user_count()
 # GET           /user/<id>/exists           user_exists()
-# POST          /users/login                login_user()
-# POST          /users/logout               logout_user()
 # POST          /users/reset                reset_password()
 
 # http://docs.stormpath.com/rest/product-guide/#verify-an-email-address
@@ -55,8 +68,41 @@ class UsersResource(BaseHandler):
         start = req.params.get('start', None)
         end = req.params.get('end', None)
 
-        users = userservice.get_user_list(filters=filters, order_by=order_by,
-                                          limit=limit, offset=offset, start=start, end=end)
+        if 'query' in req.params:
+            self._on_get_named_query(req, resp, limit=limit, offset=offset)
+            return
+
+        if 'ids' in req.params:
+            resp.http200ok(result=lookup_users(req.get_param_as_list('ids')))
+            return
+
+        try:
+            deep = parse_includes(req.params.get('include', None), User)
+        except ValueError as e:
+            log.debug(e)
+            raise HTTP400InvalidParam('include')
+
+        try:
+            users = userservice.get_user_list(filters=filters, order_by=order_by,
+                                              limit=limit, offset=offset, start=start, end=end,
+                                              deep=deep)
+        except InvalidFilters as e:
+            log.debug(e)
+            raise HTTP400InvalidParam('q')
+
+        resp.http200ok(result=[user.to_dict(deep=deep) for user in users])
+
+    def _on_get_named_query(self, req, resp, limit=None, offset=None):
+        try:
+            users = userservice.run_named_query(req.params['query'], req.params,
+                                                limit=limit, offset=offset)
+        except MissingQueryParam as e:
+            raise HTTP400MissingRequiredParam(e.param_name)
+        except InvalidQueryParam as e:
+            raise HTTP400InvalidParam(e.param_name)
+
+        if users is None:
+            raise HTTP400InvalidParam('query')
 
         resp.http200ok(result=users)
 
@@ -67,6 +113,127 @@ class UsersResource(BaseHandler):
         resp.http201created(location='/users/%s' % user.id.hex, result=user)
 
 
+class UserLoginResource(BaseHandler):
+    __url__ = '/users/login'
+
+    def __init__(self, signer):
+        self.signer = signer
+
+    @falcon.before(require_json_fields('password'))
+    def on_post(self, req, resp):
+        data = req.json_data
+        user = userservice.login_user(data['password'],
+                                      username=data.get('username', None),
+                                      email=data.get('email', None))
+        if user is None:
+            raise HTTP401Unauthorized('Invalid credentials', 'Wrong username, email or password.')
+        if user.status == USER_STATUS_DISABLED:
+            raise HTTP403Forbidden('Account disabled', 'This account has been disabled.')
+
+        resp.http200ok(result={
+            'access_token': self.signer.issue(user),
+            'token_type': 'Bearer',
+            'expires_in': self.signer.ttl,
+        })
+
+
+class UsersLookupResource(BaseHandler):
+    """The users with the ids of the body, ``{"ids": [...]}``, as ``GET /users?ids=`` for long lists."""
+    __url__ = '/users/lookup'
+
+    @falcon.before(require_json_fields('ids'))
+    def on_post(self, req, resp):
+        ids = req.json_data['ids']
+        if not isinstance(ids, list):
+            raise HTTP400InvalidParam('ids')
+        resp.http200ok(result=lookup_users(ids))
+
+
+def lookup_users(ids):
+    """Return the users with ``ids`` in the same order, ``None`` for the missing ones.
+
+    Raises 400 if an id is not 32 hex digits or there are more than :data:`MAX_LOOKUP_IDS`.
+    """
+    if not ids or len(ids) > MAX_LOOKUP_IDS:
+        raise HTTP400BadRequest('Invalid ids', 'Between 1 and %d ids are required.' % MAX_LOOKUP_IDS)
+    invalid = [id for id in ids if not is_valid_id(id)]
+    if invalid:
+        raise HTTP400BadRequest('Invalid ids', 'Ids are 32 hex digits, not: %s.'
+                                % ', '.join(str(id) for id in invalid[:10]))
+    return userservice.get_users(ids)
+
+
+class UserLogoutResource(BaseHandler):
+    __url__ = '/users/logout'
+
+    def __init__(self, signer):
+        self.signer = signer
+
+    def on_post(self, req, resp):
+        claims = req.context.get('auth')
+        if claims is None:
+            raise HTTP401Unauthorized('Authentication required', 'An access token is required to log out.')
+
+        self.signer.revoke(claims)
+        resp.http204nocontent()
+
+
+class UsersBulkResource(BaseHandler):
+    """Create users from a JSON array, processed as it is uploaded."""
+    __url__ = '/users/bulk'
+    __max_body__ = 64 * 1024 * 1024
+    __stream_body__ = True
+    __batch__ = False
+
+    @falcon.before(require_req_body())
+    def on_post(self, req, resp):
+        created = userservice.import_users(self._checked(iter_json_array(req)))
+        resp.http201created(result={'created': created})
+
+    @staticmethod
+    def _checked(items):
+        schema = validation.schema(User)
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise HTTP400BadRequest('Invalid user', 'Item %d is not a JSON object.' % index)
+            errors = schema.validate(item, prefix='%d.' % index)
+            if errors:
+                raise HTTP400InvalidFields(errors)
+            yield item
+
+
+class UsersExportResource(BaseHandler):
+    __url__ = '/users/export'
+    __batch__ = False
+
+    def on_get(self, req, resp):
+        fmt = req.params.get('format', 'ndjson')
+        if fmt not in export.MEDIA_TYPES:
+            raise HTTP400InvalidParam('format')
+
+        try:
+            rows = userservice.export_users(filters=req.params.get('q', None))
+        except InvalidFilters as e:
+            log.debug(e)
+            raise HTTP400InvalidParam('q')
+        if fmt == 'csv':
+            chunks = export.csv_chunks(rows, [col.name for col in userservice.export_columns()])
+        else:
+            chunks = export.ndjson_chunks(rows)
+
+        resp.status = falcon.HTTP_200
+        resp.content_type = export.MEDIA_TYPES[fmt]
+        resp.stream = chunks
+
+
+class UserStatsResource(BaseHandler):
+    __url__ = '/users/stats'
+
+    def on_get(self, req, resp):
+        approx = booleanize(req.params.get('approx', False))
+        resp.http200ok(result=userservice.user_stats(approx=approx))
+
+
 class UserResource(BaseHandler):
     __url__ = '/users/{id}'
 
@@ -81,6 +248,7 @@ class UserResource(BaseHandler):
 
 
     @falcon.before(require_path_param('id'))
+    @falcon.before(validate_fields(User, partial=True))
     def on_put(self, req, resp, id):
         user = userservice.update_user(req.json_data, id=id)
 
@@ -90,6 +258,16 @@ class UserResource(BaseHandler):
         resp.http200ok(result=user)
 
 
+    @falcon.before(require_path_param('id'))
+    @falcon.before(validate_fields(User, partial=True))
+    def on_patch(self, req, resp, id):
+        """Apply a JSON Merge Patch (``application/merge-patch+json``) to the user."""
+        if not userservice.patch_user(req.json_data, id=id):
+            raise HTTP404NotFound()
+
+        resp.http204nocontent()
+
+
     @falcon.before(require_path_param('id'))
     def on_delete(self, req, resp, id):
         user = userservice.delete_user(id=id)
@@ -0,0 +1,32 @@
+"""Periodic jobs run in daemon threads of the server process.
+
+Each job runs in its own thread and gets its own thread-local ``DBSession``,
+which is removed after every run. With several server processes every process
+runs the job, so only enable jobs which are safe to run concurrently.
+"""
+import logging
+import threading
+import time
+
+from nwmapi import prefork
+from nwmapi.db import DBSession
+
+log = logging.getLogger(__name__)
+
+
+def every(interval, func, name=None):
+    """Call ``func()`` every ``interval`` seconds, starting one interval from now."""
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                func()
+            except Exception as e:
+                log.exception(e)
+            finally:
+                DBSession.remove()
+
+    thread = threading.Thread(target=run, name=name or getattr(func, '__name__', None))
+    thread.daemon = True
+    prefork.start(thread.start)
+    return thread
@@ -0,0 +1,57 @@
+from nwmapi import prefork
+from nwmapi.common import booleanize, parse_vars, setup_logging, get_appsettings, _getpathsec
+import configparser
+import functools
+from logging.config import fileConfig
+import multiprocessing
+import os
+import sys
+
+from paste.deploy import loadapp
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [workers=N] [var=value]\n'
+          'Serve the app with preforked worker processes, on the host and port of [server:main].\n'
+          '(example: "%s production.ini workers=4")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def server_options(config_uri):
+    """Return the waitress settings of the ``[server:main]`` section of ``config_uri``."""
+    path, _ = _getpathsec(config_uri, None)
+    path = os.path.abspath(path)
+    parser = configparser.ConfigParser(dict(__file__=path, here=os.path.dirname(path)))
+    parser.read([path])
+    options = dict(parser.items('server:main')) if parser.has_section('server:main') else {}
+    for name in ('__file__', 'here', 'use'):
+        options.pop(name, None)
+    return options
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    # the loggers of nwmapi exist already, imported with nwmapi.common
+    setup_logging(config_uri, fileConfig=functools.partial(fileConfig, disable_existing_loggers=False))
+    settings = get_appsettings(config_uri, options=options)
+
+    waitress_options = server_options(config_uri)
+    host = options.get('host', waitress_options.get('host', '0.0.0.0'))
+    port = int(options.get('port', waitress_options.get('port', 6543)))
+    workers = int(options.get('workers', settings.get('prefork.workers') or multiprocessing.cpu_count()))
+    graceful_timeout = float(settings.get('prefork.graceful_timeout', 30))
+    if workers > 1 and booleanize(settings.get('metrics.enabled', False)) \
+            and not settings.get('metrics.multiprocess_dir'):
+        # each worker would only report its own requests
+        sys.exit('metrics.multiprocess_dir is required to serve metrics with %d workers' % workers)
+
+    sock = prefork.bind(host, port)
+    path, section = _getpathsec(config_uri, None)
+    app = prefork.load(lambda: loadapp('config:%s' % path, name=section,
+                                       relative_to=os.getcwd(), global_conf=options))
+    prefork.Arbiter(app, sock, workers=workers, options=waitress_options,
+                    graceful_timeout=graceful_timeout).run()
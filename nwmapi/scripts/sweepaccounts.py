@@ -0,0 +1,35 @@
+from nwmapi.common import parse_vars, setup_logging, get_appsettings
+from nwmapi.db import DBSession
+from nwmapi.services import userservice
+import os
+import sys
+
+from sqlalchemy import engine_from_config
+
+
+def usage(argv):
+    cmd = os.path.basename(argv[0])
+    print('usage: %s <config_uri> [batch_size=500] [pause=0] [var=value]\n'
+          'Delete the accounts not verified since 30 days of signup.\n'
+          '(example: "%s development.ini batch_size=1000")' % (cmd, cmd))
+    sys.exit(1)
+
+
+def main(argv=sys.argv):
+    if len(argv) < 2:
+        usage(argv)
+    config_uri = argv[1]
+    options = parse_vars(argv[2:])
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri, options=options)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+
+    batch_size = int(options.get('batch_size', settings.get('sweep.batch_size', 500)))
+    pause = float(options.get('pause', settings.get('sweep.pause', 0)))
+
+    def progress(total, rate):
+        print('deleted %d accounts (%.0f rows/sec)' % (total, rate))
+
+    total = userservice.sweep_non_activated_accounts(batch_size=batch_size, pause=pause, progress=progress)
+    print('done, %d accounts deleted' % total)
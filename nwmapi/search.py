@@ -15,16 +15,41 @@
 
 """
 import inspect
+import logging
+import uuid
+from collections import OrderedDict
 
 from sqlalchemy import and_
 from sqlalchemy import or_
+from sqlalchemy import Column
+from sqlalchemy import MetaData
+from sqlalchemy import Table
+from sqlalchemy import select
 from sqlalchemy.ext.associationproxy import AssociationProxy
+from sqlalchemy.orm import contains_eager
 from sqlalchemy.orm.attributes import InstrumentedAttribute
 
 from .helpers import session_query
+from .helpers import get_field_type
 from .helpers import get_related_association_proxy_model
 from .helpers import primary_key_names
 
+log = logging.getLogger(__name__)
+
+#: Maximum number of values placed in a single ``IN (...)`` clause. Longer
+#: lists are split into an ``OR`` of several ``IN`` clauses.
+IN_CHUNK_SIZE = 500
+
+#: Lists with more values than this are loaded into a temporary table and
+#: compared with ``IN (SELECT value FROM ...)`` instead, so the statement
+#: stays below the bind parameter limit of the database (999 on older SQLite
+#: builds). Only applies when a session is available to create the table.
+IN_TEMP_TABLE_THRESHOLD = 900
+
+#: Key in ``Session.info`` listing the temporary tables created for the
+#: current request; see :func:`drop_in_temp_tables`.
+IN_TEMP_TABLES_KEY = 'search.in_temp_tables'
+
 
 def _sub_operator(model, argument, fieldname):
     """Recursively calls :func:`QueryBuilder._create_operation` when argument
@@ -52,6 +77,114 @@ def _sub_operator(model, argument, fieldname):
     return getattr(submodel, fieldname) == argument
 
 
+def _normalize_in_values(fieldtype, values):
+    """Returns `values` with duplicates removed, in their original order.
+
+    Values of :class:`nwmapi.db.GUID` columns are converted to
+    :class:`uuid.UUID` once here, so binding them later is a plain format
+    instead of a parse per value. Raises :exc:`ValueError` for values which
+    are not ids.
+
+    """
+    # imported here since nwmapi.db imports this module
+    from nwmapi.db import GUID
+    if isinstance(fieldtype, GUID):
+        try:
+            values = [GUID.coerce(v) for v in values]
+        except (ValueError, TypeError, AttributeError):
+            raise ValueError('Invalid id in %r' % (values,))
+    try:
+        return list(OrderedDict.fromkeys(values))
+    except TypeError:
+        # unhashable values, leave them to the database
+        return list(values)
+
+
+def _in_temp_table(session, fieldtype, values):
+    """Loads `values` into a new temporary table and returns a
+    ``SELECT value FROM <table>`` to be used as the right side of ``IN``.
+
+    The rows are inserted with ``executemany``, so the number of values is not
+    bound by the parameter limit of a single statement. The table is recorded
+    in ``session.info`` and dropped by :func:`drop_in_temp_tables`.
+
+    """
+    table = Table('in_values_%s' % uuid.uuid4().hex, MetaData(),
+                  Column('value', fieldtype),
+                  prefixes=['TEMPORARY'])
+    connection = session.connection()
+    table.create(connection)
+    connection.execute(table.insert(), [{'value': v} for v in values])
+    session.info.setdefault(IN_TEMP_TABLES_KEY, []).append(table)
+    return select([table.c.value])
+
+
+def _in_operation(field, values, fieldtype=None, session=None, negate=False):
+    """Returns the ``IN`` (or ``NOT IN``) expression comparing `field` with
+    the list `values`.
+
+    Short lists become a single ``IN``. Lists longer than
+    :data:`IN_CHUNK_SIZE` become an ``OR`` of ``IN`` clauses of at most that
+    many values each, and lists longer than :data:`IN_TEMP_TABLE_THRESHOLD`
+    are compared against a temporary table when a `session` bound to an
+    engine is given.
+
+    """
+    if not isinstance(values, (list, tuple, set)):
+        expression = field.in_(values)
+        return ~expression if negate else expression
+
+    values = _normalize_in_values(fieldtype, values)
+    if session is not None and session.bind is not None \
+            and fieldtype is not None and len(values) > IN_TEMP_TABLE_THRESHOLD:
+        expression = field.in_(_in_temp_table(session, fieldtype, values))
+    elif len(values) > IN_CHUNK_SIZE:
+        expression = or_(*(field.in_(values[i:i + IN_CHUNK_SIZE])
+                           for i in range(0, len(values), IN_CHUNK_SIZE)))
+    else:
+        expression = field.in_(values)
+    return ~expression if negate else expression
+
+
+def in_clause(field, values, session=None):
+    """Returns ``field IN values`` for a list `values` of any length, chunked
+    or through a temporary table as :func:`_in_operation` does.
+
+    """
+    return _in_operation(field, values, fieldtype=field.type, session=session)
+
+
+def drop_in_temp_tables(session):
+    """Drops the temporary tables created for large ``IN`` lists during the
+    lifetime of `session`.
+
+    Call this instead of a rollback, just before closing the session: the
+    uncommitted work of the session is rolled back and the tables are dropped
+    in a transaction of their own, which is committed. A DROP in the session's
+    transaction would be undone by the rollback of ``close()`` and leave the
+    tables on the pooled connection.
+
+    """
+    tables = session.info.pop(IN_TEMP_TABLES_KEY, None)
+    if not tables:
+        return
+    connection = session.connection()
+    preparer = connection.dialect.identifier_preparer
+    # the DBAPI connection, since the session would give the connection back
+    # to the pool on rollback; close() then rolls back an empty transaction
+    dbapi_connection = connection.connection
+    try:
+        dbapi_connection.rollback()
+        cursor = dbapi_connection.cursor()
+        for table in tables:
+            # tables created in the rolled back transaction are gone already
+            cursor.execute('DROP TABLE IF EXISTS %s' % preparer.format_table(table))
+        cursor.close()
+        dbapi_connection.commit()
+    except Exception as e:
+        log.warning('Could not drop temporary tables %s: %s', ', '.join(t.name for t in tables), e)
+
+
 #: The mapping from operator name (as accepted by the search method) to a
 #: function which returns the SQLAlchemy expression corresponding to that
 #: operator.
@@ -100,8 +233,8 @@ OPERATORS = {
     'leq': lambda f, a: f <= a,
     'ilike': lambda f, a: f.ilike(a),
     'like': lambda f, a: f.like(a),
-    'in': lambda f, a: f.in_(a),
-    'not_in': lambda f, a: ~f.in_(a),
+    'in': lambda f, a: _in_operation(f, a),
+    'not_in': lambda f, a: _in_operation(f, a, negate=True),
     # Operators which accept three arguments.
     'has': lambda f, a, fn: f.has(_sub_operator(f, a, fn)),
     'any': lambda f, a, fn: f.any(_sub_operator(f, a, fn)),
@@ -349,7 +482,8 @@ class QueryBuilder(object):
     """
 
     @staticmethod
-    def _create_operation(model, fieldname, operator, argument, relation=None):
+    def _create_operation(model, fieldname, operator, argument, relation=None,
+                          session=None):
         """Translates an operation described as a string to a valid SQLAlchemy
         query parameter using a field or relation of the specified model.
 
@@ -381,6 +515,10 @@ class QueryBuilder(object):
         which the operation will be applied as part of the search, or ``None``
         if this function should not use a related entity in the search.
 
+        `session`, if not ``None``, is the session the query will run in. It
+        allows very long ``in`` and ``not_in`` lists to be loaded into a
+        temporary table; see :func:`_in_operation`.
+
         This function raises the following errors:
         * :exc:`KeyError` if the `operator` is unknown (that is, not in
           :data:`OPERATORS`)
@@ -406,16 +544,23 @@ class QueryBuilder(object):
             msg = ('To compare a value to NULL, use the is_null/is_not_null '
                    'operators.')
             raise TypeError(msg)
+        if operator in ('in', 'not_in') and relation is None:
+            return _in_operation(field, argument,
+                                 fieldtype=get_field_type(model, fieldname),
+                                 session=session,
+                                 negate=(operator == 'not_in'))
         if numargs == 2:
             return opfunc(field, argument)
         return opfunc(field, argument, fieldname)
 
     @staticmethod
-    def _create_filter(model, filt):
+    def _create_filter(model, filt, session=None):
         """Returns the operation on `model` specified by the provided filter.
 
         `filt` is an instance of the :class:`Filter` class.
 
+        `session` is passed on to :func:`_create_operation`.
+
         Raises one of :exc:`AttributeError`, :exc:`KeyError`, or
         :exc:`TypeError` if there is a problem creating the query. See the
         documentation for :func:`_create_operation` for more information.
@@ -435,13 +580,14 @@ class QueryBuilder(object):
                 val = getattr(model, filt.otherfield)
             # for the sake of brevity...
             create_op = QueryBuilder._create_operation
-            return create_op(model, fname, filt.operator, val, relation)
+            return create_op(model, fname, filt.operator, val, relation,
+                             session=session)
         # Otherwise, if this filter is a conjunction or a disjunction, make
         # sure to apply the appropriate filter operation.
         create_filt = QueryBuilder._create_filter
         if isinstance(filt, ConjunctionFilter):
-            return and_(create_filt(model, f) for f in filt)
-        return or_(create_filt(model, f) for f in filt)
+            return and_(create_filt(model, f, session) for f in filt)
+        return or_(create_filt(model, f, session) for f in filt)
 
     @staticmethod
     def create_query(session, model, search_params, _ignore_order_by=False):
@@ -477,7 +623,8 @@ class QueryBuilder(object):
         # For the sake of brevity, rename this method.
         create_filt = QueryBuilder._create_filter
         # This function call may raise an exception.
-        filters = [create_filt(model, filt) for filt in search_params.filters]
+        filters = [create_filt(model, filt, session)
+                   for filt in search_params.filters]
         # Multiple filter criteria at the top level of the provided search
         # parameters are interpreted as a conjunction (AND).
         query = query.filter(*filters)
@@ -496,6 +643,11 @@ class QueryBuilder(object):
                         field = getattr(relation_model, field_name_in_relation)
                         direction = getattr(field, val.direction)
                         query = query.join(relation_model)
+                        # The joined row is already in the result, populate
+                        # a scalar relation from it instead of lazy loading
+                        # it again for every instance.
+                        if not relation.property.uselist:
+                            query = query.options(contains_eager(relation))
                         query = query.order_by(direction())
                     else:
                         field = getattr(model, val.field)
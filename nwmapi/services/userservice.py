@@ -1,33 +1,138 @@
-from datetime import datetime
+from collections import OrderedDict
 import logging
+import time
+import uuid
 
-from nwmapi.db import DBSession, generate_query
-from nwmapi.models.user import User, NON_ACTIVATION_AGE, USER_STATUS_DISABLED, \
-    USER_STATUS_ENABLED
+from sqlalchemy import func, distinct
+from sqlalchemy.dialects.postgresql import JSON
+
+from nwmapi import jobs, namedqueries, passwords, search
+from nwmapi.db import DBSession, JsonBlob, generate_query, apply_filters, merge_patch, serialize_value, utcnow
+from nwmapi.estimates import CardinalityEstimator, estimate
+from nwmapi.search import in_clause
+from nwmapi.models.user import User, Activation, NON_ACTIVATION_AGE, USER_STATUS_ENABLED, \
+    USER_STATUS_UNVERIFIED, CREATED_BY_SIGNUP
 
 log = logging.getLogger(__name__)
 
+#: Approximate counts of users and of distinct values of these columns
+user_estimates = CardinalityEstimator(User, ('location', 'created_by', 'role'))
+
 
-def get_user_list(filters=None, order_by=None, limit=None, offset=None, start=None, end=None):
+def get_user_list(filters=None, order_by=None, limit=None, offset=None, start=None, end=None,
+                  deep=None):
     q = generate_query(User,
                        filters=filters,
                        order_by=order_by,
-                       limit=limit, offset=offset, start=start, end=end)
+                       limit=limit, offset=offset, start=start, end=end,
+                       deep=deep)
     return q.all()
 
 
+def export_users(filters=None, batch_size=1000):
+    """Return an iterator of every user matching ``filters`` as a dictionary of JSON values.
+
+    ``filters`` is parsed and the query built now, so an invalid filter
+    raises ``InvalidFilters`` before anything is sent; only the rows are read
+    lazily. They are read through a server-side cursor ``batch_size`` at a
+    time, as plain column tuples so they do not accumulate in an identity
+    map. The iterator uses its own session since it is consumed after the
+    request's session has been closed. The password column is never included.
+    """
+    columns = export_columns()
+    session = DBSession.session_factory()
+    try:
+        q = apply_filters(session.query(User), User, filters, session=session)
+        q = q.with_entities(*columns) \
+            .execution_options(stream_results=True) \
+            .yield_per(batch_size)
+    except Exception:
+        session.close()
+        raise
+    return _export_rows(session, q, columns)
+
+
+def _export_rows(session, q, columns):
+    try:
+        for row in q:
+            yield OrderedDict((col.name, serialize_value(val)) for col, val in zip(columns, row))
+    finally:
+        session.close()
+
+
+def export_columns():
+    """Columns included in user exports: all but the password."""
+    return [col for col in User.__table__.columns if col.name != 'password']
+
+
+def run_named_query(name, params, limit=None, offset=None):
+    """Run the named query ``name`` with the parameter values in ``params``.
+
+    Returns ``None`` if there is no such query.
+    """
+    query = namedqueries.get(User, name)
+    if query is None:
+        return None
+    return query.execute(params, limit=limit, offset=offset)
+
+
 def create_user(dictionary=None):
     user = User()
     user.from_dict(dictionary)
-    # created_by = dictionary.get('created_by', CREATED_BY_SIGNUP)
-    # if user.status == USER_STATUS_DISABLED:
-    #     user.activation = Activation(created_by)
+    created_by = (dictionary or {}).get('created_by', CREATED_BY_SIGNUP)
+    if user.status == USER_STATUS_UNVERIFIED:
+        user.activation = Activation(created_by)
 
     DBSession.add(user)
     DBSession.commit()
     return user
 
 
+def import_users(dictionaries, batch_size=100):
+    """Create a user for each dictionary of the iterable ``dictionaries``.
+
+    The iterable is consumed as users are created, and they are committed
+    ``batch_size`` at a time, so an import holds at most one batch in the
+    session. Batches committed before an error stay imported.
+
+    :return: the number of created users
+    """
+    total = 0
+    try:
+        for dictionary in dictionaries:
+            user = User()
+            user.from_dict(dictionary)
+            if user.status == USER_STATUS_UNVERIFIED:
+                user.activation = Activation(dictionary.get('created_by', CREATED_BY_SIGNUP))
+            DBSession.add(user)
+
+            total += 1
+            if total % batch_size == 0:
+                DBSession.commit()
+                DBSession.expunge_all()
+        DBSession.commit()
+    except Exception:
+        DBSession.rollback()
+        raise
+    return total
+
+
+def login_user(password, username=None, email=None):
+    """Return the user with these credentials, or ``None``.
+
+    A password hash made with an outdated cost is upgraded on the way.
+    """
+    if email is not None:
+        email = email.lower()
+    user = get_user(username=username, email=email)
+    if user is None or not user.validate_password(password):
+        return None
+
+    if DBSession.is_modified(user):
+        DBSession.commit()
+    return user
+
+
 def get_user(id=None, username=None, email=None):
     q = DBSession.query(User)
 
@@ -43,6 +148,17 @@ def get_user(id=None, username=None, email=None):
     return None
 
 
+def get_users(ids):
+    """Return the users with these hex ``ids`` in the same order, ``None`` for the missing ones.
+
+    They are read with one ``IN`` query.
+    """
+    keys = [uuid.UUID(id) for id in ids]
+    users = DBSession.query(User).filter(in_clause(User.id, keys, session=DBSession))
+    found = dict((user.id, user) for user in users)
+    return [found.get(key) for key in keys]
+
+
 def update_user(dictionary, id=None, username=None, email=None):
     user = get_user(id=id, username=username, email=email)
     if not user:
@@ -54,6 +170,41 @@ def update_user(dictionary, id=None, username=None, email=None):
     return user
 
 
+def patch_user(patch, id):
+    """Apply the JSON Merge Patch ``patch`` to the user ``id``, returning whether it exists.
+
+    Only the columns of the patch are written, with one UPDATE and without
+    loading the user; ``updated_at`` is bumped by its ``onupdate``. A
+    ``null`` clears a column. The members of an object patching a JSON
+    column are merged into its current value, the one column read first with
+    ``SELECT ... FOR UPDATE`` so that concurrent patches of the column do not
+    lose each other's members. SQLite has no row locks: there the later of two
+    overlapping patches fails with a busy error instead of overwriting the
+    other's.
+    """
+    user_filter = User.id == uuid.UUID(id)
+    if not patch:
+        return DBSession.query(User.id).filter(user_filter).first() is not None
+
+    columns = User.__table__.columns
+    values = {}
+    for key, value in patch.items():
+        if key == 'password' and value is not None:
+            value = passwords.hash_password(value)
+        elif key == 'email' and value is not None:
+            value = value.lower()
+        elif isinstance(value, dict) and isinstance(columns[key].type, (JSON, JsonBlob)):
+            current = DBSession.query(columns[key]).filter(user_filter).with_for_update().first()
+            if current is None:
+                return False
+            value = merge_patch(current[0], value)
+        values[columns[key]] = value
+
+    count = DBSession.query(User).filter(user_filter).update(values, synchronize_session=False)
+    DBSession.commit()
+    return count > 0
+
+
 def delete_user(id=None, username=None, email=None):
     user = get_user(id=id, username=username, email=email)
     if not user:
@@ -69,7 +220,7 @@ def activate(activation):
     DBSession.delete(activation)
 
 
-def activation_count(self):
+def activation_count():
     """Count how many activations are in the system."""
     return DBSession.query(Activation).count()
 
@@ -77,6 +228,7 @@ def activation_count(self):
 def get_user_by_activation_code(username, code):
     """Get the user for this code"""
     activation = DBSession.query(Activation) \
+        .join(Activation.user) \
         .filter(Activation.code == code) \
         .filter(User.username == username) \
         .first()
@@ -90,6 +242,7 @@ def get_user_by_activation_code(username, code):
 def activate_user(username, code, new_pass):
     """Given this code get the user with this code make sure they exist"""
     activation = DBSession.query(Activation) \
+        .join(Activation.user) \
         .filter(Activation.code == code) \
         .filter(User.username == username) \
         .first()
@@ -98,7 +251,7 @@ def activate_user(username, code, new_pass):
         user = activation.user
         user.status = USER_STATUS_ENABLED
         user.password = new_pass
-        activation.activate()
+        activate(activation)
         return user
     else:
         return None
@@ -119,28 +272,105 @@ def acceptable_password(password):
     return True
 
 
-def non_activated_account(delete=False):
-    """Get a list of  user accounts which are not verified since 30 days of signup"""
-    test_date = datetime.utcnow() - NON_ACTIVATION_AGE
+def _non_activated_account_query(columns):
+    """Query ``columns`` for the accounts not verified since 30 days of signup"""
+    test_date = utcnow() - NON_ACTIVATION_AGE
 
-    subquery = DBSession.query(Activation.id). \
+    # Activation.valid_until is indexed, so this is a range scan
+    return DBSession.query(*columns). \
+        join(Activation, Activation.user_id == User.id). \
         filter(Activation.valid_until < test_date). \
-        subquery(name="query")
+        filter(User.status == USER_STATUS_UNVERIFIED)
 
-    user_query = DBSession.query(User). \
-        filter(User.status == USER_STATUS_DISABLED). \
-        filter(User.id.in_(subquery))
 
+def non_activated_account(delete=False):
+    """Get a list of  user accounts which are not verified since 30 days of signup"""
     # Delete the non activated accounts only if it is asked to.
     if delete:
-        for user in user_query.all():
-            DBSession.delete(user)
+        sweep_non_activated_accounts()
     # If the non activated accounts are not asked to be deleted,
     # return their details.
     else:
-        return user_query.all()
+        return _non_activated_account_query([User]).all()
+
+
+def sweep_non_activated_accounts(batch_size=500, pause=0, progress=None):
+    """Delete the accounts not verified since 30 days of signup.
+
+    Accounts are deleted ``batch_size`` at a time with set-based ``DELETE``
+    statements, each batch in its own short transaction, so locks are only held
+    for one batch. A batch larger than ``search.IN_CHUNK_SIZE`` is deleted with
+    several statements in its transaction, so that no statement goes over the
+    bind parameter limit of the database. ``pause`` seconds are slept between batches to leave room
+    for other writers.
+
+    ``progress``, if given, is called after each batch with the number of
+    accounts deleted so far and the rate in rows/sec.
+
+    :return: the number of deleted accounts
+    """
+    total = 0
+    started = time.time()
+    try:
+        while True:
+            ids = [row[0] for row in _non_activated_account_query([User.id]).limit(batch_size)]
+            if not ids:
+                break
+
+            for i in range(0, len(ids), search.IN_CHUNK_SIZE):
+                chunk = ids[i:i + search.IN_CHUNK_SIZE]
+                DBSession.query(Activation).filter(Activation.user_id.in_(chunk)).delete(synchronize_session=False)
+                DBSession.query(User).filter(User.id.in_(chunk)).delete(synchronize_session=False)
+            DBSession.commit()
 
+            total += len(ids)
+            rate = total / max(time.time() - started, 1e-6)
+            log.info('Deleted %d non activated accounts (%.0f rows/sec)', total, rate)
+            if progress is not None:
+                progress(total, rate)
+            if pause:
+                time.sleep(pause)
+    except Exception:
+        DBSession.rollback()
+        raise
 
-def user_count(self):
+    return total
+
+
+@jobs.job_type('sweep_non_activated_accounts', concurrency=1)
+def _sweep_non_activated_accounts_job(payload):
+    return {'deleted': sweep_non_activated_accounts(**payload)}
+
+
+def enqueue_sweep_non_activated_accounts(batch_size=500, pause=0):
+    """Sweep the non activated accounts in a background job and return its id."""
+    return jobs.enqueue('sweep_non_activated_accounts', {'batch_size': batch_size, 'pause': pause})
+
+
+def get_job(id):
+    """Status of the background job ``id``, or ``None``."""
+    return jobs.get(id)
+
+
+def user_count():
     """Number of users in the system."""
     return DBSession.query(User).count()
+
+
+def user_stats(approx=False):
+    """Number of users and of distinct values of the ``user_estimates`` columns.
+
+    With ``approx``, the values come from in-memory sketches and carry their
+    error; otherwise they are counted exactly by the database.
+    """
+    if approx:
+        return user_estimates.stats(DBSession.session_factory)
+
+    table = User.__table__
+    columns = user_estimates.columns
+    row = DBSession.query(func.count(), *[func.count(distinct(table.c[col])) for col in columns]).one()
+
+    result = OrderedDict()
+    result['count'] = estimate(row[0], 0)
+    result['distinct'] = OrderedDict((col, estimate(value, 0)) for col, value in zip(columns, row[1:]))
+    return result
@@ -0,0 +1,164 @@
+"""Log of the SQL statements slower than a threshold.
+
+Every statement taking ``slowqueries.threshold_ms`` or more is logged as a
+warning with its duration, the route of the request running it and the shape
+of its bind parameters (their types, never their values). The last
+``slowqueries.size`` of them are kept in memory and listed at
+``GET /meta/slow-queries``.
+
+With ``slowqueries.explain``, the plan of each slow ``SELECT``, ``UPDATE`` or
+``DELETE`` is captured on a separate connection by a background thread
+(``EXPLAIN``, or ``EXPLAIN QUERY PLAN`` on SQLite) and added to its entry.
+Statements using the temporary tables of a request cannot be explained
+there; their entry records the error instead.
+
+Settings::
+
+    # 0 disables the log
+    slowqueries.threshold_ms = 200
+    slowqueries.size = 100
+    slowqueries.explain = true
+    # required in the X-Admin-Token header of GET /meta/slow-queries
+    slowqueries.token =
+"""
+from collections import OrderedDict, deque
+import datetime
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from sqlalchemy import event
+
+from nwmapi import prefork
+from nwmapi.common import booleanize
+
+log = logging.getLogger(__name__)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+
+_local = threading.local()
+
+
+def param_shape(parameters, executemany=False):
+    """Describe ``parameters`` by the type names of their values."""
+    if executemany:
+        parameters = list(parameters)
+        if not parameters:
+            return []
+        return {'rows': len(parameters), 'first': param_shape(parameters[0])}
+    if isinstance(parameters, dict):
+        return OrderedDict((key, type(value).__name__) for key, value in sorted(parameters.items()))
+    if isinstance(parameters, (list, tuple)):
+        return [type(value).__name__ for value in parameters]
+    return type(parameters).__name__
+
+
+class SlowQueryLog(object):
+    """Records slow statements of ``engine``; also the middleware naming their route."""
+
+    def __init__(self, engine, threshold, size=100, explain=True):
+        self.engine = engine
+        self.threshold = threshold
+        self.explain = explain
+        self.entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._explain_queue = queue.Queue(maxsize=size)
+        self._explainer = None
+
+    def install(self):
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(self.engine, 'after_cursor_execute', self._after_cursor_execute)
+        if self.explain:
+            self._explainer = threading.Thread(target=self._explain_loop, name='slowqueries-explain')
+            self._explainer.daemon = True
+            prefork.start(self._explainer.start)
+
+    def process_resource(self, req, resp, resource):
+        _local.route = '%s %s' % (req.method, getattr(resource, '__url__', None))
+
+    def process_response(self, req, resp, resource):
+        _local.route = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info['slowqueries.start'] = clock()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        start = conn.info.pop('slowqueries.start', None)
+        if start is None:
+            return
+        duration = clock() - start
+        if duration >= self.threshold:
+            self.record(statement, parameters, executemany, duration)
+
+    def record(self, statement, parameters, executemany, duration):
+        entry = OrderedDict()
+        entry['at'] = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+        entry['duration_ms'] = round(duration * 1000, 2)
+        entry['route'] = getattr(_local, 'route', None)
+        entry['statement'] = statement
+        entry['params'] = param_shape(parameters, executemany)
+        entry['plan'] = None
+        log.warning('Slow query %.1f ms route=%s params=%s: %s',
+                    entry['duration_ms'], entry['route'], entry['params'], statement)
+
+        with self._lock:
+            self.entries.append(entry)
+
+        if self.explain and not executemany and statement.lstrip()[:6].upper().startswith(EXPLAINABLE):
+            try:
+                # the values are only kept until the plan is captured
+                self._explain_queue.put_nowait((entry, statement, parameters))
+            except queue.Full:
+                pass
+
+    def _explain_loop(self):
+        while True:
+            entry, statement, parameters = self._explain_queue.get()
+            try:
+                entry['plan'] = self._explain(statement, parameters)
+            except Exception as e:
+                entry['plan'] = 'EXPLAIN failed: %r' % e
+
+    def _explain(self, statement, parameters):
+        prefix = 'EXPLAIN QUERY PLAN ' if self.engine.dialect.name == 'sqlite' else 'EXPLAIN '
+        # a DBAPI connection, so that EXPLAIN itself is not timed or counted
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+            cursor.close()
+            connection.rollback()
+        finally:
+            connection.close()
+        return [' '.join(str(value) for value in row) for row in rows]
+
+    def recent(self):
+        """The recorded statements, the latest first."""
+        with self._lock:
+            return list(reversed(self.entries))
+
+
+#: the :class:`SlowQueryLog` of the application, ``None`` when disabled
+registry = None
+
+
+def from_settings(settings, engine):
+    """Return the :class:`SlowQueryLog` middleware, or ``None`` if disabled."""
+    global registry
+    threshold = float(settings.get('slowqueries.threshold_ms', 0))
+    if not threshold:
+        registry = None
+        return None
+    registry = SlowQueryLog(engine, threshold / 1000.0,
+                            size=int(settings.get('slowqueries.size', 100)),
+                            explain=booleanize(settings.get('slowqueries.explain', True)))
+    registry.install()
+    return registry
@@ -0,0 +1,186 @@
+"""Per-request SQL statement counting.
+
+:func:`install` attaches cursor listeners to the engine which count every
+statement executed by the current thread and the time spent executing them.
+``RequestPipeline`` resets the counts when a request starts, so
+:func:`query_count` and :func:`query_time` tell how many statements the
+request has issued so far and how long they took.
+
+The statements of a request are also counted by shape (the SQL text with its
+bind parameters, not their values). When the same shape runs
+``n_plus_one_threshold`` times or more in a request, which is what loading a
+relationship row by row looks like, the request is logged as a likely N+1.
+
+With a ``budget``, a request issuing more statements fails with
+:exc:`QueryBudgetExceeded` at the first statement over it. Meant for
+development, to catch regressions before they ship. Each sub-request of a
+batch gets a budget of its own, see :func:`renew_budget`.
+
+Settings::
+
+    sqlstats.budget = 0
+    sqlstats.n_plus_one_threshold = 5
+
+In tests, use :func:`count_queries` to assert how many statements a block of
+code issues and catch N+1 regressions::
+
+    with count_queries() as counter:
+        userservice.get_user_list(deep={'activation': {}})
+    assert counter() == 2
+
+or :func:`assert_max_queries`, which lists the statements on failure and also
+works around a whole request through the WSGI app::
+
+    with assert_max_queries(2):
+        app(create_environ('/users', query_string='include=activation'), start_response)
+
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from sqlalchemy import event
+
+log = logging.getLogger(__name__)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+#: Statements allowed per request, 0 for no limit
+BUDGET = 0
+
+#: Executions of one statement shape in a request reported as a likely N+1, 0 to disable
+N_PLUS_ONE_THRESHOLD = 5
+
+_local = threading.local()
+
+
+class QueryBudgetExceeded(Exception):
+    """A request issued more statements than :data:`BUDGET`."""
+
+    def __init__(self, budget, statement):
+        super(QueryBudgetExceeded, self).__init__(
+            'More than %d SQL statements in one request, the last one: %s' % (budget, statement))
+        self.budget = budget
+        self.statement = statement
+
+
+def configure(budget=None, n_plus_one_threshold=None):
+    global BUDGET, N_PLUS_ONE_THRESHOLD
+    if budget is not None:
+        BUDGET = int(budget)
+    if n_plus_one_threshold is not None:
+        N_PLUS_ONE_THRESHOLD = int(n_plus_one_threshold)
+
+
+def install(engine):
+    """Start counting the statements executed through ``engine``."""
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    count = _local.count = getattr(_local, 'count', 0) + 1
+    _local.total = getattr(_local, 'total', 0) + 1
+
+    shapes = getattr(_local, 'shapes', None)
+    if shapes is not None:
+        shapes[statement] = shapes.get(statement, 0) + 1
+    for recorder in getattr(_local, 'recorders', ()):
+        recorder.append(statement)
+
+    budget = getattr(_local, 'budget', 0)
+    if budget and count - _local.budget_from > budget:
+        raise QueryBudgetExceeded(budget, statement)
+
+    conn.info['sqlstats.start'] = clock()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('sqlstats.start', None)
+    if start is not None:
+        _local.time = getattr(_local, 'time', 0.0) + clock() - start
+
+
+def reset(request=False):
+    """Reset the statement count and time of the current thread.
+
+    With ``request``, the statements until the next reset are those of a
+    request: their shapes are counted and the :data:`BUDGET` applies.
+    """
+    _local.count = 0
+    _local.time = 0.0
+    _local.shapes = {} if request and N_PLUS_ONE_THRESHOLD else None
+    _local.budget = BUDGET if request else 0
+    _local.budget_from = 0
+
+
+def renew_budget():
+    """Apply the whole :data:`BUDGET` again from the next statement of the request."""
+    _local.budget_from = getattr(_local, 'count', 0)
+
+
+def end_request():
+    """Stop applying the budget and counting shapes; the counts are kept."""
+    _local.shapes = None
+    _local.budget = 0
+
+
+def query_count():
+    """Return the number of statements executed by the current thread since the last :func:`reset`."""
+    return getattr(_local, 'count', 0)
+
+
+def query_time():
+    """Return the seconds spent executing statements by the current thread since the last :func:`reset`."""
+    return getattr(_local, 'time', 0.0)
+
+
+def repeated_statements():
+    """Return the statement shapes of the current request run at least :data:`N_PLUS_ONE_THRESHOLD` times.
+
+    :return: an ordered mapping of statement to the number of executions, most executed first
+    """
+    shapes = getattr(_local, 'shapes', None)
+    if not shapes:
+        return OrderedDict()
+    repeated = [(statement, count) for statement, count in shapes.items() if count >= N_PLUS_ONE_THRESHOLD]
+    return OrderedDict(sorted(repeated, key=lambda item: -item[1]))
+
+
+@contextmanager
+def record_queries():
+    """Yield the list of the statements executed inside the ``with`` block, filled as they run."""
+    statements = []
+    recorders = getattr(_local, 'recorders', None)
+    if recorders is None:
+        recorders = _local.recorders = []
+    recorders.append(statements)
+    try:
+        yield statements
+    finally:
+        recorders.remove(statements)
+
+
+@contextmanager
+def count_queries():
+    """Count the statements executed inside the ``with`` block.
+
+    Yields a callable returning the number of statements executed so far
+    within the block. Unlike :func:`query_count`, the count is not affected by
+    requests resetting the counters inside the block.
+    """
+    start = getattr(_local, 'total', 0)
+    yield lambda: getattr(_local, 'total', 0) - start
+
+
+@contextmanager
+def assert_max_queries(expected):
+    """Fail with the list of statements if the ``with`` block executes more than ``expected``."""
+    with record_queries() as statements:
+        yield statements
+    if len(statements) > expected:
+        raise AssertionError('%d SQL statements executed, expected at most %d:\n%s'
+                             % (len(statements), expected, '\n'.join(statements)))
@@ -0,0 +1,794 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import uuid
+
+from falcon import testing
+
+
+class AppTestCase(unittest.TestCase):
+    """Builds the app through ``main()`` on a new SQLite database."""
+
+    settings = {}
+
+    def setUp(self):
+        from nwmapi import main
+        self.directory = tempfile.mkdtemp()
+        settings = {
+            'sqlalchemy.url': 'sqlite:///%s' % os.path.join(self.directory, 'test.sqlite'),
+            'auth.keys': 'test:secret',
+            'db.create_all': 'true',
+            'passwords.rounds': '4',
+        }
+        settings.update(self.settings)
+        self.app = main({}, **settings)
+
+    def tearDown(self):
+        from nwmapi.db import DBSession
+        DBSession.remove()
+        shutil.rmtree(self.directory)
+
+    def request(self, method, path, query_string='', body=None, headers=None):
+        """Return the status, headers and body of a request to the app."""
+        all_headers = {'Accept': 'application/json', 'Content-Type': 'application/json'}
+        all_headers.update(headers or {})
+        env = testing.create_environ(path=path, method=method, query_string=query_string, headers=all_headers,
+                                     body=json.dumps(body) if body is not None else '')
+        start_response = testing.StartResponseMock()
+        result = b''.join(self.app(env, start_response))
+        return start_response.status, start_response.headers_dict, result
+
+    def token(self, role='CONSUMER'):
+        """Return the Authorization header of a new access token of the same user."""
+        from nwmapi.tokens import TokenSigner
+
+        class User(object):
+            id = uuid.UUID(int=1)
+            status = 'ENABLED'
+
+        User.role = role
+        return 'Bearer ' + TokenSigner({'test': 'secret'}).issue(User())
+
+    def create_users(self, count):
+        """Sign up ``count`` users, not activated."""
+        for i in range(count):
+            status, _, _ = self.request('POST', '/users', body={'username': 'user%d' % i,
+                                                                'email': 'user%d@example.com' % i,
+                                                                'password': 'secret12'})
+            self.assertEqual(status, '201 Created')
+
+
+class MainTests(AppTestCase):
+    def test_meta(self):
+        status, headers, body = self.request('GET', '/meta')
+        self.assertEqual(status, '200 OK')
+        self.assertIn('user', json.loads(body.decode('utf-8')))
+        self.assertTrue(headers['etag'])
+
+        status, _, body = self.request('GET', '/meta', headers={'If-None-Match': headers['etag']})
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(body, b'')
+
+
+class QueryCountTests(AppTestCase):
+    """Regression tests of the statements issued per request, see :mod:`nwmapi.sqlstats`."""
+
+    def test_include_activation_is_one_query(self):
+        from nwmapi.sqlstats import assert_max_queries
+        self.create_users(5)
+
+        # the users and their activations in one statement, not one more per user
+        with assert_max_queries(1):
+            status, _, body = self.request('GET', '/users', query_string='include=activation')
+        self.assertEqual(status, '200 OK')
+        users = json.loads(body.decode('utf-8'))
+        self.assertEqual(len(users), 5)
+        self.assertTrue(all(user['activation']['code'] for user in users))
+
+
+class RateLimitTests(AppTestCase):
+    settings = {'ratelimit.enabled': 'true', 'ratelimit.default': '2/60'}
+
+    def test_tokens_of_a_user_share_a_bucket(self):
+        for i in range(2):
+            status, _, _ = self.request('GET', '/meta', headers={'Authorization': self.token()})
+            self.assertEqual(status, '200 OK')
+        status, headers, _ = self.request('GET', '/meta', headers={'Authorization': self.token()})
+        self.assertEqual(status, '429 Too Many Requests')
+        self.assertTrue(headers['retry-after'])
+
+    def test_sqlite_store(self):
+        from nwmapi.ratelimit import SQLiteStore
+        store = SQLiteStore(os.path.join(self.directory, 'ratelimit.sqlite'), expire=60, purge_interval=0)
+        self.assertEqual(store.take('a', 1.0, 2), 0)
+        self.assertEqual(store.take('a', 1.0, 2), 0)
+        self.assertTrue(0 < store.take('a', 1.0, 2) <= 1)
+        self.assertEqual(store.take('b', 1.0, 2), 0)
+
+        conn = store._connection()
+        conn.execute('UPDATE bucket SET updated = ? WHERE key = ?', (time.time() - 120, 'a'))
+        store.take('b', 1.0, 2)
+        self.assertEqual([row[0] for row in conn.execute('SELECT key FROM bucket')], ['b'])
+
+
+class BatchTests(AppTestCase):
+    settings = {'ratelimit.enabled': 'true', 'ratelimit.default': '2/60', 'ratelimit.route./batch': '10/60',
+                'sqlstats.budget': '1'}
+
+    def tearDown(self):
+        from nwmapi import sqlstats
+        super(BatchTests, self).tearDown()
+        sqlstats.configure(budget=0)
+
+    def batch(self, *paths):
+        status, _, body = self.request('POST', '/batch',
+                                       body={'requests': [{'method': 'GET', 'path': path} for path in paths]})
+        self.assertEqual(status, '200 OK')
+        return [response['status'] for response in json.loads(body.decode('utf-8'))['responses']]
+
+    def test_sub_requests_are_rate_limited(self):
+        self.assertEqual(self.batch('/meta', '/meta', '/meta'), [200, 200, 429])
+
+    def test_sub_requests_have_their_own_budget(self):
+        self.assertEqual(self.batch('/users', '/users'), [200, 200])
+
+
+class EstimatesTests(AppTestCase):
+    def setUp(self):
+        super(EstimatesTests, self).setUp()
+        from nwmapi.services import userservice
+        self.estimates = userservice.user_estimates
+        self.estimates.built_at = None
+        self.create_users(3)
+
+    def test_small_counts_are_exact(self):
+        from nwmapi.services import userservice
+        count = userservice.user_stats(approx=True)['count']
+        self.assertEqual(count['value'], 3)
+        self.assertEqual(count['bounds'], [3, 3])
+
+    def test_bulk_writes(self):
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import User
+        from nwmapi.services import userservice
+        userservice.user_stats(approx=True)
+
+        DBSession.query(User).filter(User.username == 'user0').delete(synchronize_session=False)
+        DBSession.query(User).update({User.firstname: 'Ann'}, synchronize_session=False)
+        DBSession.commit()
+        self.assertFalse(self.estimates.stale)
+        self.assertEqual(userservice.user_stats(approx=True)['count']['value'], 2)
+
+        DBSession.query(User).update({'location': 'Lisbon'}, synchronize_session=False)
+        DBSession.commit()
+        self.assertTrue(self.estimates.stale)
+
+
+class NamedQueriesTests(AppTestCase):
+    settings = {'namedqueries.allow_post': 'true',
+                'namedquery.user.since': '{"filters": [{"name": "created_at", "op": "gt", "val": ":since"}]}'}
+
+    def tearDown(self):
+        from nwmapi import namedqueries
+        super(NamedQueriesTests, self).tearDown()
+        namedqueries._registry.clear()
+        namedqueries.configure(allow_post=False, max_queries=100)
+
+    def post(self, body, role='ADMIN'):
+        headers = {'Authorization': self.token(role)} if role else {}
+        return self.request('POST', '/queries', body=body, headers=headers)[0]
+
+    def test_post(self):
+        from nwmapi import namedqueries
+        query = {'name': 'admins', 'q': {'filters': [{'name': 'role', 'op': 'eq', 'val': 'ADMIN'}]}}
+        self.assertEqual(self.post(query, role=None), '401 Unauthorized')
+        self.assertEqual(self.post(query, role='CONSUMER'), '403 Forbidden')
+        self.assertEqual(self.post(query), '201 Created')
+        self.assertEqual(self.post(query), '409 Conflict')
+        self.assertEqual(self.post({'name': 'since', 'q': {}}), '409 Conflict')
+        self.assertEqual(self.post({'name': 'list', 'q': []}), '400 Bad Request')
+
+        namedqueries.configure(max_queries=2)
+        self.assertEqual(self.post({'name': 'all', 'q': {}}), '400 Bad Request')
+
+    def test_post_not_allowed(self):
+        from nwmapi import namedqueries
+        namedqueries.configure(allow_post=False)
+        self.assertEqual(self.post({'name': 'all', 'q': {}}), '403 Forbidden')
+
+    def test_invalid_param(self):
+        status, _, _ = self.request('GET', '/users', query_string='query=since&since=garbage')
+        self.assertEqual(status, '400 Bad Request')
+        status, _, _ = self.request('GET', '/users', query_string='query=since&since=2016-02-01T00:00:00Z')
+        self.assertEqual(status, '200 OK')
+
+
+
+class RevocationTests(AppTestCase):
+    def test_revocation_is_shared(self):
+        from nwmapi import tokens
+        settings = {'auth.keys': 'test:secret',
+                    'auth.revocation_url': 'sqlite:///%s' % os.path.join(self.directory, 'revoked.sqlite')}
+        # the signers of two workers
+        first, second = tokens.from_settings(settings), tokens.from_settings(settings)
+        self.addCleanup(first.revoked.stop)
+        self.addCleanup(second.revoked.stop)
+        token = self.token().split(' ', 1)[1]
+
+        first.revoke(first.verify(token))
+        self.assertRaises(tokens.InvalidToken, first.verify, token)
+        # the other process only reads the database when it refreshes
+        second.verify(token)
+        second.revoked.refresh()
+        self.assertRaises(tokens.InvalidToken, second.verify, token)
+
+    def test_verify_does_not_query(self):
+        from nwmapi import sqlstats, tokens
+        settings = {'auth.keys': 'test:secret',
+                    'auth.revocation_url': 'sqlite:///%s' % os.path.join(self.directory, 'revoked.sqlite')}
+        signer = tokens.from_settings(settings)
+        self.addCleanup(signer.revoked.stop)
+        sqlstats.install(signer.revoked.engine)
+        token = self.token().split(' ', 1)[1]
+        with sqlstats.count_queries() as counter:
+            signer.verify(token)
+        self.assertEqual(counter(), 0)
+
+
+class AdminTokenTests(AppTestCase):
+    settings = {'metrics.enabled': 'true', 'metrics.token': 'admin-token',
+                'slowqueries.threshold_ms': '200', 'slowqueries.token': 'admin-token'}
+
+    def test_token_required(self):
+        for path in ('/metrics', '/meta/slow-queries'):
+            self.assertEqual(self.request('GET', path)[0], '401 Unauthorized')
+            self.assertEqual(self.request('GET', path, headers={'X-Admin-Token': 'wrong'})[0], '401 Unauthorized')
+            self.assertEqual(self.request('GET', path, headers={'X-Admin-Token': 'admin-token'})[0], '200 OK')
+
+
+class SearchTests(AppTestCase):
+    def test_invalid_filters(self):
+        for q in ('notjson', '{"filters": [{"name": "id", "op": "in", "val": ["notanid"]}]}',
+                  '{"filters": [{"name": "id", "op": "notanop", "val": 1}]}'):
+            self.assertEqual(self.request('GET', '/users', query_string='q=' + q)[0], '400 Bad Request')
+            self.assertEqual(self.request('GET', '/users/export', query_string='q=' + q)[0], '400 Bad Request')
+
+    def test_temp_tables_are_dropped(self):
+        from nwmapi import search
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import User
+        self.addCleanup(setattr, search, 'IN_TEMP_TABLE_THRESHOLD', search.IN_TEMP_TABLE_THRESHOLD)
+        search.IN_TEMP_TABLE_THRESHOLD = 2
+
+        ids = [uuid.uuid4().hex for i in range(3)]
+        self.assertEqual(DBSession.query(User).filter(search.in_clause(User.id, ids, DBSession)).all(), [])
+        dbapi_connection = DBSession.connection().connection
+        search.drop_in_temp_tables(DBSession)
+        # as DBSession.close() does
+        dbapi_connection.rollback()
+        self.assertEqual(dbapi_connection.execute('SELECT name FROM sqlite_temp_master').fetchall(), [])
+
+
+class ValidationTests(unittest.TestCase):
+    def test_datetime(self):
+        from nwmapi import validation
+        from nwmapi.models.user import User
+        schema = validation.schema(User)
+        for value in ('2016-02-01T10:20:30.123Z', '2016-02-01T10:20:30+01:00', '2016-02-01', '2016-02-01 10:20'):
+            self.assertEqual(schema.validate({'created_at': value}, partial=True), {}, value)
+        for value in ('2016-13-45', '2016-02-30T10:20:30Z', '2016-02-01T25:00', 'yesterday', 20160201):
+            self.assertIn('created_at', schema.validate({'created_at': value}, partial=True), value)
+
+
+class DatetimeTests(unittest.TestCase):
+    def test_iso8601(self):
+        from datetime import datetime, timedelta
+        from nwmapi.db import UTC, parse_iso8601
+        self.assertEqual(parse_iso8601('2016-02-01T10:20:30Z'), datetime(2016, 2, 1, 10, 20, 30, tzinfo=UTC))
+        self.assertEqual(parse_iso8601('2016-02-01 10:20:30'), datetime(2016, 2, 1, 10, 20, 30))
+        for offset in ('+05:30', '+0530'):
+            parsed = parse_iso8601('2016-02-01T10:20:30' + offset)
+            self.assertEqual(parsed.utcoffset(), timedelta(hours=5, minutes=30))
+            self.assertEqual(parsed, datetime(2016, 2, 1, 4, 50, 30, tzinfo=UTC))
+        self.assertEqual(parse_iso8601('2016-02-01T10:20:30-01:30').utcoffset(), -timedelta(hours=1, minutes=30))
+
+    def test_iso8601_fractions(self):
+        from nwmapi.db import parse_iso8601
+        for fraction, microsecond in (('1', 100000), ('123', 123000), ('123456', 123456), ('1234567', 123456),
+                                      ('123456789', 123456)):
+            self.assertEqual(parse_iso8601('2016-02-01T10:20:30.%sZ' % fraction).microsecond, microsecond, fraction)
+
+    def test_iso8601_other_formats(self):
+        from nwmapi.db import parse_iso8601
+        for value in ('2016-02-30T10:20:30Z', '2016-13-01T10:20:30Z', '2016-02-01T24:00:00', '2016-02-01T10:60:00',
+                      '2016-02-01', '2016-02-01T10:20', '2016-02-01T10:20:30Zjunk', 'yesterday'):
+            self.assertIsNone(parse_iso8601(value), value)
+
+    def test_dateutil_fallback(self):
+        from datetime import datetime
+        from nwmapi.db import parse_datetime
+        self.assertEqual(parse_datetime('2016-02-01'), datetime(2016, 2, 1))
+        self.assertEqual(parse_datetime('Feb 1 2016 10:20'), datetime(2016, 2, 1, 10, 20))
+        self.assertRaises(ValueError, parse_datetime, 'yesterday')
+
+
+class ConvertersTests(unittest.TestCase):
+    def test_cached_per_model(self):
+        from nwmapi.db import Base, parse_datetime
+        from nwmapi.models.user import Activation, User
+        converters = User.column_converters()
+        self.assertIs(User.column_converters(), converters)
+        self.assertIs(converters['created_at'], parse_datetime)
+        self.assertIsNone(converters['username'])
+        activation_converters = Activation.column_converters()
+        self.assertIsNot(activation_converters, converters)
+        self.assertEqual(sorted(activation_converters), sorted(Activation.__table__.columns.keys()))
+        self.assertNotIn('_column_converters', Base.__dict__)
+
+    def test_from_dict(self):
+        from datetime import datetime
+        from nwmapi.db import UTC
+        from nwmapi.models.user import User
+        user = User()
+        user.from_dict({'firstname': 'Ann', 'lastname': '', 'created_at': '2016-02-01T10:20:30.5Z',
+                        'updated_at': 'Feb 1 2016', 'unknown': 'ignored'})
+        self.assertEqual(user.firstname, 'Ann')
+        self.assertIsNone(user.lastname)
+        self.assertEqual(user.created_at, datetime(2016, 2, 1, 10, 20, 30, 500000, tzinfo=UTC))
+        self.assertEqual(user.updated_at, datetime(2016, 2, 1))
+        self.assertFalse(hasattr(user, 'unknown'))
+
+
+class PasswordsTests(unittest.TestCase):
+    def setUp(self):
+        from nwmapi import passwords
+        self.addCleanup(setattr, passwords, 'TIMEOUT', passwords.TIMEOUT)
+        self.addCleanup(passwords.configure, workers=passwords.WORKERS, queue_depth=passwords.QUEUE_DEPTH)
+        passwords.configure(workers=1, queue_depth=1)
+        passwords.TIMEOUT = 0.05
+
+    def test_timeout_is_busy(self):
+        from nwmapi import passwords
+        self.assertRaises(passwords.PasswordPoolBusy, passwords._run, time.sleep, 0.5)
+        # queued behind the sleep, then cancelled, which gives its slot back
+        self.assertRaises(passwords.PasswordPoolBusy, passwords._run, time.sleep, 0)
+        self.assertTrue(passwords._slots.acquire(False))
+        passwords._slots.release()
+
+
+class JobsTests(unittest.TestCase):
+    def setUp(self):
+        from sqlalchemy import create_engine
+        from nwmapi import jobs
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(jobs.JOB_TYPES.pop, 'test_lost', None)
+        jobs.job_type('test_lost', max_attempts=2, lease=0)(lambda payload: None)
+        self.queue = jobs.JobQueue(create_engine('sqlite:///%s' % os.path.join(directory, 'jobs.sqlite')))
+
+    def test_expired_lease_after_last_attempt_fails(self):
+        job_id = self.queue.enqueue('test_lost')
+        # two workers crash with the job
+        self.assertEqual(self.queue.claim(['test_lost'])[3], 1)
+        time.sleep(0.01)
+        self.assertEqual(self.queue.claim(['test_lost'])[3], 2)
+        time.sleep(0.01)
+        self.assertIsNone(self.queue.claim(['test_lost']))
+        job = self.queue.get(job_id)
+        self.assertEqual((job['status'], job['attempts']), ('failed', 2))
+
+
+class SweepTests(AppTestCase):
+    def setUp(self):
+        super(SweepTests, self).setUp()
+        import datetime
+        from nwmapi import search
+        from nwmapi.db import DBSession, utcnow
+        from nwmapi.models.user import Activation, User, NON_ACTIVATION_AGE
+        self.addCleanup(setattr, search, 'IN_CHUNK_SIZE', search.IN_CHUNK_SIZE)
+        self.create_users(6)
+        # user0 to user4 never verified their account, user5 signed up recently
+        old = [user_id for user_id, in DBSession.query(User.id).filter(User.username != 'user5')]
+        DBSession.query(Activation).filter(Activation.user_id.in_(old)).update(
+            {'valid_until': utcnow() - NON_ACTIVATION_AGE - datetime.timedelta(days=1)},
+            synchronize_session=False)
+        DBSession.commit()
+
+    def usernames(self):
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import Activation, User
+        self.assertEqual(DBSession.query(Activation).count(), DBSession.query(User).count())
+        return [username for username, in DBSession.query(User.username)]
+
+    def test_sweep(self):
+        from nwmapi import search
+        from nwmapi.services import userservice
+        search.IN_CHUNK_SIZE = 2
+        progress = []
+        deleted = userservice.sweep_non_activated_accounts(batch_size=3, progress=lambda total, rate: progress.append(total))
+        self.assertEqual(deleted, 5)
+        self.assertEqual(progress, [3, 5])
+        self.assertEqual(self.usernames(), ['user5'])
+
+    def test_job(self):
+        from nwmapi import jobs
+        from nwmapi.services import userservice  # registers the job type
+        self.assertEqual(jobs.JOB_TYPES['sweep_non_activated_accounts'].func({'batch_size': 2}), {'deleted': 5})
+        self.assertEqual(self.usernames(), ['user5'])
+
+    def test_enqueue_runs_inline_without_queue(self):
+        from nwmapi.services import userservice
+        self.assertIsNone(userservice.enqueue_sweep_non_activated_accounts(batch_size=2))
+        self.assertEqual(self.usernames(), ['user5'])
+
+
+class TimingTests(AppTestCase):
+    settings = {'timing.enabled': 'true'}
+
+    def test_server_timing(self):
+        self.create_users(1)
+        status, headers, _ = self.request('GET', '/users')
+        self.assertEqual(status, '200 OK')
+        phases = [phase.split(';dur=')[0] for phase in headers['server-timing'].split(', ')]
+        for phase in ('mw', 'route', 'db', 'serialize', 'encode', 'app', 'total'):
+            self.assertIn(phase, phases)
+        self.assertEqual(phases[-1], 'total')
+
+    def test_error_response(self):
+        status, headers, _ = self.request('GET', '/users/%s' % uuid.uuid4().hex)
+        self.assertEqual(status, '404 Not Found')
+        self.assertIn('total;dur=', headers['server-timing'])
+
+
+class TimingDisabledTests(AppTestCase):
+    def test_no_header(self):
+        from sqlalchemy import event
+        from nwmapi import timing
+        from nwmapi.db import DBSession
+        status, headers, _ = self.request('GET', '/users')
+        self.assertEqual(status, '200 OK')
+        self.assertNotIn('server-timing', headers)
+        self.assertFalse(event.contains(DBSession.get_bind(), 'before_cursor_execute', timing._before_cursor_execute))
+
+
+class SlowQueriesTests(AppTestCase):
+    # every statement is slow
+    settings = {'slowqueries.threshold_ms': '0.000001', 'slowqueries.token': 'admin-token'}
+
+    def slow_queries(self):
+        status, _, body = self.request('GET', '/meta/slow-queries', headers={'X-Admin-Token': 'admin-token'})
+        self.assertEqual(status, '200 OK')
+        return json.loads(body.decode('utf-8'))
+
+    def test_recorded(self):
+        user_id = uuid.uuid4().hex
+        self.assertEqual(self.request('GET', '/users/%s' % user_id)[0], '404 Not Found')
+        entry = self.slow_queries()[0]
+        self.assertEqual(entry['route'], 'GET /users/{id}')
+        self.assertTrue(entry['statement'].lstrip().startswith('SELECT'))
+        # the types of the parameters, not their values
+        self.assertNotIn(user_id, json.dumps(entry['params']))
+        for _ in range(100):
+            entry = [e for e in self.slow_queries() if e['route'] == 'GET /users/{id}'][0]
+            if entry['plan'] is not None:
+                break
+            time.sleep(0.01)
+        self.assertIsInstance(entry['plan'], list)
+
+
+class SlowQueriesDisabledTests(AppTestCase):
+    def test_disabled(self):
+        from nwmapi import slowqueries
+        self.assertEqual(self.request('GET', '/users')[0], '200 OK')
+        # no route
+        status, _, body = self.request('GET', '/meta/slow-queries')
+        self.assertEqual(status, '400 Bad Request')
+        self.assertEqual(json.loads(body.decode('utf-8'))['title'], 'Invalid url')
+        self.assertIsNone(slowqueries.registry)
+
+
+class ProfilingTests(AppTestCase):
+    def setUp(self):
+        self.profiles = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.profiles)
+        self.settings = {'profiling.token': 'profile-token', 'profiling.sample_every': '2',
+                         'profiling.directory': self.profiles, 'profiling.keep': '3'}
+        super(ProfilingTests, self).setUp()
+
+    def test_on_demand(self):
+        status, headers, body = self.request('GET', '/users', query_string='limit=5',
+                                             headers={'X-Profile': 'profile-token'})
+        self.assertEqual(status, '200 OK')
+        self.assertTrue(headers['content-type'].startswith('text/plain'))
+        self.assertTrue(body.decode('utf-8').startswith('GET /users limit\n'))
+        self.assertIn('cumulative', body.decode('utf-8'))
+        self.assertEqual(os.listdir(self.profiles), [headers['x-profile-dump']])
+
+        status, headers, body = self.request('GET', '/users', headers={'X-Profile': 'wrong'})
+        self.assertEqual(headers['content-type'], 'application/json; charset=utf-8')
+        self.assertEqual(json.loads(body.decode('utf-8')), [])
+
+    def test_sampled(self):
+        dumps = []
+        for _ in range(10):
+            status, headers, body = self.request('GET', '/users')
+            self.assertEqual(json.loads(body.decode('utf-8')), [])
+            if 'x-profile-dump' in headers:
+                dumps.append(headers['x-profile-dump'])
+        self.assertEqual(len(dumps), 5)
+        self.assertEqual(sorted(os.listdir(self.profiles)), dumps[-3:])
+
+
+class ProfilingDisabledTests(AppTestCase):
+    def test_disabled(self):
+        from nwmapi import profiling
+        self.assertIsNone(profiling.from_settings({'profiling.token': '', 'profiling.sample_every': '0'}))
+        status, headers, body = self.request('GET', '/users', headers={'X-Profile': ''})
+        self.assertEqual(json.loads(body.decode('utf-8')), [])
+        self.assertNotIn('x-profile-dump', headers)
+
+
+class ExportTests(AppTestCase):
+    def setUp(self):
+        super(ExportTests, self).setUp()
+        from nwmapi import export
+        self.addCleanup(setattr, export, 'CHUNK_SIZE', export.CHUNK_SIZE)
+        # several chunks per response
+        export.CHUNK_SIZE = 1
+        self.create_users(3)
+
+    def export(self, fmt):
+        from nwmapi import export
+        status, headers, body = self.request('GET', '/users/export', query_string='format=' + fmt,
+                                             headers={'Accept': export.MEDIA_TYPES[fmt]})
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(headers['content-type'], export.MEDIA_TYPES[fmt])
+        return body.decode('utf-8')
+
+    def test_ndjson(self):
+        rows = [json.loads(line) for line in self.export('ndjson').splitlines()]
+        self.assertEqual(sorted(row['username'] for row in rows), ['user0', 'user1', 'user2'])
+        for row in rows:
+            self.assertNotIn('password', row)
+            self.assertEqual(len(row['id']), 32)
+
+    def test_csv(self):
+        import csv
+        import io
+        rows = list(csv.DictReader(io.StringIO(self.export('csv'))))
+        self.assertEqual(sorted(row['username'] for row in rows), ['user0', 'user1', 'user2'])
+        self.assertNotIn('password', rows[0])
+        self.assertEqual(rows[0]['firstname'], '')
+
+    def test_unknown_format(self):
+        status, _, _ = self.request('GET', '/users/export', query_string='format=xml')
+        self.assertEqual(status, '400 Bad Request')
+
+
+class PatchTests(AppTestCase):
+    def setUp(self):
+        super(PatchTests, self).setUp()
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import User
+        self.create_users(1)
+        self.user_id = DBSession.query(User.id).scalar().hex
+        self.patch({'firstname': 'Ann', 'lastname': 'Smith', 'custom_data': {'a': 1, 'b': {'c': 2}}})
+
+    def patch(self, body, user_id=None):
+        status, _, _ = self.request('PATCH', '/users/%s' % (user_id or self.user_id), body=body,
+                                    headers={'Content-Type': 'application/merge-patch+json'})
+        return status
+
+    def user(self):
+        """The columns of the user as a dictionary."""
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import User
+        columns = User.__table__.columns
+        DBSession.remove()
+        return dict(zip(columns.keys(), DBSession.query(*columns).one()))
+
+    def test_only_patched_columns_change(self):
+        before = self.user()
+        self.assertEqual(self.patch({'firstname': 'Bea'}), '204 No Content')
+        after = self.user()
+        self.assertEqual(after.pop('firstname'), 'Bea')
+        self.assertGreaterEqual(after.pop('updated_at'), before.pop('updated_at'))
+        before.pop('firstname')
+        self.assertEqual(after, before)
+
+    def test_null_clears_column(self):
+        self.assertEqual(self.patch({'lastname': None}), '204 No Content')
+        self.assertIsNone(self.user()['lastname'])
+
+    def test_nested_objects_merge(self):
+        self.assertEqual(self.patch({'custom_data': {'a': None, 'b': {'d': 3}, 'e': 4}}), '204 No Content')
+        self.assertEqual(self.user()['custom_data'], {'b': {'c': 2, 'd': 3}, 'e': 4})
+
+    def test_missing_user(self):
+        self.assertEqual(self.patch({'firstname': 'Bea'}, user_id=uuid.uuid4().hex), '404 Not Found')
+        self.assertEqual(self.patch({'custom_data': {'a': 2}}, user_id=uuid.uuid4().hex), '404 Not Found')
+
+
+class LookupTests(AppTestCase):
+    def setUp(self):
+        super(LookupTests, self).setUp()
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import User
+        self.create_users(3)
+        self.ids = dict((username, user_id.hex) for username, user_id in DBSession.query(User.username, User.id))
+        DBSession.remove()
+
+    def lookup(self, ids):
+        status, _, body = self.request('GET', '/users', query_string='ids=%s' % ','.join(ids))
+        return status, json.loads(body.decode('utf-8'))
+
+    def test_order_is_kept(self):
+        ids = [self.ids['user2'], self.ids['user0'], self.ids['user1']]
+        status, result = self.lookup(ids)
+        self.assertEqual(status, '200 OK')
+        self.assertEqual([user['id'] for user in result], ids)
+        self.assertEqual([user['username'] for user in result], ['user2', 'user0', 'user1'])
+
+    def test_missing_ids_are_null(self):
+        missing = uuid.uuid4().hex
+        status, result = self.lookup([self.ids['user1'], missing])
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(result[0]['username'], 'user1')
+        self.assertIsNone(result[1])
+
+    def test_invalid_ids(self):
+        status, result = self.lookup([self.ids['user1'], 'nothex'])
+        self.assertEqual(status, '400 Bad Request')
+        self.assertIn('nothex', result['description'])
+
+    def test_too_many_ids(self):
+        from nwmapi.resources.users import MAX_LOOKUP_IDS
+        ids = [uuid.uuid4().hex for _ in range(MAX_LOOKUP_IDS + 1)]
+        status, _, _ = self.request('POST', '/users/lookup', body={'ids': ids})
+        self.assertEqual(status, '400 Bad Request')
+        status, result = self.lookup(ids[:MAX_LOOKUP_IDS])
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(result, [None] * MAX_LOOKUP_IDS)
+
+    def test_post(self):
+        ids = [self.ids['user1'], uuid.uuid4().hex, self.ids['user0']]
+        status, _, body = self.request('POST', '/users/lookup', body={'ids': ids})
+        self.assertEqual(status, '200 OK')
+        result = json.loads(body.decode('utf-8'))
+        self.assertEqual([user and user['username'] for user in result], ['user1', None, 'user0'])
+        status, _, _ = self.request('POST', '/users/lookup', body={'ids': self.ids['user1']})
+        self.assertEqual(status, '400 Bad Request')
+
+
+class PreforkTests(unittest.TestCase):
+    def setUp(self):
+        import gc
+        from nwmapi import prefork
+        # load() leaves the collector to the master
+        self.addCleanup(gc.enable)
+        self.addCleanup(setattr, prefork, '_deferred', [])
+        self.addCleanup(setattr, prefork, '_engines', [])
+
+    def test_start_is_deferred_while_loading(self):
+        from nwmapi import prefork
+        calls = []
+        self.assertEqual(prefork.load(lambda: prefork.start(lambda: calls.append('loading')) or 'app'), 'app')
+        self.assertEqual(calls, [])
+        prefork.start(lambda: calls.append('now'))
+        self.assertEqual(calls, ['now'])
+        self.assertEqual(len(prefork._deferred), 1)
+
+    def test_workers(self):
+        import signal
+        from nwmapi import prefork
+        try:
+            from http.client import HTTPConnection
+        except ImportError:
+            from httplib import HTTPConnection
+
+        started = []
+
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [('%d %s' % (os.getpid(), started)).encode('utf-8')]
+
+        sock = prefork.bind('127.0.0.1', 0)
+        self.addCleanup(sock.close)
+        app = prefork.load(lambda: prefork.start(lambda: started.append(os.getpid())) or app)
+        master = os.fork()
+        if not master:
+            try:
+                prefork.Arbiter(app, sock, workers=2, graceful_timeout=1).run()
+            finally:
+                os._exit(0)
+
+        try:
+            pids = set()
+            for _ in range(10):
+                connection = HTTPConnection('127.0.0.1', sock.getsockname()[1], timeout=10)
+                connection.request('GET', '/')
+                pid, deferred = connection.getresponse().read().decode('utf-8').split(' ', 1)
+                connection.close()
+                # the deferred call ran in the worker
+                self.assertEqual(deferred, '[%s]' % pid)
+                pids.add(int(pid))
+            self.assertNotIn(os.getpid(), pids)
+            self.assertNotIn(master, pids)
+        finally:
+            os.kill(master, signal.SIGTERM)
+            self.assertEqual(os.waitpid(master, 0)[1], 0)
+        self.assertEqual(started, [])
+
+
+class AtomicBatchTests(AppTestCase):
+    def test_failed_batch_is_rolled_back(self):
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import User
+        self.create_users(1)
+        user_id = DBSession.query(User.id).scalar().hex
+        DBSession.remove()
+
+        status, _, body = self.request('POST', '/batch', body={'atomic': True, 'requests': [
+            {'method': 'PATCH', 'path': '/users/%s' % user_id, 'body': {'firstname': 'Ann'}},
+            {'method': 'GET', 'path': '/users/%s' % uuid.uuid4().hex}]})
+        self.assertEqual(status, '200 OK')
+        result = json.loads(body.decode('utf-8'))
+        self.assertEqual([response['status'] for response in result['responses']], [204, 404])
+        self.assertFalse(result['committed'])
+        self.assertIsNone(DBSession.query(User.firstname).scalar())
+
+    def test_batch_is_committed(self):
+        from nwmapi.db import DBSession
+        from nwmapi.models.user import User
+        self.create_users(1)
+        user_id = DBSession.query(User.id).scalar().hex
+        DBSession.remove()
+
+        status, _, body = self.request('POST', '/batch', body={'atomic': True, 'requests': [
+            {'method': 'PATCH', 'path': '/users/%s' % user_id, 'body': {'firstname': 'Ann'}},
+            {'method': 'PATCH', 'path': '/users/%s' % user_id, 'body': {'lastname': 'Smith'}}]})
+        self.assertTrue(json.loads(body.decode('utf-8'))['committed'])
+        self.assertEqual(DBSession.query(User.firstname, User.lastname).one(), ('Ann', 'Smith'))
+
+
+class JsonArrayTests(unittest.TestCase):
+    def parse(self, body, chunk_size, max_body=1024):
+        from nwmapi import middleware
+        self.addCleanup(setattr, middleware, 'READ_CHUNK_SIZE', middleware.READ_CHUNK_SIZE)
+        middleware.READ_CHUNK_SIZE = chunk_size
+        req = middleware.Request(testing.create_environ(method='POST', body=body))
+        req.max_body = max_body
+        return list(middleware.iter_json_array(req))
+
+    def test_items(self):
+        for body in ('[]', ' [ ] ', '[12.5]', '[1e5,2]', '[-0.25E-3 , 7]', '[true,false,null]',
+                     '[{"a": [1, 2.5]}, "x,]", 10]', u'["é€", 3]\n'):
+            for chunk_size in (1, 2, 3, 7, 1024):
+                self.assertEqual(self.parse(body.encode('utf-8'), chunk_size), json.loads(body), (body, chunk_size))
+
+    def test_malformed(self):
+        import falcon
+        for body in (b'', b'{}', b'[1,]', b'[1 2]', b'[12x]', b'[1] 2', b'[1]]', b'[1', b'["\xff"]'):
+            for chunk_size in (1, 2, 1024):
+                with self.assertRaises(falcon.HTTPError) as raised:
+                    self.parse(body, chunk_size)
+                self.assertEqual(raised.exception.status, '400 Bad Request', (body, chunk_size))
+
+    def test_too_large(self):
+        import falcon
+        with self.assertRaises(falcon.HTTPError) as raised:
+            self.parse(b'[' + b'1,' * 100 + b'1]', 16, max_body=64)
+        self.assertEqual(raised.exception.status, '413 Payload Too Large')
+
+
+class BodyLimitTests(AppTestCase):
+    settings = {'request.max_body': '64'}
+
+    def test_too_large(self):
+        status, _, _ = self.request('POST', '/users', body={'username': 'x' * 100})
+        self.assertEqual(status, '413 Payload Too Large')
+        status, _, _ = self.request('POST', '/users/bulk', body=[{'username': 'x' * 100}])
+        self.assertNotEqual(status, '413 Payload Too Large')
@@ -0,0 +1,193 @@
+"""Per-request phase timings in a ``Server-Timing`` header.
+
+When ``timing.enabled`` is set, every response carries::
+
+    Server-Timing: mw;dur=0.41, route;dur=0.03, hooks;dur=0.12, db;dur=3.80,
+                   serialize;dur=0.95, encode;dur=0.40, app;dur=1.10, total;dur=6.81
+
+and a ``timing`` log line with the same values, in milliseconds. The phases
+are exclusive: SQL run while serializing counts as ``db``, not ``serialize``.
+
+* ``mw``: middleware methods
+* ``route``: finding the responder
+* ``hooks``: ``falcon.before`` hooks wrapped with :func:`timed_hook`
+* ``db``: executing statements, from the engine's cursor events; fetching and
+  loading the rows counts as ``app``
+* ``serialize``: ``to_dict()`` of the models
+* ``encode``: ``json.dumps()`` of the response
+* ``app``: everything else until the response
+
+When disabled, no component or listener is installed, and the instrumented
+functions only check a thread-local.
+
+Settings::
+
+    timing.enabled = false
+"""
+from collections import OrderedDict
+import functools
+import logging
+import threading
+import time
+import types
+
+from sqlalchemy import event
+
+from nwmapi.common import booleanize
+
+log = logging.getLogger(__name__)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+_local = threading.local()
+
+
+class RequestTimer(object):
+    """Exclusive time spent in each phase of a request."""
+
+    def __init__(self):
+        self.started = clock()
+        self.phases = OrderedDict()
+        self.last_mw_end = None
+        # [phase, start, time spent in nested phases]
+        self._stack = []
+
+    def push(self, name):
+        self._stack.append([name, clock(), 0.0])
+
+    def pop(self):
+        name, start, nested = self._stack.pop()
+        self.add(name, clock() - start, nested)
+
+    def add(self, name, seconds, nested=0.0):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds - nested
+        if self._stack:
+            self._stack[-1][2] += seconds
+
+    def total(self):
+        return clock() - self.started
+
+    def header(self, total):
+        phases = list(self.phases.items())
+        phases.append(('app', max(0.0, total - sum(self.phases.values()))))
+        phases.append(('total', total))
+        return ', '.join('%s;dur=%.2f' % (name, seconds * 1000) for name, seconds in phases)
+
+
+def current():
+    """The timer of the request handled by this thread, or ``None``."""
+    return getattr(_local, 'timer', None)
+
+
+def timed(name):
+    """Count the time spent in the decorated function as phase ``name``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timer = getattr(_local, 'timer', None)
+            if timer is None:
+                return func(*args, **kwargs)
+            timer.push(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timer.pop()
+        return wrapper
+    return decorator
+
+
+def timed_hook(hook):
+    """Count the time spent in the ``falcon.before`` hook as ``hooks``.
+
+    The wrapper keeps the ``(req, resp, resource, params)`` signature falcon
+    inspects.
+    """
+    def wrapper(req, resp, resource, params):
+        timer = getattr(_local, 'timer', None)
+        if timer is None:
+            return hook(req, resp, resource, params)
+        timer.push('hooks')
+        try:
+            return hook(req, resp, resource, params)
+        finally:
+            timer.pop()
+    return wrapper
+
+
+class TimedComponent(object):
+    """Middleware ``component`` whose methods count as ``mw``."""
+
+    def __init__(self, component):
+        self.component = component
+        for method in ('process_request', 'process_resource', 'process_response'):
+            func = getattr(component, method, None)
+            if func is not None:
+                # falcon only accepts bound methods
+                setattr(self, method, types.MethodType(self._wrap(method, func), self))
+
+    @staticmethod
+    def _wrap(method, func):
+        def wrapper(self, req, resp, *args):
+            timer = getattr(_local, 'timer', None)
+            if timer is None:
+                return func(req, resp, *args)
+            if method == 'process_resource' and 'route' not in timer.phases and timer.last_mw_end:
+                timer.add('route', clock() - timer.last_mw_end)
+            timer.push('mw')
+            try:
+                return func(req, resp, *args)
+            finally:
+                timer.pop()
+                timer.last_mw_end = clock()
+        return wrapper
+
+
+class ServerTiming(object):
+    """Starts the timer of each request and reports it.
+
+    Must be the first middleware component, so that its ``process_response``
+    runs last.
+    """
+
+    def process_request(self, req, resp):
+        _local.timer = RequestTimer()
+
+    def process_response(self, req, resp, resource):
+        timer = getattr(_local, 'timer', None)
+        if timer is None:
+            return
+        _local.timer = None
+
+        total = timer.total()
+        header = timer.header(total)
+        resp.set_header('Server-Timing', header)
+        log.info('timing method=%s route=%s status=%s %s', req.method,
+                 getattr(resource, '__url__', None), resp.status.split(' ', 1)[0],
+                 header.replace(';dur=', '=').replace(', ', ' '))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_local, 'timer', None) is not None:
+        conn.info['timing.query_start'] = clock()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timer = getattr(_local, 'timer', None)
+    start = conn.info.pop('timing.query_start', None)
+    if timer is not None and start is not None:
+        timer.add('db', clock() - start)
+
+
+def install(engine):
+    """Count the statements executed through ``engine`` as ``db``."""
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def instrument(settings, engine, components):
+    """Return ``components`` timed, after a :class:`ServerTiming`, if ``timing.enabled``."""
+    if not booleanize(settings.get('timing.enabled', False)):
+        return components
+    install(engine)
+    return [ServerTiming()] + [TimedComponent(component) for component in components]
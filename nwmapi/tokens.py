@@ -0,0 +1,246 @@
+"""Stateless signed access tokens.
+
+An access token carries the user id, role, status and expiry, signed with
+HMAC-SHA256::
+
+    base64url(json claims) "." base64url(signature)
+
+so it is verified in-process without a database lookup. The claims name the
+key they were signed with (``kid``): tokens are signed with the current key,
+and the previous keys stay valid for verification until removed from the
+configuration, which allows rotating keys without logging everybody out.
+
+Revoked tokens are remembered by id (``jti``) until they expire, in the
+database of ``auth.revocation_url`` shared by every process using it: the
+SQLite file of the jobs for the workers of one host, the main database for
+several hosts. Verifying a token never reads that database: each process
+keeps the revoked ids in memory and reloads them in the background every
+``auth.revocation_refresh`` seconds, so a token revoked by another process
+is rejected within that delay (at once by the process revoking it).
+Without ``auth.revocation_url`` the list is only kept in memory, so it is
+per process (a token revoked by one prefork worker is still accepted by the
+others) and lost on restart.
+
+Settings::
+
+    # <key id>:<secret> ..., the first key signs new tokens
+    auth.keys = 2016b:secret2 2016a:secret1
+    auth.token_ttl = 3600
+    auth.revocation_url = sqlite:///%(here)s/nwmjobs.sqlite
+    auth.revocation_refresh = 5
+"""
+import base64
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy import Table, Column, MetaData, String, Float, create_engine, select
+from sqlalchemy.exc import IntegrityError
+
+from nwmapi import prefork
+
+log = logging.getLogger(__name__)
+
+metadata = MetaData()
+
+revoked_token_table = Table(
+    'revoked_token', metadata,
+    Column('jti', String(32), primary_key=True),
+    Column('exp', Float, nullable=False, index=True),
+)
+
+
+class InvalidToken(Exception):
+    """The token is malformed, has a bad signature, or is expired or revoked."""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+class RevocationList(object):
+    """Ids of revoked tokens, kept until the tokens expire.
+
+    Holds at most ``max_size`` ids; past that the ones expiring first are
+    dropped.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._expiry = {}
+        self._lock = threading.Lock()
+
+    def add(self, jti, exp):
+        now = time.time()
+        with self._lock:
+            if len(self._expiry) >= self.max_size:
+                for key in [k for k, e in self._expiry.items() if e <= now]:
+                    del self._expiry[key]
+            if len(self._expiry) >= self.max_size:
+                for key in sorted(self._expiry, key=self._expiry.get)[:len(self._expiry) // 10 + 1]:
+                    del self._expiry[key]
+            self._expiry[jti] = exp
+
+    def __contains__(self, jti):
+        return jti in self._expiry
+
+
+class DatabaseRevocationList(object):
+    """Ids of revoked tokens in the database of ``engine``, shared by the processes using it.
+
+    Lookups only read a copy of the ids in memory, reloaded with
+    :meth:`refresh` every ``refresh_interval`` seconds by the thread of
+    :meth:`start`. Expired ids are deleted at most every ``purge_interval``
+    seconds by each process, when a token is revoked.
+    """
+
+    def __init__(self, engine, refresh_interval=5.0, purge_interval=3600):
+        self.engine = engine
+        self.refresh_interval = refresh_interval
+        self.purge_interval = purge_interval
+        self._purged = 0
+        self._revoked = frozenset()
+        # jti -> exp of the tokens revoked by this process, until a refresh reads them
+        self._added = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        metadata.create_all(engine)
+        self.refresh()
+
+    def add(self, jti, exp):
+        now = time.time()
+        with self._lock:
+            self._added[jti] = exp
+        if now - self._purged > self.purge_interval:
+            self._purged = now
+            self.engine.execute(revoked_token_table.delete().where(revoked_token_table.c.exp < now))
+        try:
+            self.engine.execute(revoked_token_table.insert().values(jti=jti, exp=exp))
+        except IntegrityError:
+            # revoked already
+            pass
+
+    def __contains__(self, jti):
+        return jti in self._revoked or jti in self._added
+
+    def refresh(self):
+        """Reload the ids of the tokens not expired yet from the database."""
+        table = revoked_token_table
+        now = time.time()
+        revoked = frozenset(row[0] for row in
+                            self.engine.execute(select([table.c.jti]).where(table.c.exp >= now)))
+        with self._lock:
+            self._revoked = revoked
+            self._added = dict((jti, exp) for jti, exp in self._added.items()
+                               if jti not in revoked and exp >= now)
+
+    def start(self):
+        """Refresh the ids in a daemon thread until :meth:`stop`."""
+        thread = threading.Thread(target=self._run, name='token-revocations')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                log.exception(e)
+
+
+class TokenSigner(object):
+    """Issues and verifies access tokens.
+
+    ``keys`` is an ordered mapping of key id to secret; the first key signs
+    new tokens.
+    """
+
+    def __init__(self, keys, ttl=3600, revoked=None):
+        if not keys:
+            raise ValueError('At least one signing key is required')
+        self.keys = OrderedDict((kid, secret if isinstance(secret, bytes) else secret.encode('utf-8'))
+                                for kid, secret in keys.items())
+        self.current_key_id = next(iter(self.keys))
+        self.ttl = ttl
+        self.revoked = RevocationList() if revoked is None else revoked
+
+    def _sign(self, kid, payload):
+        return _b64encode(hmac.new(self.keys[kid], payload, hashlib.sha256).digest())
+
+    def issue(self, user):
+        """Return a new access token for ``user``."""
+        claims = OrderedDict()
+        claims['sub'] = user.id.hex
+        claims['role'] = user.role
+        claims['status'] = user.status
+        claims['exp'] = int(time.time()) + self.ttl
+        claims['jti'] = uuid.uuid4().hex
+        claims['kid'] = self.current_key_id
+        payload = _b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+        return (payload + b'.' + self._sign(self.current_key_id, payload)).decode('ascii')
+
+    def verify(self, token):
+        """Return the claims of ``token``, or raise :exc:`InvalidToken`."""
+        try:
+            payload, signature = token.encode('ascii').split(b'.')
+            claims = json.loads(_b64decode(payload).decode('utf-8'))
+            kid = claims['kid']
+        except (ValueError, KeyError, TypeError, UnicodeError):
+            raise InvalidToken('Malformed token')
+
+        if kid not in self.keys:
+            raise InvalidToken('Unknown signing key')
+        if not hmac.compare_digest(signature, self._sign(kid, payload)):
+            raise InvalidToken('Bad signature')
+        if claims.get('exp', 0) < time.time():
+            raise InvalidToken('Token expired')
+        if claims.get('jti') in self.revoked:
+            raise InvalidToken('Token revoked')
+        return claims
+
+    def revoke(self, claims):
+        self.revoked.add(claims['jti'], claims['exp'])
+
+
+def parse_keys(value):
+    """Parse ``<key id>:<secret> ...`` into an ordered mapping."""
+    keys = OrderedDict()
+    for item in value.split():
+        kid, secret = item.split(':', 1)
+        keys[kid] = secret
+    return keys
+
+
+def from_settings(settings):
+    keys = settings.get('auth.keys')
+    if keys:
+        keys = parse_keys(keys)
+    else:
+        log.warning('auth.keys is not set, access tokens are signed with a random key '
+                    'and only valid in this process until it restarts')
+        keys = {'random': _b64encode(os.urandom(32))}
+
+    if settings.get('auth.revocation_url'):
+        engine = create_engine(settings['auth.revocation_url'])
+        prefork.register_engine(engine)
+        revoked = DatabaseRevocationList(engine,
+                                         refresh_interval=float(settings.get('auth.revocation_refresh', 5)))
+        prefork.start(revoked.start)
+    else:
+        log.warning('auth.revocation_url is not set, revoked access tokens are only rejected '
+                    'by the process which revoked them')
+        revoked = RevocationList()
+    return TokenSigner(keys, ttl=int(settings.get('auth.token_ttl', 3600)), revoked=revoked)
@@ -0,0 +1,160 @@
+"""Validation of request bodies against the columns of a model.
+
+A :class:`Schema` is compiled once per model from its table: each column
+gets a check of its type, length, enum values and nullability. Validating a
+body is then a single pass over its keys with a dictionary lookup per key,
+and every error of the body is reported, not only the first::
+
+    errors = schema(User).validate(data)
+    # {'email': 'longer than 255 characters', 'role': 'not one of CONSUMER, BUSINESS, ADMIN'}
+
+Primary keys cannot be set from a body. Columns which are neither nullable nor
+primary keys are required, unless the body is ``partial`` (an update).
+"""
+from collections import OrderedDict
+import re
+import uuid
+
+from sqlalchemy import Boolean, DateTime, Enum, Float, Integer, Numeric, String
+
+from nwmapi.db import GUID, UTCDateTime, parse_datetime, parse_iso8601
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+ISO_8601 = re.compile(r'\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}(:?\d{2})?)?)?$')
+
+
+def _string(length):
+    def check(value):
+        if not isinstance(value, string_types):
+            return 'not a string'
+        if length is not None and len(value) > length:
+            return 'longer than %d characters' % length
+    return check
+
+
+def _enum(values):
+    allowed = frozenset(values)
+    message = 'not one of %s' % ', '.join(values)
+
+    def check(value):
+        if not isinstance(value, string_types) or value not in allowed:
+            return message
+    return check
+
+
+def _guid(value):
+    if not isinstance(value, string_types):
+        return 'not a string'
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return 'not a 32 digits hex number'
+
+
+def _datetime(value):
+    # the format is not enough, 2016-13-45 has it: parse the value as from_dict will
+    if not isinstance(value, string_types):
+        return 'not an ISO 8601 date'
+    if parse_iso8601(value) is not None:
+        return None
+    if not ISO_8601.match(value):
+        return 'not an ISO 8601 date'
+    try:
+        parse_datetime(value)
+    except (ValueError, OverflowError):
+        return 'not an ISO 8601 date'
+
+
+def _integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        return 'not an integer'
+
+
+def _number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return 'not a number'
+
+
+def _boolean(value):
+    if not isinstance(value, bool):
+        return 'not a boolean'
+
+
+def _type_check(column_type):
+    """Return the check of a value of ``column_type``, ``None`` to accept any value."""
+    if isinstance(column_type, GUID):
+        return _guid
+    if isinstance(column_type, (UTCDateTime, DateTime)):
+        return _datetime
+    if isinstance(column_type, Enum):
+        return _enum(column_type.enums)
+    if isinstance(column_type, String):
+        return _string(column_type.length)
+    if isinstance(column_type, Boolean):
+        return _boolean
+    if isinstance(column_type, Integer):
+        return _integer
+    if isinstance(column_type, (Float, Numeric)):
+        return _number
+    # JSON and other types take any JSON value
+    return None
+
+
+def _column_check(column):
+    type_check = _type_check(column.type)
+    nullable = column.nullable
+
+    def check(value):
+        if value is None:
+            return None if nullable else 'may not be null'
+        if type_check is not None:
+            return type_check(value)
+    return check
+
+
+class Schema(object):
+    """The compiled checks of the columns of ``model``."""
+
+    def __init__(self, model):
+        self.model = model
+        self.checks = {}
+        self.required = []
+        for column in model.__table__.columns:
+            if column.primary_key:
+                continue
+            self.checks[column.name] = _column_check(column)
+            if not column.nullable:
+                self.required.append(column.name)
+
+    def validate(self, data, partial=False, prefix=''):
+        """Return the errors of ``data`` as an ordered mapping of field to message, empty if valid."""
+        errors = OrderedDict()
+        checks = self.checks
+        for key, value in data.items():
+            check = checks.get(key)
+            if check is None:
+                errors[prefix + key] = 'unknown field'
+                continue
+            message = check(value)
+            if message is not None:
+                errors[prefix + key] = message
+        if not partial:
+            for name in self.required:
+                if name not in data:
+                    errors[prefix + name] = 'required'
+        return errors
+
+
+_schemas = {}
+
+
+def schema(model):
+    """Return the :class:`Schema` of ``model``, compiled on first use."""
+    compiled = _schemas.get(model)
+    if compiled is None:
+        compiled = _schemas[model] = Schema(model)
+    return compiled
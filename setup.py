@@ -39,5 +39,7 @@ setup(name='nwmapi',
       main = nwmapi:main
       [console_scripts]
       initialize_nwmdb = nwmapi.scripts.initializedb:main
+      sweep_nwmdb = nwmapi.scripts.sweepaccounts:main
+      serve_nwmapi = nwmapi.scripts.serve:main
       """,
       )